@@ -21,7 +21,14 @@ if ($_SERVER['REQUEST_METHOD'] === 'OPTIONS') {
 require_once 'config.php';
 
 class FingerprintAPI {
+    // Paginación por cursor de los listados y tamaño de bloque de las exportaciones
+    const PAGE_DEFAULT_LIMIT = 50;
+    const PAGE_MAX_LIMIT = 500;
+    const EXPORT_CHUNK_SIZE = 1000;
+
     private $conn;
+    // Usuarios cuya galería cambió en esta solicitud (se notifican al bridge al final)
+    private $changed_users = [];
 
     public function __construct() {
         $database = new Database();
@@ -96,33 +103,62 @@ class FingerprintAPI {
                 $user_internal_id = $this->conn->lastInsertId();
             }
             
+            // Plantillas del dedo: la principal (slot 0) y, opcionalmente, las de otros tríos
+            // de muestras generadas por el bridge ('templates', la primera es la principal)
+            $templates = [$template];
+            if (isset($data['templates']) && is_array($data['templates'])) {
+                foreach (array_slice($data['templates'], 1) as $extra) {
+                    if (!is_string($extra) || strlen($extra) < 100 || strlen($extra) > 10000
+                        || !preg_match('/^[a-zA-Z0-9\/\r\n+]*={0,2}$/', $extra)) {
+                        $this->conn->rollBack();
+                        return ['success' => false, 'message' => 'Plantilla adicional inválida'];
+                    }
+                    $templates[] = $extra;
+                }
+            }
+            
             // Paso 2: Insertar o actualizar la huella en la tabla 'fingerprints'
             $query_finger = "
-                INSERT INTO fingerprints (user_id, finger_index, template, created_at)
-                VALUES (:user_id, :finger_index, :template, NOW())
+                INSERT INTO fingerprints (user_id, finger_index, template_slot, template, created_at)
+                VALUES (:user_id, :finger_index, :template_slot, :template, NOW())
                 ON DUPLICATE KEY UPDATE
                 template = VALUES(template),
-                updated_at = NOW()
+                updated_at = NOW(6)
             ";
             
             $stmt_finger = $this->conn->prepare($query_finger);
-            $stmt_finger->bindParam(":user_id", $user_internal_id, PDO::PARAM_INT);
-            $stmt_finger->bindParam(":finger_index", $finger_index, PDO::PARAM_INT);
-            $stmt_finger->bindParam(":template", $template, PDO::PARAM_STR);
-            
-            if ($stmt_finger->execute()) {
-                $this->conn->commit();
-                return [
-                    'success' => true,
-                    'message' => 'Huella registrada/actualizada exitosamente',
-                    'user_id' => $userId_str,
-                    'name' => $name
-                ];
-            } else {
-                $this->conn->rollBack();
-                return ['success' => false, 'message' => 'Error al guardar la huella'];
+            foreach ($templates as $slot => $slot_template) {
+                $stmt_finger->bindValue(":user_id", $user_internal_id, PDO::PARAM_INT);
+                $stmt_finger->bindValue(":finger_index", $finger_index, PDO::PARAM_INT);
+                $stmt_finger->bindValue(":template_slot", $slot, PDO::PARAM_INT);
+                $stmt_finger->bindValue(":template", $slot_template, PDO::PARAM_STR);
+                
+                if (!$stmt_finger->execute()) {
+                    $this->conn->rollBack();
+                    return ['success' => false, 'message' => 'Error al guardar la huella'];
+                }
             }
             
+            // Quitar plantillas sobrantes de un registro anterior con más plantillas
+            $stmt_stale = $this->conn->prepare("
+                DELETE FROM fingerprints
+                WHERE user_id = :user_id AND finger_index = :finger_index AND template_slot >= :slots
+            ");
+            $stmt_stale->bindValue(":user_id", $user_internal_id, PDO::PARAM_INT);
+            $stmt_stale->bindValue(":finger_index", $finger_index, PDO::PARAM_INT);
+            $stmt_stale->bindValue(":slots", count($templates), PDO::PARAM_INT);
+            $stmt_stale->execute();
+            
+            $this->conn->commit();
+            $this->changed_users[$user_internal_id] = true;
+            return [
+                'success' => true,
+                'message' => 'Huella registrada/actualizada exitosamente',
+                'user_id' => $userId_str,
+                'name' => $name,
+                'templates_stored' => count($templates)
+            ];
+            
         } catch(PDOException $e) {
             if ($this->conn->inTransaction()) {
                 $this->conn->rollBack();
@@ -139,28 +175,9 @@ class FingerprintAPI {
      */
     public function getAllVerificationData() {
         try {
-            // Solo obtener IDs internos y plantillas para el matching
-            $query = "
-                SELECT 
-                    u.id AS user_internal_id, 
-                    u.user_id AS user_id_str, 
-                    u.name, 
-                    f.template, 
-                    f.finger_index
-                FROM 
-                    fingerprints f
-                JOIN 
-                    users u ON f.user_id = u.id
-                WHERE
-                    u.status = 1
-            ";
-            $stmt = $this->conn->prepare($query);
-            $stmt->execute();
-            $data = $stmt->fetchAll(PDO::FETCH_ASSOC);
-
             return [
                 'success' => true, 
-                'data' => $data
+                'data' => $this->verificationRows()
             ];
         } catch(PDOException $e) {
             // Manejo de error más detallado para el backend
@@ -171,32 +188,209 @@ class FingerprintAPI {
             ];
         }
     }   
+
+    // Filas de la galería de verificación: todas, o solo las de un usuario (notificaciones al bridge)
+    private function verificationRows($user_internal_id = null) {
+        // Solo obtener IDs internos y plantillas para el matching
+        $query = "
+            SELECT 
+                u.id AS user_internal_id, 
+                u.user_id AS user_id_str, 
+                u.name, 
+                f.template, 
+                f.finger_index,
+                (
+                    SELECT GROUP_CONCAT(up.partition_key ORDER BY up.partition_key SEPARATOR ',')
+                    FROM user_partitions up
+                    WHERE up.user_id = u.id
+                ) AS partitions -- sitios/puertas/grupos habilitados ('*' = todos)
+            FROM 
+                fingerprints f
+            JOIN 
+                users u ON f.user_id = u.id
+            WHERE
+                u.status = 1
+        " . ($user_internal_id !== null ? " AND u.id = :user_id" : "");
+        $stmt = $this->conn->prepare($query);
+        if ($user_internal_id !== null) {
+            $stmt->bindValue(":user_id", $user_internal_id, PDO::PARAM_INT);
+        }
+        $stmt->execute();
+        return $stmt->fetchAll(PDO::FETCH_ASSOC);
+    }
+
+    /**
+     * Notificar a los bridges (BRIDGE_NOTIFY_URLS) los usuarios modificados en esta
+     * solicitud, con sus plantillas vigentes y la firma resultante de la galería.
+     * Se llama después de responder al cliente; si un bridge no responde, lo
+     * detectará en su próxima verificación de firma. Sin fastcgi_finish_request
+     * (mod_php) no se llama: cada bridge demoraría la respuesta hasta
+     * BRIDGE_NOTIFY_TIMEOUT y la verificación de firma ya cubre el cambio.
+     */
+    public function notifyGalleryChanges() {
+        if (empty($this->changed_users) || BRIDGE_NOTIFY_URLS === '') {
+            return;
+        }
+
+        try {
+            $changes = [];
+            $version = $this->getVerificationVersion();
+            foreach (array_keys($this->changed_users) as $user_internal_id) {
+                $changes[] = [
+                    'user_internal_id' => $user_internal_id,
+                    'rows' => $this->verificationRows($user_internal_id),
+                    'signature' => $version['success'] ? $version['signature'] : null
+                ];
+            }
+        } catch(PDOException $e) {
+            error_log("Error preparando notificación de galería: " . $e->getMessage());
+            return;
+        }
+        $this->changed_users = [];
+
+        $headers = "Content-Type: application/json\r\n";
+        if (BRIDGE_NOTIFY_TOKEN !== '') {
+            $headers .= "X-Gallery-Token: " . BRIDGE_NOTIFY_TOKEN . "\r\n";
+        }
+        $context = stream_context_create(['http' => [
+            'method' => 'POST',
+            'header' => $headers,
+            'content' => json_encode(['changes' => $changes]),
+            'timeout' => BRIDGE_NOTIFY_TIMEOUT,
+            'ignore_errors' => true
+        ]]);
+
+        foreach (array_map('trim', explode(',', BRIDGE_NOTIFY_URLS)) as $url) {
+            if ($url !== '' && @file_get_contents($url, false, $context) === false) {
+                error_log("Bridge no notificado ($url): recargará la galería al verificar la firma");
+            }
+        }
+    }
     
-    // Obtener lista de huellas registradas (para la tabla "Usuarios" en la UI)
-    public function getRegisteredFingerprints() {
+    /**
+     * Firma del contenido actual de la galería de verificación.
+     * Permite al Bridge de Python saber si debe recargar sus plantillas
+     * sin descargar la tabla completa en cada identificación.
+     * Solo usa agregados baratos (no lee las plantillas): un alta o cambio de
+     * plantilla mueve MAX(id)/MAX(updated_at) y un borrado cambia COUNT.
+     * updated_at es DATETIME(6): dos cambios dentro del mismo segundo (p. ej.
+     * desactivar y volver a registrar un dedo) siguen dando firmas distintas.
+     * @return array
+     */
+    public function getVerificationVersion() {
         try {
             $query = "
                 SELECT 
-                    f.id, -- ID de la huella (para borrar)
-                    u.user_id,
-                    u.name,
-                    f.finger_index,
-                    f.created_at,
-                    u.status
-                FROM fingerprints f
-                JOIN users u ON f.user_id = u.id
-                ORDER BY f.created_at DESC
+                    COUNT(*) AS total,
+                    MAX(f.id) AS max_id,
+                    MAX(f.updated_at) AS fingerprints_updated,
+                    MAX(u.updated_at) AS users_updated,
+                    (
+                        SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT(up.user_id, '/', up.partition_key))), 0))
+                        FROM user_partitions up
+                    ) AS partitions_checksum
+                FROM 
+                    fingerprints f
+                JOIN 
+                    users u ON f.user_id = u.id
+                WHERE
+                    u.status = 1
             ";
             $stmt = $this->conn->prepare($query);
             $stmt->execute();
-            
-            $fingerprints = $stmt->fetchAll(PDO::FETCH_ASSOC);
-            
+            $row = $stmt->fetch(PDO::FETCH_ASSOC);
+
+            return [
+                'success' => true,
+                'signature' => md5(json_encode($row))
+            ];
+        } catch(PDOException $e) {
+            error_log("Error en getVerificationVersion: " . $e->getMessage());
+            return [
+                'success' => false,
+                'message' => 'Error de base de datos al obtener versión de verificación'
+            ];
+        }
+    }
+
+    /**
+     * Reemplaza las particiones (sitio, puerta o grupo) en las que un usuario puede
+     * identificarse. '*' lo habilita en todas; una lista vacía lo deja solo en la
+     * galería completa (identificaciones sin partición).
+     * @return array
+     */
+    public function setUserPartitions($data) {
+        if (empty($data['user_id']) || !isset($data['partitions']) || !is_array($data['partitions'])) {
+            return ['success' => false, 'message' => 'Se requieren user_id y partitions (lista)'];
+        }
+
+        $partitions = [];
+        foreach ($data['partitions'] as $key) {
+            $key = is_string($key) ? trim($key) : '';
+            if ($key === '' || strlen($key) > 64 || strpos($key, ',') !== false) {
+                return ['success' => false, 'message' => 'Partición inválida (1-64 caracteres, sin comas)'];
+            }
+            $partitions[$key] = true;
+        }
+
+        try {
+            $stmt_user = $this->conn->prepare("SELECT id FROM users WHERE user_id = :user_id_str");
+            $stmt_user->bindValue(":user_id_str", $data['user_id']);
+            $stmt_user->execute();
+            $user_internal_id = $stmt_user->fetchColumn();
+            if (!$user_internal_id) {
+                return ['success' => false, 'message' => 'Usuario no encontrado'];
+            }
+
+            $this->conn->beginTransaction();
+            $stmt_clear = $this->conn->prepare("DELETE FROM user_partitions WHERE user_id = :user_id");
+            $stmt_clear->bindValue(":user_id", $user_internal_id, PDO::PARAM_INT);
+            $stmt_clear->execute();
+
+            $stmt_insert = $this->conn->prepare("
+                INSERT INTO user_partitions (user_id, partition_key) VALUES (:user_id, :partition_key)
+            ");
+            foreach (array_keys($partitions) as $key) {
+                $stmt_insert->bindValue(":user_id", $user_internal_id, PDO::PARAM_INT);
+                $stmt_insert->bindValue(":partition_key", $key, PDO::PARAM_STR);
+                $stmt_insert->execute();
+            }
+            $this->conn->commit();
+            $this->changed_users[$user_internal_id] = true;
+
             return [
                 'success' => true,
-                'users' => $fingerprints // 'users' para compatibilidad con index.html
+                'message' => 'Particiones actualizadas',
+                'user_id' => $data['user_id'],
+                'partitions' => array_keys($partitions)
             ];
+        } catch(PDOException $e) {
+            if ($this->conn->inTransaction()) {
+                $this->conn->rollBack();
+            }
+            return ['success' => false, 'message' => 'Error de BD: ' . $e->getMessage()];
+        }
+    }
+
+    // Obtener lista de huellas registradas (para la tabla "Usuarios" en la UI), paginada por cursor
+    public function getRegisteredFingerprints($filters = [], $limit = self::PAGE_DEFAULT_LIMIT, $cursor = null) {
+        try {
+            list($users, $next_cursor) = $this->fetchFingerprintPage($filters, $this->pageLimit($limit), $cursor);
+
+            $response = [
+                'success' => true,
+                'users' => $users, // 'users' para compatibilidad con index.html
+                'next_cursor' => $next_cursor,
+                'has_more' => $next_cursor !== null
+            ];
+            if ($cursor === null || $cursor === '') {
+                // Totales solo en la primera página (la UI los muestra en las tarjetas)
+                $response['summary'] = $this->fingerprintSummary($filters);
+            }
+            return $response;
             
+        } catch(InvalidArgumentException $e) {
+            return ['success' => false, 'message' => $e->getMessage()];
         } catch(PDOException $e) {
             return ['success' => false, 'message' => 'Error al obtener usuarios: ' . $e->getMessage()];
         }
@@ -205,13 +399,25 @@ class FingerprintAPI {
     // Eliminar una huella específica
     public function deleteFingerprint($fingerprintId) {
         try {
-            // El ID que recibimos es el ID de la tabla 'fingerprints'
-            $query = "DELETE FROM fingerprints WHERE id = :id";
+            // Usuario dueño de la huella, para notificar al bridge después del borrado
+            $stmt_owner = $this->conn->prepare("SELECT user_id FROM fingerprints WHERE id = :id");
+            $stmt_owner->bindValue(":id", $fingerprintId, PDO::PARAM_INT);
+            $stmt_owner->execute();
+            $user_internal_id = $stmt_owner->fetchColumn();
+            
+            // El ID que recibimos es el ID de la tabla 'fingerprints'; se borran
+            // también las demás plantillas (slots) del mismo dedo
+            $query = "
+                DELETE f FROM fingerprints f
+                JOIN fingerprints p ON p.user_id = f.user_id AND p.finger_index = f.finger_index
+                WHERE p.id = :id
+            ";
             $stmt = $this->conn->prepare($query);
             $stmt->bindParam(":id", $fingerprintId, PDO::PARAM_INT);
             
             if ($stmt->execute()) {
                 if ($stmt->rowCount() > 0) {
+                    $this->changed_users[$user_internal_id] = true;
                     return ['success' => true, 'message' => 'Huella eliminada exitosamente'];
                 } else {
                     return ['success' => false, 'message' => 'No se encontró la huella'];
@@ -242,41 +448,362 @@ class FingerprintAPI {
         }
     }
 
-    // Obtener logs de acceso
-    public function getAccessLogs($limit = 50) {
+    /**
+     * Registrar un lote de eventos de acceso (enviado por el Bridge de Python).
+     * Un solo INSERT multi-fila en una transacción; los eventos con un event_id ya
+     * registrado se ignoran, así que reenviar un lote tras un timeout es seguro.
+     * @param array $events [{event_id, user_id, status, method, access_time}, ...]
+     * @return array
+     */
+    public function logAccessBulk($events) {
+        if (!is_array($events) || empty($events)) {
+            return ['success' => false, 'message' => 'Se requiere una lista de eventos'];
+        }
+        if (count($events) > 500) {
+            return ['success' => false, 'message' => 'Máximo 500 eventos por lote'];
+        }
+
+        $placeholders = [];
+        $values = [];
+        foreach ($events as $event) {
+            $status = isset($event['status']) ? $event['status'] : 'failed';
+            $method = isset($event['method']) ? $event['method'] : 'fingerprint';
+            $access_time = isset($event['access_time']) ? $event['access_time'] : null;
+            $event_id = isset($event['event_id']) ? $event['event_id'] : null;
+
+            if (!is_string($status) || strlen($status) > 20 || !is_string($method) || strlen($method) > 20) {
+                return ['success' => false, 'message' => 'Evento inválido: status/method'];
+            }
+            if ($access_time !== null && !preg_match('/^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$/', $access_time)) {
+                return ['success' => false, 'message' => 'Evento inválido: access_time (Y-m-d H:i:s)'];
+            }
+            if ($event_id !== null && !preg_match('/^[a-zA-Z0-9-]{1,36}$/', $event_id)) {
+                return ['success' => false, 'message' => 'Evento inválido: event_id'];
+            }
+
+            $placeholders[] = '(?, ?, COALESCE(?, NOW()), ?, ?)';
+            array_push(
+                $values,
+                $event_id,
+                isset($event['user_id']) && is_numeric($event['user_id']) ? (int)$event['user_id'] : null,
+                $access_time,
+                $status,
+                $method
+            );
+        }
+
+        try {
+            $this->conn->beginTransaction();
+            $stmt = $this->conn->prepare(
+                "INSERT IGNORE INTO access_logs (event_id, user_id, access_time, status, method) VALUES "
+                . implode(', ', $placeholders)
+            );
+            $stmt->execute($values);
+            $inserted = $stmt->rowCount();
+            $this->conn->commit();
+
+            return ['success' => true, 'received' => count($events), 'inserted' => $inserted];
+        } catch(PDOException $e) {
+            if ($this->conn->inTransaction()) {
+                $this->conn->rollBack();
+            }
+            error_log("Error en logAccessBulk: " . $e->getMessage());
+            return ['success' => false, 'message' => 'Error de BD al registrar accesos'];
+        }
+    }
+
+    // Obtener logs de acceso, paginados por cursor (access_time, id) y filtrados
+    public function getAccessLogs($filters = [], $limit = self::PAGE_DEFAULT_LIMIT, $cursor = null) {
         try {
-            $query = "
-                SELECT 
-                    al.id, 
-                    al.access_time, 
-                    al.status, 
-                    al.method,
-                    u.name, 
-                    u.user_id 
-                FROM access_logs al 
-                LEFT JOIN users u ON al.user_id = u.id 
-                ORDER BY al.access_time DESC 
-                LIMIT :limit
-            ";
+            list($logs, $next_cursor) = $this->fetchAccessLogPage($filters, $this->pageLimit($limit), $cursor);
             
-            $stmt = $this->conn->prepare($query);
-            $stmt->bindParam(":limit", $limit, PDO::PARAM_INT);
-            $stmt->execute();
-            
-            $logs = $stmt->fetchAll(PDO::FETCH_ASSOC);
-            
-            return ['success' => true, 'logs' => $logs];
+            return [
+                'success' => true,
+                'logs' => $logs,
+                'next_cursor' => $next_cursor,
+                'has_more' => $next_cursor !== null
+            ];
+        } catch(InvalidArgumentException $e) {
+            return ['success' => false, 'message' => $e->getMessage()];
         } catch(PDOException $e) {
             return ['success' => false, 'message' => 'Error: ' . $e->getMessage()];
         }
     }
 
+    // Exportar logs de acceso (CSV o NDJSON) con los mismos filtros que getAccessLogs
+    public function exportAccessLogs($filters = [], $format = 'csv') {
+        return $this->streamExport(
+            'access_logs',
+            ['id', 'access_time', 'status', 'method', 'name', 'user_id'],
+            function ($cursor) use ($filters) {
+                return $this->fetchAccessLogPage($filters, self::EXPORT_CHUNK_SIZE, $cursor);
+            },
+            $format
+        );
+    }
+
+    // Exportar la lista de huellas registradas (CSV o NDJSON)
+    public function exportRegisteredFingerprints($filters = [], $format = 'csv') {
+        return $this->streamExport(
+            'fingerprints',
+            ['id', 'user_id', 'name', 'finger_index', 'created_at', 'status'],
+            function ($cursor) use ($filters) {
+                return $this->fetchFingerprintPage($filters, self::EXPORT_CHUNK_SIZE, $cursor);
+            },
+            $format
+        );
+    }
+
+    // ==================== PAGINACIÓN POR CURSOR ====================
+
+    private function pageLimit($limit) {
+        $limit = intval($limit);
+        if ($limit <= 0) {
+            return self::PAGE_DEFAULT_LIMIT;
+        }
+        return min($limit, self::PAGE_MAX_LIMIT);
+    }
+
+    // Cursor opaco con la última fila entregada: "fecha|id" en base64 apto para URL
+    private function encodeCursor($time, $id) {
+        return rtrim(strtr(base64_encode($time . '|' . $id), '+/', '-_'), '=');
+    }
+
+    private function decodeCursor($cursor) {
+        if ($cursor === null || $cursor === '') {
+            return null;
+        }
+        $decoded = base64_decode(strtr($cursor, '-_', '+/'), true);
+        if ($decoded === false || !preg_match('/^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\|(\d+)$/', $decoded, $m)) {
+            throw new InvalidArgumentException('Cursor inválido');
+        }
+        return [$m[1], (int)$m[2]];
+    }
+
+    // Fecha de filtro: 'Y-m-d' o 'Y-m-d H:i:s' ('to' con solo fecha incluye el día completo)
+    private function parseFilterDate($value, $end_of_day = false) {
+        $value = trim($value);
+        if (preg_match('/^\d{4}-\d{2}-\d{2}$/', $value)) {
+            return $value . ($end_of_day ? ' 23:59:59' : ' 00:00:00');
+        }
+        if (preg_match('/^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2})?$/', $value)) {
+            $value = str_replace('T', ' ', $value);
+            return strlen($value) === 16 ? $value . ':00' : $value;
+        }
+        throw new InvalidArgumentException('Fecha inválida (use Y-m-d o Y-m-d H:i:s): ' . $value);
+    }
+
+    /**
+     * Página de access_logs ordenada por (access_time, id) descendente.
+     * Filtros: from, to, user_id (ID de empleado), status. Cada condición usa
+     * idx_access_time, idx_user_time o idx_status_time; el cursor continúa
+     * justo después de la última fila sin OFFSET.
+     * @return array [filas, siguiente cursor o null]
+     */
+    private function fetchAccessLogPage($filters, $limit, $cursor) {
+        $where = [];
+        $params = [];
+
+        if (!empty($filters['from'])) {
+            $where[] = 'al.access_time >= :from_time';
+            $params[':from_time'] = $this->parseFilterDate($filters['from']);
+        }
+        if (!empty($filters['to'])) {
+            $where[] = 'al.access_time <= :to_time';
+            $params[':to_time'] = $this->parseFilterDate($filters['to'], true);
+        }
+        if (!empty($filters['user_id'])) {
+            // Subconsulta escalar: el filtro queda sobre al.user_id (idx_user_time)
+            $where[] = 'al.user_id = (SELECT id FROM users WHERE user_id = :filter_user)';
+            $params[':filter_user'] = $filters['user_id'];
+        }
+        if (!empty($filters['status'])) {
+            $where[] = 'al.status = :filter_status';
+            $params[':filter_status'] = $filters['status'];
+        }
+
+        $position = $this->decodeCursor($cursor);
+        if ($position !== null) {
+            $where[] = '(al.access_time < :cursor_time OR (al.access_time = :cursor_time_eq AND al.id < :cursor_id))';
+            $params[':cursor_time'] = $position[0];
+            $params[':cursor_time_eq'] = $position[0];
+            $params[':cursor_id'] = $position[1];
+        }
+
+        $query = "
+            SELECT 
+                al.id, 
+                al.access_time, 
+                al.status, 
+                al.method,
+                u.name, 
+                u.user_id 
+            FROM access_logs al 
+            LEFT JOIN users u ON al.user_id = u.id 
+            " . ($where ? 'WHERE ' . implode(' AND ', $where) : '') . "
+            ORDER BY al.access_time DESC, al.id DESC 
+            LIMIT :limit
+        ";
+
+        return $this->fetchPage($query, $params, $limit, 'access_time');
+    }
+
+    /**
+     * Página de huellas registradas (slot 0) ordenada por (created_at, id) descendente.
+     * Filtros: q (prefijo de ID de empleado o nombre) y status (0/1).
+     * @return array [filas, siguiente cursor o null]
+     */
+    private function fetchFingerprintPage($filters, $limit, $cursor) {
+        list($where, $params) = $this->fingerprintFilters($filters);
+
+        $position = $this->decodeCursor($cursor);
+        if ($position !== null) {
+            $where[] = '(f.created_at < :cursor_time OR (f.created_at = :cursor_time_eq AND f.id < :cursor_id))';
+            $params[':cursor_time'] = $position[0];
+            $params[':cursor_time_eq'] = $position[0];
+            $params[':cursor_id'] = $position[1];
+        }
+
+        $query = "
+            SELECT 
+                f.id, -- ID de la huella (para borrar)
+                u.user_id,
+                u.name,
+                f.finger_index,
+                f.created_at,
+                u.status
+            FROM fingerprints f
+            JOIN users u ON f.user_id = u.id
+            WHERE " . implode(' AND ', $where) . "
+            ORDER BY f.created_at DESC, f.id DESC
+            LIMIT :limit
+        ";
+
+        return $this->fetchPage($query, $params, $limit, 'created_at');
+    }
+
+    private function fingerprintFilters($filters) {
+        $where = ['f.template_slot = 0']; // una fila por dedo (los slots extra son del mismo dedo)
+        $params = [];
+
+        if (isset($filters['q']) && trim($filters['q']) !== '') {
+            $prefix = addcslashes(trim($filters['q']), '%_\\') . '%';
+            $where[] = '(u.user_id LIKE :q_id OR u.name LIKE :q_name)';
+            $params[':q_id'] = $prefix;
+            $params[':q_name'] = $prefix;
+        }
+        if (isset($filters['status']) && $filters['status'] !== '') {
+            if (!in_array((string)$filters['status'], ['0', '1'], true)) {
+                throw new InvalidArgumentException('Estado inválido (0 o 1)');
+            }
+            $where[] = 'u.status = :filter_status';
+            $params[':filter_status'] = (int)$filters['status'];
+        }
+        return [$where, $params];
+    }
+
+    // Totales de la lista de huellas con los mismos filtros (sin cursor)
+    private function fingerprintSummary($filters) {
+        list($where, $params) = $this->fingerprintFilters($filters);
+        $stmt = $this->conn->prepare("
+            SELECT COUNT(*) AS total, COALESCE(SUM(u.status = 1), 0) AS active
+            FROM fingerprints f
+            JOIN users u ON f.user_id = u.id
+            WHERE " . implode(' AND ', $where)
+        );
+        $stmt->execute($params);
+        $row = $stmt->fetch(PDO::FETCH_ASSOC);
+        return ['total' => (int)$row['total'], 'active' => (int)$row['active']];
+    }
+
+    // Ejecuta la consulta pidiendo una fila extra para saber si hay otra página
+    private function fetchPage($query, $params, $limit, $time_column) {
+        $stmt = $this->conn->prepare($query);
+        foreach ($params as $name => $value) {
+            $stmt->bindValue($name, $value, is_int($value) ? PDO::PARAM_INT : PDO::PARAM_STR);
+        }
+        $stmt->bindValue(':limit', $limit + 1, PDO::PARAM_INT);
+        $stmt->execute();
+        $rows = $stmt->fetchAll(PDO::FETCH_ASSOC);
+
+        $next_cursor = null;
+        if (count($rows) > $limit) {
+            array_pop($rows);
+            $last = end($rows);
+            $next_cursor = $this->encodeCursor($last[$time_column], $last['id']);
+        }
+        return [$rows, $next_cursor];
+    }
+
+    /**
+     * Transmitir una exportación por bloques de EXPORT_CHUNK_SIZE filas.
+     * Cada bloque es una consulta corta por cursor (lectura consistente de InnoDB,
+     * sin bloqueos ni una transacción larga), y se envía al cliente antes de leer
+     * el siguiente, así que la memoria no crece con el tamaño de la tabla.
+     * @return array|null Error (antes de enviar nada) o null si ya se transmitió
+     */
+    private function streamExport($name, $columns, $fetch_page, $format) {
+        if (!in_array($format, ['csv', 'ndjson'], true)) {
+            return ['success' => false, 'message' => 'Formato inválido (csv o ndjson)'];
+        }
+
+        // El primer bloque se lee antes de enviar encabezados: filtros inválidos siguen respondiendo JSON
+        try {
+            list($rows, $cursor) = $fetch_page(null);
+        } catch(InvalidArgumentException $e) {
+            return ['success' => false, 'message' => $e->getMessage()];
+        } catch(PDOException $e) {
+            return ['success' => false, 'message' => 'Error al exportar: ' . $e->getMessage()];
+        }
+
+        set_time_limit(0);
+        $filename = $name . '_' . date('Ymd_His') . '.' . $format;
+        header('Content-Type: ' . ($format === 'csv' ? 'text/csv' : 'application/x-ndjson') . '; charset=UTF-8');
+        header('Content-Disposition: attachment; filename="' . $filename . '"');
+        header('X-Accel-Buffering: no'); // Nginx: no acumular la respuesta
+        while (ob_get_level() > 0) {
+            ob_end_flush();
+        }
+
+        $out = fopen('php://output', 'w');
+        if ($format === 'csv') {
+            fputcsv($out, $columns);
+        }
+
+        try {
+            while (true) {
+                foreach ($rows as $row) {
+                    if ($format === 'csv') {
+                        fputcsv($out, array_map(function ($column) use ($row) {
+                            return $row[$column];
+                        }, $columns));
+                    } else {
+                        fwrite($out, json_encode($row, JSON_UNESCAPED_UNICODE) . "\n");
+                    }
+                }
+                flush();
+
+                if ($cursor === null) {
+                    break;
+                }
+                list($rows, $cursor) = $fetch_page($cursor);
+            }
+        } catch(PDOException $e) {
+            // Los encabezados ya se enviaron: solo queda registrar el corte
+            error_log("Error exportando $name: " . $e->getMessage());
+        }
+
+        fclose($out);
+        return null;
+    }
+
 } // CIERRE de FingerprintAPI
 
 // api.php - Reemplazar completamente el bloque de "Manejo de rutas API"
 
 // Manejo de rutas API (ACTUALIZADO, CORREGIDO Y SEGURO)
 $api = new FingerprintAPI();
+header('Server-Timing: db-connect;dur=' . Database::$connect_ms); // Costo de conexión (persistente o nueva)
 $method = $_SERVER['REQUEST_METHOD'];
 $request = isset($_GET['action']) ? $_GET['action'] : '';
 $response = ['success' => false, 'message' => 'Acción no válida'];
@@ -300,6 +827,13 @@ try {
                     $api->logAccess($userId, $status, $method_log);
                     $response = ['success' => true]; // Log no necesita respuesta detallada
                     break;
+                case 'log_access_bulk':
+                    // RUTA DEL BRIDGE DE PYTHON: bitácora de accesos en lote
+                    $response = $api->logAccessBulk(isset($data['events']) ? $data['events'] : null);
+                    break;
+                case 'set_partitions':
+                    $response = $api->setUserPartitions($data);
+                    break;
                 default:
                     $response = ['success' => false, 'message' => 'Acción POST no válida'];
                     http_response_code(404);
@@ -310,18 +844,35 @@ try {
         case 'GET':
             switch ($request) {
                 case 'users':
-                    // Esto obtiene la lista de huellas para la UI (seguro)
-                    $response = $api->getRegisteredFingerprints();
+                    // Esto obtiene la lista de huellas para la UI (seguro), por páginas
+                    $limit = isset($_GET['limit']) ? intval($_GET['limit']) : FingerprintAPI::PAGE_DEFAULT_LIMIT;
+                    $cursor = isset($_GET['cursor']) ? $_GET['cursor'] : null;
+                    $response = $api->getRegisteredFingerprints($_GET, $limit, $cursor);
                     break;
                 case 'logs':
-                    $limit = isset($_GET['limit']) ? intval($_GET['limit']) : 50;
-                    $response = $api->getAccessLogs($limit);
+                    // Filtros opcionales: from, to, user_id, status
+                    $limit = isset($_GET['limit']) ? intval($_GET['limit']) : FingerprintAPI::PAGE_DEFAULT_LIMIT;
+                    $cursor = isset($_GET['cursor']) ? $_GET['cursor'] : null;
+                    $response = $api->getAccessLogs($_GET, $limit, $cursor);
+                    break;
+                case 'export_logs':
+                case 'export_users':
+                    $format = isset($_GET['format']) ? $_GET['format'] : 'csv';
+                    $response = $request === 'export_logs'
+                        ? $api->exportAccessLogs($_GET, $format)
+                        : $api->exportRegisteredFingerprints($_GET, $format);
+                    if ($response === null) {
+                        exit(); // El archivo ya se transmitió
+                    }
                     break;
                 
                 // RUTA SEGURA - SOLO PARA EL BRIDGE DE PYTHON
                 case 'get_verification_data':
                     $response = $api->getAllVerificationData();
                     break;
+                case 'get_verification_version':
+                    $response = $api->getVerificationVersion();
+                    break;
 
                 default:
                     $response = ['success' => false, 'message' => 'Acción GET no válida'];
@@ -360,6 +911,13 @@ if (isset($response['success']) && !$response['success'] && http_response_code()
 
 echo json_encode($response);
 
+// Entregar la respuesta y luego avisar los cambios de galería a los bridges. Solo con PHP-FPM:
+// con mod_php el cliente seguiría esperando a cada bridge
+if (function_exists('fastcgi_finish_request')) {
+    fastcgi_finish_request();
+    $api->notifyGalleryChanges();
+}
+
 // database.sql - Script SQL para crear la base de datos
 /*
 CREATE DATABASE IF NOT EXISTS fingerprint_db;
@@ -371,7 +929,7 @@ CREATE TABLE IF NOT EXISTS users (
     user_id VARCHAR(50) UNIQUE NOT NULL, -- ID del empleado (ej: "EMP001")
     name VARCHAR(100) NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    updated_at DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6), -- microsegundos: firma de la galería
     status TINYINT(1) DEFAULT 1,
     INDEX idx_user_id (user_id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -381,22 +939,35 @@ CREATE TABLE IF NOT EXISTS fingerprints (
     id INT AUTO_INCREMENT PRIMARY KEY,
     user_id INT NOT NULL, -- FK a la tabla users
     finger_index INT NOT NULL, -- 1-10 (Índice Derecho, Pulgar Izq, etc.)
+    template_slot TINYINT NOT NULL DEFAULT 0, -- 0 = plantilla principal, 1..N = plantillas adicionales del dedo
     template TEXT NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    updated_at DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6), -- microsegundos: firma de la galería
     
     -- Clave foránea
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
     
-    -- Evitar duplicados: un usuario solo puede tener una huella por dedo
-    UNIQUE KEY uk_user_finger (user_id, finger_index),
+    -- Evitar duplicados: un usuario solo puede tener una plantilla por dedo y slot
+    UNIQUE KEY uk_user_finger_slot (user_id, finger_index, template_slot),
     
     INDEX idx_user_id (user_id)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- Particiones de acceso (sitio, puerta o grupo) de cada usuario para la búsqueda 1:N
+-- ('*' = habilitado en todas las particiones)
+CREATE TABLE IF NOT EXISTS user_partitions (
+    user_id INT NOT NULL, -- FK a la tabla users
+    partition_key VARCHAR(64) NOT NULL, -- ej: "planta-norte", "puerta-3", "mantenimiento"
+    
+    PRIMARY KEY (user_id, partition_key),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    INDEX idx_partition_key (partition_key)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 -- Tabla de logs (sin cambios, pero actualizada la FK)
 CREATE TABLE IF NOT EXISTS access_logs (
     id INT AUTO_INCREMENT PRIMARY KEY,
+    event_id VARCHAR(36) NULL, -- ID del evento generado por el bridge (reenvíos idempotentes)
     user_id INT, -- FK a la tabla users (puede ser NULL si falla)
     access_time DATETIME NOT NULL,
     status VARCHAR(20) NOT NULL,
@@ -405,10 +976,19 @@ CREATE TABLE IF NOT EXISTS access_logs (
     -- Actualizado ON DELETE SET NULL para no perder logs si se borra el usuario
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
     
+    UNIQUE KEY uk_event_id (event_id),
     INDEX idx_access_time (access_time),
-    INDEX idx_user_id (user_id)
+    INDEX idx_user_id (user_id),
+    
+    -- Paginación por cursor (access_time, id) filtrando por usuario o estado
+    INDEX idx_user_time (user_id, access_time),
+    INDEX idx_status_time (status, access_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- Listado paginado de huellas (slot 0 ordenado por fecha de registro)
+ALTER TABLE fingerprints 
+ADD INDEX idx_slot_created (template_slot, created_at);
+
 -- Índice compuesto para optimizar verificación 1:N
 ALTER TABLE fingerprints 
 ADD INDEX idx_user_template (user_id, finger_index);
@@ -416,5 +996,27 @@ ADD INDEX idx_user_template (user_id, finger_index);
 -- Índice para búsquedas por estado de usuario
 ALTER TABLE users 
 ADD INDEX idx_status (status);
+
+-- Migración de bases existentes: varias plantillas por dedo
+ALTER TABLE fingerprints
+ADD COLUMN template_slot TINYINT NOT NULL DEFAULT 0 AFTER finger_index,
+ADD UNIQUE KEY uk_user_finger_slot (user_id, finger_index, template_slot),
+DROP INDEX uk_user_finger;
+
+-- Migración de bases existentes: bitácora de accesos en lote desde el bridge
+ALTER TABLE access_logs
+ADD COLUMN event_id VARCHAR(36) NULL AFTER id,
+ADD UNIQUE KEY uk_event_id (event_id);
+
+-- Migración de bases existentes: listados paginados y filtrados de logs
+ALTER TABLE access_logs
+ADD INDEX idx_user_time (user_id, access_time),
+ADD INDEX idx_status_time (status, access_time);
+
+-- Migración de bases existentes: updated_at con microsegundos (firma de la galería)
+ALTER TABLE users
+MODIFY updated_at DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);
+ALTER TABLE fingerprints
+MODIFY updated_at DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6);
 */
 ?>
\ No newline at end of file
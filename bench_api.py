@@ -0,0 +1,107 @@
+"""
+Prueba de carga de api.php para ZKTeco Bridge Service
+Mide la latencia de las rutas frecuentes (la descarga de la galería del bridge,
+la firma de versión y el registro de accesos de los kioscos) con varios
+clientes simultáneos, y el costo de conexión a MySQL que api.php reporta en
+el encabezado Server-Timing (db-connect).
+
+Para medir la ganancia de las conexiones persistentes, ejecutar dos veces con
+el servidor web configurado con DB_PERSISTENT=false y luego con DB_PERSISTENT=true:
+
+    python bench_api.py --concurrency 16 --requests 2000
+    python bench_api.py --actions get_verification_data --concurrency 4
+
+`log_access` inserta filas reales en access_logs (method='benchmark').
+"""
+
+import argparse
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+API_URL = "http://localhost/fingerprint/api.php"
+ACTIONS = ('get_verification_version', 'get_verification_data', 'log_access')
+
+
+def print_header(text):
+    print("\n" + "=" * 60)
+    print(f"  {text}")
+    print("=" * 60)
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Percentiles por rango más cercano"""
+    values = sorted(values)
+    if not values:
+        return {p: None for p in points}
+    return {p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] for p in points}
+
+
+def call(session, base_url, action):
+    """Una solicitud; devuelve (ms totales, ms de conexión a la BD o None, éxito)"""
+    start = time.perf_counter()
+    if action == 'log_access':
+        response = session.post(f"{base_url}?action=log_access",
+                                json={'user_id': None, 'status': 'failed', 'method': 'benchmark'}, timeout=30)
+    else:
+        response = session.get(f"{base_url}?action={action}", timeout=30)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    match = re.search(r'db-connect;dur=([\d.]+)', response.headers.get('Server-Timing', ''))
+    return elapsed, float(match.group(1)) if match else None, response.ok
+
+
+def run(base_url, action, concurrency, total):
+    local = threading.local()
+
+    def worker(_):
+        # Una sesión HTTP por hilo (keep-alive): se mide el costo de PHP y MySQL, no el de TCP
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            return call(local.session, base_url, action)
+        except requests.RequestException:
+            return None, None, False
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(worker, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies = [r[0] for r in results if r[0] is not None]
+    connects = [r[1] for r in results if r[1] is not None]
+    errors = sum(1 for r in results if not r[2])
+    return latencies, connects, errors, wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latencia de api.php bajo carga concurrente')
+    parser.add_argument('--url', default=API_URL, help='URL de api.php')
+    parser.add_argument('--actions', nargs='+', choices=ACTIONS, default=list(ACTIONS), help='Rutas a medir')
+    parser.add_argument('--concurrency', type=int, default=8, help='Clientes simultáneos')
+    parser.add_argument('--requests', type=int, default=500, help='Solicitudes por ruta')
+    args = parser.parse_args()
+
+    print_header(f"CARGA: {args.concurrency} clientes, {args.requests} solicitudes por ruta")
+    print(f"   {'':<26}{'req/s':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'conexión p50':>15}{'errores':>9}")
+
+    failed = False
+    for action in args.actions:
+        latencies, connects, errors, wall = run(args.url, action, args.concurrency, args.requests)
+        p = percentiles(latencies)
+        c = percentiles(connects)[50]
+        cells = ''.join(f"{'-' if p[k] is None else round(p[k], 1):>9}" for k in (50, 90, 99))
+        print(f"   {action:<26}{len(latencies) / wall:>8.1f}{cells}"
+              f"{'-' if c is None else round(c, 2):>15}{errors:>9}")
+        failed = failed or errors > 0
+
+    print("\n   Latencias en ms. 'conexión' es el tiempo de new PDO() reportado por api.php.")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,597 @@
+"""
+ZKTeco USB Bridge Service - Capa API asyncio
+Front-end asyncio (aiohttp) para las mismas rutas de bridge_service.py.
+
+- Las llamadas al SDK/dispositivo se despachan a un executor dedicado.
+- La E/S hacia la API PHP se espera (await) con aiohttp.
+- /api/capture/stream publica las capturas como Server-Sent Events, de modo que
+  cientos de kioscos suscritos cuestan una corrutina cada uno, no un hilo.
+
+Uso:
+    python bridge_async.py
+"""
+
+import asyncio
+import base64
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+import bridge_service
+from bridge_service import (
+    device, bootstrap, profiler, logger, env_int, env_float, gallery_change_allowed, debug_admin_allowed, parse_gallery_changes,
+    replay_status, InstrumentedSDK, PROFILE_INTERVAL,
+    HOST, PORT, ENABLE_CORS, CORS_ORIGINS, PHP_API_URL, PHP_API_TIMEOUT, AUTO_START, HEALTH_MAX_AGE
+)
+
+# ==================== CONFIGURACIÓN ====================
+ASYNC_DEVICE_WORKERS = env_int('ASYNC_DEVICE_WORKERS', 4) # Hilos del executor de dispositivo/SDK
+STREAM_QUEUE_SIZE = env_int('STREAM_QUEUE_SIZE', 8) # Eventos pendientes por suscriptor (se descartan los más viejos)
+STREAM_KEEPALIVE = env_float('STREAM_KEEPALIVE', 15) # Segundos entre comentarios keep-alive SSE
+
+device_executor = ThreadPoolExecutor(max_workers=ASYNC_DEVICE_WORKERS, thread_name_prefix='zk-device')
+
+
+async def run_device(func, *args):
+    """Ejecutar una llamada bloqueante del dispositivo/SDK en el executor dedicado"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(device_executor, func, *args)
+
+
+async def read_json(request):
+    """Leer el cuerpo JSON de la solicitud (None si no es JSON válido)"""
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+def query_int(request, name):
+    """Parámetro entero de la query string (None si falta o no es válido)"""
+    try:
+        return int(request.query[name]) if name in request.query else None
+    except ValueError:
+        return None
+
+
+# ==================== PUSH DE CAPTURAS ====================
+class CaptureHub:
+    """Distribuye las capturas del hilo de captura a las colas asyncio de los suscriptores"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.subscribers = set()
+
+    def publish_threadsafe(self, capture):
+        """Callback registrado en el dispositivo (se ejecuta en el hilo de captura)"""
+        self.loop.call_soon_threadsafe(self._dispatch, capture)
+
+    def _dispatch(self, capture):
+        for queue in self.subscribers:
+            if queue.full():
+                # Suscriptor lento: descartar el evento más viejo
+                queue.get_nowait()
+            queue.put_nowait(capture)
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+def capture_event(capture, include_image):
+    """Serializar una captura como evento SSE"""
+    payload = capture if include_image else {k: v for k, v in capture.items() if k != 'image'}
+    return f"event: capture\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+
+
+# ==================== E/S HACIA LA API PHP ====================
+async def php_get(session, action):
+    """GET a la API PHP; lanza excepción si la respuesta no es exitosa"""
+    async with session.get(PHP_API_URL, params={'action': action}) as response:
+        response.raise_for_status()
+        data = await response.json(content_type=None)
+    if not data.get('success'):
+        raise RuntimeError(data.get('message', f'Error en acción {action}'))
+    return data
+
+
+async def refresh_gallery(app):
+    """Verificar/recargar la galería residente esperando la E/S de PHP en el loop"""
+    gallery = device.gallery
+    if not gallery.needs_check():
+        return
+
+    async with app['gallery_lock']:
+        if not gallery.needs_check():
+            return
+        session = app['php_session']
+        signature = (await php_get(session, 'get_verification_version')).get('signature')
+        rows = None
+        if not gallery.is_current(signature):
+            logger.info("Obteniendo plantillas registradas desde API PHP (asyncio)...")
+            rows = (await php_get(session, 'get_verification_data')).get('data', [])
+        # La decodificación de plantillas es CPU: fuera del loop
+        await run_device(gallery.apply, signature, rows)
+
+
+# ==================== RUTAS DE LA API ====================
+routes = web.RouteTableDef()
+
+@routes.get('/api/health')
+async def health_check(request):
+    """Health check del servicio (responde desde el arranque; `ready` indica si el dispositivo está listo)"""
+    return web.json_response({
+        'success': True,
+        'message': 'ZKTeco Bridge Service Running',
+        'version': '4.0.0',
+        'timestamp': datetime.now().isoformat(),
+        'sdk_available': bridge_service.SDK_AVAILABLE,
+        'ready': bootstrap.ready,
+        'bootstrap': bootstrap.get_status(),
+        'server': 'asyncio'
+    })
+
+@routes.get('/api/health/ready')
+async def readiness_check(request):
+    """Readiness para monitores/balanceadores: 503 hasta que el dispositivo esté abierto"""
+    status = bootstrap.get_status()
+    return web.json_response({'success': status['ready'], **status}, status=200 if status['ready'] else 503)
+
+@routes.post('/api/device/initialize')
+async def initialize_device(request):
+    """Inicializar dispositivo"""
+    logger.info("Solicitud: Inicializar dispositivo")
+    return web.json_response(await run_device(device.initialize))
+
+@routes.post('/api/device/open')
+async def open_device(request):
+    """Abrir dispositivo"""
+    data = await read_json(request) or {}
+    index = data.get('index', 0)
+
+    logger.info(f"Solicitud: Abrir dispositivo (índice: {index})")
+    result = await run_device(device.open_device, index)
+
+    if result.get('success'):
+        await run_device(device.start_capture)
+
+    return web.json_response(result)
+
+@routes.post('/api/device/close')
+async def close_device(request):
+    """Cerrar dispositivo"""
+    logger.info("Solicitud: Cerrar dispositivo")
+    return web.json_response(await run_device(device.close_device))
+
+@routes.get('/api/device/status')
+async def device_status(request):
+    """Obtener estado del dispositivo"""
+    return web.json_response(device.get_status())
+
+@routes.get('/api/device/verify_connection')
+async def verify_connection(request):
+    """Verificar estado de conexión del dispositivo (desde la salud cacheada; ?max_age= en segundos)"""
+    try:
+        max_age = float(request.query.get('max_age', HEALTH_MAX_AGE))
+    except ValueError:
+        max_age = HEALTH_MAX_AGE
+    if device.health.is_fresh(max_age):
+        health = device.health.check(max_age) # Sin E/S del SDK: se responde en el loop
+    else:
+        health = await run_device(device.health.check, max_age)
+    is_connected = health['connected']
+
+    return web.json_response({
+        'success': bool(is_connected),
+        'connected': is_connected, # None: otro sondeo en curso y aún sin estado conocido
+        'message': 'Dispositivo conectado y respondiendo' if is_connected
+                   else 'Verificando el dispositivo' if is_connected is None
+                   else 'Dispositivo desconectado o no responde',
+        'health': health
+    })
+
+@routes.post('/api/capture/start')
+async def start_capture(request):
+    """Iniciar captura"""
+    logger.info("Solicitud: Iniciar captura")
+    return web.json_response(await run_device(device.start_capture))
+
+@routes.post('/api/capture/stop')
+async def stop_capture(request):
+    """Detener captura"""
+    logger.info("Solicitud: Detener captura")
+    return web.json_response(await run_device(device.stop_capture))
+
+@routes.get('/api/capture/get')
+async def get_capture(request):
+    """Obtener última captura (?since=<version>&include_image=0&session=<id> opcionales)"""
+    since = query_int(request, 'since')
+    include_image = request.query.get('include_image', '1').lower() not in ('0', 'false', 'no')
+    # Toma _registration_lock (puede esperar al hilo de captura): fuera del loop
+    return web.json_response(
+        await run_device(device.get_last_capture, since, include_image, request.query.get('session'))
+    )
+
+@routes.get('/api/capture/history')
+async def capture_history(request):
+    """Metadatos de las capturas recientes"""
+    return web.json_response({'success': True, 'frames': device.get_capture_history()})
+
+@routes.get('/api/capture/stream')
+async def capture_stream(request):
+    """Stream SSE de capturas (?include_image=1 para incluir la imagen, ?session=<id> para una sesión de registro)"""
+    include_image = request.query.get('include_image', '0').lower() in ('1', 'true', 'yes')
+    session_id = request.query.get('session')
+    hub = request.app['capture_hub']
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Los headers CORS deben ir antes de prepare(): el middleware ya no puede modificarlos
+    response.headers.update(cors_headers(request))
+    await response.prepare(request)
+
+    queue = hub.subscribe()
+    try:
+        await response.write(f"event: status\ndata: {json.dumps(device.get_status())}\n\n".encode('utf-8'))
+        while True:
+            try:
+                capture = await asyncio.wait_for(queue.get(), timeout=STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+            if session_id is not None and capture.get('session_id') != session_id:
+                # Captura de otra sesión (u otro modo): no es de este operador
+                continue
+            await response.write(capture_event(capture, include_image))
+    except ConnectionResetError:
+        # El cliente cerró la conexión
+        pass
+    finally:
+        hub.unsubscribe(queue)
+
+    return response
+
+@routes.post('/api/mode/set')
+async def set_mode(request):
+    """Establecer modo (idle, registering, verifying)"""
+    data = await read_json(request)
+
+    if not data or 'mode' not in data:
+        return web.json_response({
+            'success': False,
+            'message': 'Parámetro "mode" requerido'
+        }, status=400)
+
+    mode = data.get('mode', 'idle')
+    logger.info(f"Solicitud: Cambiar modo a '{mode}'")
+    return web.json_response(
+        await run_device(
+            device.set_mode, mode, data.get('auto_identify', False),
+            data.get('label'), data.get('samples'), data.get('store_templates')
+        )
+    )
+
+@routes.get('/api/enrollment')
+async def list_enrollments(request):
+    """Sesiones de registro abiertas (activa y en cola)"""
+    return web.json_response(await run_device(device.list_enrollments))
+
+@routes.post('/api/enrollment/open')
+async def open_enrollment(request):
+    """Abrir una sesión de registro (queda en cola si el sensor está ocupado)"""
+    data = await read_json(request) or {}
+    logger.info(f"Solicitud: Abrir sesión de registro ({data.get('label') or 'sin etiqueta'})")
+    result = await run_device(device.open_enrollment, data.get('label'), data.get('samples'), data.get('store_templates'))
+    if result.get('success'):
+        return web.json_response(result)
+    return web.json_response(result, status=429 if result.get('busy') else 400)
+
+@routes.get('/api/enrollment/{session_id}')
+async def get_enrollment(request):
+    """Estado de una sesión de registro (?since=<version> opcional)"""
+    result = await run_device(device.get_enrollment, request.match_info['session_id'], query_int(request, 'since'))
+    return web.json_response(result, status=200 if result.get('success') else 404)
+
+@routes.post('/api/enrollment/{session_id}/cancel')
+async def cancel_enrollment(request):
+    """Cerrar una sesión de registro sin afectar a las demás"""
+    session_id = request.match_info['session_id']
+    logger.info(f"Solicitud: Cerrar sesión de registro {session_id}")
+    result = await run_device(device.reset_registration, session_id)
+    return web.json_response(result, status=200 if result.get('success') else 404)
+
+@routes.post('/api/compare')
+async def compare_templates(request):
+    """Comparar dos plantillas de huellas"""
+    data = await read_json(request)
+
+    if not data:
+        return web.json_response({
+            'success': False,
+            'message': 'Datos no proporcionados'
+        }, status=400)
+
+    template1 = data.get('template1')
+    template2 = data.get('template2')
+
+    if not template1 or not template2:
+        return web.json_response({
+            'success': False,
+            'message': 'Se requieren template1 y template2'
+        }, status=400)
+
+    logger.info("Solicitud: Comparar plantillas")
+    return web.json_response(await run_device(
+        device.compare_templates, template1, template2,
+        data.get('user_id'), data.get('finger_index'), data.get('site')
+    ))
+
+@routes.post('/api/db/match_one_to_many')
+async def match_one_to_many_api(request):
+    """Identificación 1:N: E/S de PHP en el loop, matching en el executor del SDK"""
+    data = await read_json(request) or {}
+    captured_template_b64 = data.get('captured_template')
+
+    if not captured_template_b64:
+        return web.json_response({'success': False, 'message': 'Plantilla de huella capturada faltante.'}, status=400)
+
+    try:
+        template_bytes = base64.b64decode(captured_template_b64)
+    except Exception as e:
+        logger.error(f"Error al decodificar plantilla capturada: {e}")
+        return web.json_response({'success': False, 'message': 'Plantilla de huella capturada inválida.'}, status=400)
+
+    # Un reintento ya calculado se responde sin esperar la verificación de la firma en PHP
+    cached = device.cached_identification(template_bytes, data.get('site'), data.get('partition'))
+    if cached is not None:
+        return web.json_response(cached)
+
+    try:
+        await refresh_gallery(request.app)
+    except (ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Error de conexión con API PHP: {e}")
+        return web.json_response({'success': False, 'message': f'Error de conexión con el servicio API PHP: {e}'}, status=500)
+    except Exception as e:
+        logger.error(f"Error al obtener datos de verificación desde API: {e}")
+        return web.json_response({'success': False, 'message': 'Error al cargar datos de verificación de la BD.'}, status=500)
+
+    try:
+        result = await run_device(device.identify_template, template_bytes, data.get('site'), data.get('partition'))
+    except Exception as e:
+        logger.error(f"Error crítico en match_one_to_many_api: {e}")
+        return web.json_response({'success': False, 'message': 'Error interno durante el matching.'}, status=500)
+
+    if result.get('success'):
+        return web.json_response(result)
+    return web.json_response(result, status=503 if result.get('busy') else 500)
+
+@routes.get('/api/debug/last_capture')
+async def debug_last_capture(request):
+    """Endpoint para inspeccionar el estado actual de last_capture"""
+    return web.json_response(device.get_last_capture_debug())
+
+@routes.get('/api/debug/registration_status')
+async def debug_registration_status(request):
+    """Endpoint de debugging para estado de registro"""
+    return web.json_response({'success': True, 'status': await run_device(device.get_registration_status)})
+
+@routes.get('/api/debug/thread_status')
+async def debug_thread_status(request):
+    """Endpoint de debugging para estado de threads"""
+    return web.json_response({'success': True, 'status': device.get_thread_status()})
+
+@routes.post('/api/gallery/changes')
+async def gallery_changes(request):
+    """Cambios puntuales de la galería notificados por api.php (registro, borrado, particiones)"""
+    if not gallery_change_allowed(request.remote, request.headers.get('X-Gallery-Token')):
+        return web.json_response({'success': False, 'message': 'Notificación no autorizada'}, status=403)
+
+    changes = parse_gallery_changes(await read_json(request))
+    if changes is None:
+        return web.json_response(
+            {'success': False, 'message': 'Se requiere {"changes": [{"user_internal_id", "rows", "signature"}]}'},
+            status=400
+        )
+
+    # La decodificación de plantillas es CPU: fuera del loop
+    applied = 0
+    for change in changes:
+        applied += bool(await run_device(device.gallery.apply_change, change))
+    return web.json_response({'success': True, 'applied': applied, 'version': device.gallery.version})
+
+@routes.get('/api/debug/match_cache')
+async def debug_match_cache(request):
+    """Endpoint de debugging para la galería residente y la cache de resultados 1:N"""
+    return web.json_response({
+        'success': True,
+        'gallery': device.gallery.get_status(),
+        'cache': device.match_cache.get_status(),
+        'prefilter': device.prefilter.get_status()
+    })
+
+@routes.get('/api/debug/capture_recorder')
+async def debug_capture_recorder(request):
+    """Estado de la grabación de capturas y, si el lector es una grabación, del replay"""
+    return web.json_response({
+        'success': True,
+        'recorder': device.capture_recorder.get_status(),
+        'replay': replay_status()
+    })
+
+@routes.get('/api/debug/sdk_calls')
+@routes.post('/api/debug/sdk_calls')
+async def debug_sdk_calls(request):
+    """Conteos, histogramas de latencia y códigos de retorno por función del SDK.
+
+    POST {"enabled": true|false, "reset": true} activa/desactiva la medición o reinicia los conteos.
+    """
+    if not debug_admin_allowed(request.remote, request.headers.get('X-Admin-Token')):
+        return web.json_response({'success': False, 'message': 'No autorizado'}, status=403)
+    zkfp = bridge_service.zkfp
+    if not isinstance(zkfp, InstrumentedSDK):
+        return web.json_response({'success': False, 'message': 'SDK no cargado'}, status=503)
+    if request.method == 'POST':
+        data = await read_json(request) or {}
+        if data.get('reset'):
+            zkfp.reset()
+        if 'enabled' in data:
+            zkfp.set_enabled(data['enabled'])
+    return web.json_response({'success': True, 'sdk_calls': zkfp.get_status()})
+
+@routes.get('/api/debug/profile')
+async def get_profile(request):
+    """Último perfil de muestreo"""
+    if not debug_admin_allowed(request.remote, request.headers.get('X-Admin-Token')):
+        return web.json_response({'success': False, 'message': 'No autorizado'}, status=403)
+    return web.json_response({'success': True, 'running': profiler.running, 'profile': profiler.last})
+
+@routes.post('/api/debug/profile')
+async def run_profile(request):
+    """Perfil de muestreo de los hilos (POST {"seconds", "interval_ms", "threads": ["capture", ...]})"""
+    if not debug_admin_allowed(request.remote, request.headers.get('X-Admin-Token')):
+        return web.json_response({'success': False, 'message': 'No autorizado'}, status=403)
+    data = await read_json(request) or {}
+    try:
+        seconds = float(data.get('seconds', 5))
+        interval = float(data.get('interval_ms', PROFILE_INTERVAL * 1000)) / 1000.0
+    except (TypeError, ValueError):
+        return web.json_response({'success': False, 'message': 'seconds e interval_ms deben ser números'}, status=400)
+    threads = data.get('threads')
+    if isinstance(threads, str):
+        threads = [threads]
+    # Un solo perfil a la vez: no ocupar otro hilo del executor esperando
+    if profiler.running:
+        return web.json_response({'success': False, 'message': 'Ya hay un perfil en curso'}, status=409)
+
+    logger.info(f"Solicitud: Perfil de muestreo ({seconds}s, hilos: {threads or 'todos'})")
+    # El muestreo duerme entre muestras: executor por defecto, sin ocupar los hilos del SDK
+    loop = asyncio.get_running_loop()
+    profile = await loop.run_in_executor(None, profiler.run, seconds, interval, threads)
+    if profile is None:
+        return web.json_response({'success': False, 'message': 'Ya hay un perfil en curso'}, status=409)
+    return web.json_response({'success': True, 'profile': profile})
+
+@routes.get('/api/debug/access_log')
+async def debug_access_log(request):
+    """Estado de la bitácora de accesos en lote"""
+    return web.json_response({'success': True, 'access_log': device.access_log.get_status()})
+
+@routes.get('/api/debug/score_recorder')
+async def debug_score_recorder(request):
+    """Estado del muestreo de distribuciones de scores 1:N"""
+    return web.json_response({'success': True, 'recorder': device.score_recorder.get_status()})
+
+@routes.get('/api/policy/thresholds')
+async def get_threshold_policy(request):
+    """Política de umbrales vigente"""
+    return web.json_response({'success': True, 'policy': device.threshold_policy.get_status()})
+
+@routes.post('/api/policy/thresholds/reload')
+async def reload_threshold_policy(request):
+    """Recargar la política de umbrales desde THRESHOLD_POLICY_FILE"""
+    logger.info("Solicitud: Recargar política de umbrales")
+    try:
+        policy = await run_device(device.threshold_policy.load)
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f"Política de umbrales inválida: {e}")
+        return web.json_response({'success': False, 'message': f'Política de umbrales inválida: {e}'}, status=400)
+    return web.json_response({'success': True, 'policy': policy})
+
+@routes.post('/api/registration/reset')
+async def reset_registration(request):
+    """Resetear estado de registro ({"session_id": ...} opcional)"""
+    data = await read_json(request) or {}
+    logger.info("Solicitud: Resetear registro")
+    return web.json_response(await run_device(device.reset_registration, data.get('session_id')))
+
+
+# ==================== MIDDLEWARES ====================
+def cors_headers(request):
+    """Headers CORS equivalentes a flask-cors con ENABLE_CORS/CORS_ORIGINS"""
+    origin = request.headers.get('Origin')
+    if not ENABLE_CORS or not origin or ('*' not in CORS_ORIGINS and origin not in CORS_ORIGINS):
+        return {}
+    return {
+        'Access-Control-Allow-Origin': '*' if '*' in CORS_ORIGINS else origin,
+        'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type'
+    }
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+
+    if not response.prepared:
+        response.headers.update(cors_headers(request))
+    return response
+
+@web.middleware
+async def error_middleware(request, handler):
+    """Respuestas JSON para 404/500, como los errorhandler de Flask"""
+    try:
+        return await handler(request)
+    except web.HTTPNotFound as error:
+        return web.json_response({
+            'success': False,
+            'message': 'Endpoint no encontrado',
+            'error': str(error)
+        }, status=404)
+    except web.HTTPException:
+        raise
+    except Exception as error:
+        logger.error(f"Error interno del servidor: {error}")
+        return web.json_response({
+            'success': False,
+            'message': 'Error interno del servidor',
+            'error': str(error)
+        }, status=500)
+
+
+# ==================== CICLO DE VIDA ====================
+async def on_startup(app):
+    app['php_session'] = ClientSession(timeout=ClientTimeout(total=PHP_API_TIMEOUT))
+    app['gallery_lock'] = asyncio.Lock()
+    app['capture_hub'] = CaptureHub(asyncio.get_running_loop())
+    device.add_capture_listener(app['capture_hub'].publish_threadsafe)
+    if AUTO_START:
+        bootstrap.start()
+
+async def on_cleanup(app):
+    bootstrap.stop()
+    await run_device(device.access_log.flush)
+    device.remove_capture_listener(app['capture_hub'].publish_threadsafe)
+    await app['php_session'].close()
+    await run_device(device.close_device)
+    device_executor.shutdown(wait=False)
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware, error_middleware])
+    app.add_routes(routes)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    print("=" * 60)
+    print("ZKTeco USB Bridge Service v4.0.0 - Capa asyncio")
+    print("=" * 60)
+    print(f"Arranque automático: {'Sí (SDK y dispositivo en segundo plano, ver /api/health)' if AUTO_START else 'No'}")
+    print(f"Iniciando servicio en http://{HOST}:{PORT}")
+    print(f"Executor de dispositivo: {ASYNC_DEVICE_WORKERS} hilos")
+    print("Stream de capturas: GET /api/capture/stream (Server-Sent Events)")
+    print("\nPresione Ctrl+C para detener el servicio\n")
+
+    web.run_app(create_app(), host=HOST, port=PORT, print=None)
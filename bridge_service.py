@@ -11,11 +11,88 @@ import time
 import base64
 import json
 import logging
+import logging.handlers
 import sys
 import os
+import hashlib
+import hmac
+import itertools
+import uuid
+import heapq
+import bisect
+import queue
+import random
+import struct
+import zlib
+from collections import OrderedDict, deque
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Optional
 from datetime import datetime
 import requests # <--- Nueva importación para comunicarnos con la API PHP
 
+# NumPy es opcional: habilita el análisis de calidad vectorizado sobre la imagen cruda
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# ==================== CONFIGURACIÓN DE ENTORNO (.env) ====================
+# Las variables se leen del archivo .env junto a este script (si python-dotenv está instalado)
+# y pueden sobrescribirse con variables de entorno del sistema.
+try:
+    from dotenv import load_dotenv
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+except ImportError:
+    pass
+
+def env_str(name, default):
+    value = os.environ.get(name)
+    return value.strip() if value is not None and value.strip() != '' else default
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on', 'si', 'sí')
+
+def env_int(name, default):
+    try:
+        return int(env_str(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def env_float(name, default):
+    try:
+        return float(env_str(name, default))
+    except (TypeError, ValueError):
+        return default
+
+HOST = env_str('HOST', '0.0.0.0')
+PORT = env_int('PORT', 5000)
+DEBUG = env_bool('DEBUG', False)
+LOG_LEVEL = env_str('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = env_str('LOG_FILE', 'bridge_service.log')
+LOG_MAX_SIZE = env_int('LOG_MAX_SIZE', 10) # MB
+CAPTURE_INTERVAL = env_int('CAPTURE_INTERVAL', 100) / 1000.0 # ms -> segundos
+MAX_RETRIES = env_int('MAX_RETRIES', 3)
+RETRY_DELAY = env_float('RETRY_DELAY', 2)
+ENABLE_CORS = env_bool('ENABLE_CORS', True)
+CORS_ORIGINS = [o.strip() for o in env_str('CORS_ORIGINS', '*').split(',') if o.strip()]
+
+# Modo de servidor: 'development' (Werkzeug) o 'production' (waitress, multi-hilo)
+SERVER_MODE = env_str('SERVER_MODE', 'development').lower()
+HTTP_THREADS = env_int('HTTP_THREADS', 16) # Hilos HTTP del servidor de producción
+HTTP_CONNECTION_LIMIT = env_int('HTTP_CONNECTION_LIMIT', 200) # Conexiones simultáneas aceptadas
+MATCH_CONCURRENCY = env_int('MATCH_CONCURRENCY', 4) # Identificaciones 1:N simultáneas (en cola del SDK)
+MATCH_QUEUE_TIMEOUT = env_float('MATCH_QUEUE_TIMEOUT', 10) # Espera máxima (s) por un turno de matching
+AUTO_START = env_bool('AUTO_START', True) # Cargar SDK, abrir dispositivo y galería en segundo plano al arrancar
+DEVICE_INDEX = env_int('DEVICE_INDEX', 0) # Lector que abre el arranque automático
+BOOTSTRAP_RETRY_INTERVAL = env_float('BOOTSTRAP_RETRY_INTERVAL', 1) # Segundos entre reintentos del arranque (se duplica hasta el máximo)
+BOOTSTRAP_MAX_RETRY_INTERVAL = 30.0 # Espera máxima entre reintentos del arranque
+
 # ==================== CONFIGURACIÓN DE LOGGING CORREGIDA ====================
 class UTF8StreamHandler(logging.StreamHandler):
     def __init__(self, stream=None):
@@ -37,7 +114,7 @@ class UTF8StreamHandler(logging.StreamHandler):
 
 # Configurar logger principal
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 
 # Crear formatter
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -46,8 +123,12 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler = UTF8StreamHandler(sys.stdout)
 console_handler.setFormatter(formatter)
 
-# Handler para archivo (siempre usa UTF-8)
-file_handler = logging.FileHandler('bridge_service.log', encoding='utf-8')
+# Handler para archivo (siempre usa UTF-8, con rotación por tamaño)
+if os.path.dirname(LOG_FILE):
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+file_handler = logging.handlers.RotatingFileHandler(
+    LOG_FILE, maxBytes=LOG_MAX_SIZE * 1024 * 1024, backupCount=5, encoding='utf-8'
+)
 file_handler.setFormatter(formatter)
 
 # Agregar handlers al logger
@@ -60,14 +141,103 @@ logging.getLogger('werkzeug').setLevel(logging.WARNING)
 logger.info("=== ZKTeco USB Bridge Service Iniciado ===")
 
 # ==================== CARGA DEL SDK ZKTECO ====================
-try:
-    import ctypes
-    from ctypes import *
-    
+import ctypes
+from ctypes import *
+
+# Constantes del SDK
+ZKFP_ERR_OK = 0
+ZKFP_ERR_INITLIB = -1
+ZKFP_ERR_INIT = -2
+ZKFP_ERR_NO_DEVICE = -3
+ZKFP_ERR_NOT_SUPPORT = -4
+ZKFP_ERR_INVALID_PARAM = -5
+ZKFP_ERR_OPEN = -6
+ZKFP_ERR_INVALID_HANDLE = -7
+ZKFP_ERR_CAPTURE = -8
+ZKFP_ERR_EXTRACT_FP = -9
+ZKFP_ERR_ABSORT = -10
+ZKFP_ERR_MEMORY_NOT_ENOUGH = -11
+ZKFP_ERR_BUSY = -12
+ZKFP_ERR_ADD_FINGER = -13
+ZKFP_ERR_DEL_FINGER = -14
+ZKFP_ERR_FAIL = -17
+ZKFP_ERR_CANCEL = -18
+ZKFP_ERR_VERIFY_FP = -20
+ZKFP_ERR_MERGE = -22
+ZKFP_ERR_NOT_OPENED = -23
+ZKFP_ERR_NOT_INIT = -24
+ZKFP_ERR_ALREADY_INIT = -25
+ZKFP_ERR_LOADIMAGE = -26
+ZKFP_ERR_ANALYZE_FP = -27
+
+# Nombres de los códigos de error (para los conteos de la capa de medición)
+SDK_ERROR_NAMES = {value: name for name, value in globals().items() if name.startswith('ZKFP_ERR_')}
+
+# Códigos de parámetros
+PARAM_CODE_IMAGE_WIDTH = 1
+PARAM_CODE_IMAGE_HEIGHT = 2
+PARAM_CODE_IMAGE_DPI = 3
+PARAM_CODE_VENDOR = 1101
+PARAM_CODE_PRODUCT = 1102
+PARAM_CODE_SERIAL = 1103
+
+# La DLL se carga bajo demanda (load_sdk): desde el arranque en segundo plano o desde
+# /api/device/initialize, de modo que el servidor HTTP responde desde el primer segundo.
+zkfp = None
+SDK_AVAILABLE = False
+ACQUIRE_IMAGE_AVAILABLE = False
+_sdk_lock = threading.Lock()
+
+def load_sdk():
+    """Cargar la DLL del SDK y definir sus prototipos. Devuelve SDK_AVAILABLE.
+
+    Un éxito queda cacheado; un fallo (DLL ausente, p. ej. durante una actualización
+    de Windows) puede reintentarse en la siguiente llamada.
+    """
+    global zkfp, SDK_AVAILABLE, ACQUIRE_IMAGE_AVAILABLE
+    with _sdk_lock:
+        if SDK_AVAILABLE:
+            return True
+        try:
+            _load_sdk_library()
+            zkfp = InstrumentedSDK(zkfp)
+            SDK_AVAILABLE = True
+            logger.info("SDK de ZKTeco cargado correctamente con prototipos seguros")
+        except Exception as e:
+            zkfp = None
+            SDK_AVAILABLE = False
+            ACQUIRE_IMAGE_AVAILABLE = False
+            logger.error(f"Error crítico al cargar SDK: {e}")
+            logger.warning("El servicio funcionará en modo simulación")
+        return SDK_AVAILABLE
+
+def _load_sdk_library():
+    """Cargar el backend del SDK: la DLL o, con CAPTURE_REPLAY_FILE, una grabación (requiere _sdk_lock)"""
+    global zkfp, ACQUIRE_IMAGE_AVAILABLE
+
+    if CAPTURE_REPLAY_FILE:
+        # Replay: la grabación hace de lector; la DLL (si existe) solo aporta los algoritmos
+        try:
+            _load_sdk_dll()
+            algorithms = zkfp
+        except Exception:
+            logger.warning("DLL no disponible: el replay usará un comparador exacto de plantillas")
+            algorithms = None
+        zkfp = ReplaySDK(CAPTURE_REPLAY_FILE, algorithms=algorithms)
+        ACQUIRE_IMAGE_AVAILABLE = True
+        return
+
+    _load_sdk_dll()
+
+
+def _load_sdk_dll():
+    """Cargar la DLL real del SDK y declarar sus prototipos (requiere _sdk_lock)"""
+    global zkfp, ACQUIRE_IMAGE_AVAILABLE
+
     # Determinar arquitectura
     is_64bit = sys.maxsize > 2**32
     logger.info(f"Ejecutando en modo {'64-bit' if is_64bit else '32-bit'}")
-    
+
     # Intentar cargar la librería principal
     try:
         if os.path.exists('libzkfp.dll'):
@@ -76,33 +246,33 @@ try:
             zkfp = ctypes.CDLL('libzkfpcsharp.dll')
         else:
             zkfp = ctypes.windll.LoadLibrary('libzkfp.dll')
-        
+
         logger.info("DLL cargada exitosamente")
     except Exception as e:
         logger.error(f"Error al cargar DLL: {e}")
         raise
-    
+
     # ==================== DEFINICIÓN DE PROTOTIPOS ====================
     # ZKFPM_Init
     zkfp.ZKFPM_Init.argtypes = []
     zkfp.ZKFPM_Init.restype = ctypes.c_int
-    
+
     # ZKFPM_Terminate
     zkfp.ZKFPM_Terminate.argtypes = []
     zkfp.ZKFPM_Terminate.restype = ctypes.c_int
-    
+
     # ZKFPM_GetDeviceCount
     zkfp.ZKFPM_GetDeviceCount.argtypes = []
     zkfp.ZKFPM_GetDeviceCount.restype = ctypes.c_int
-    
+
     # ZKFPM_OpenDevice
     zkfp.ZKFPM_OpenDevice.argtypes = [ctypes.c_int]
     zkfp.ZKFPM_OpenDevice.restype = ctypes.c_void_p
-    
+
     # ZKFPM_CloseDevice
     zkfp.ZKFPM_CloseDevice.argtypes = [ctypes.c_void_p]
     zkfp.ZKFPM_CloseDevice.restype = ctypes.c_int
-    
+
     # ZKFPM_GetParameters
     zkfp.ZKFPM_GetParameters.argtypes = [
         ctypes.c_void_p,  # handle
@@ -111,7 +281,7 @@ try:
         ctypes.POINTER(ctypes.c_int)     # size
     ]
     zkfp.ZKFPM_GetParameters.restype = ctypes.c_int
-    
+
     # ZKFPM_AcquireFingerprint
     zkfp.ZKFPM_AcquireFingerprint.argtypes = [
         ctypes.c_void_p,  # handle
@@ -121,7 +291,17 @@ try:
         ctypes.POINTER(ctypes.c_int)     # cbTemplate
     ]
     zkfp.ZKFPM_AcquireFingerprint.restype = ctypes.c_int
-    
+
+    # ZKFPM_AcquireFingerprintImage (solo imagen, sin extraer template; no está en todas las versiones)
+    ACQUIRE_IMAGE_AVAILABLE = hasattr(zkfp, 'ZKFPM_AcquireFingerprintImage')
+    if ACQUIRE_IMAGE_AVAILABLE:
+        zkfp.ZKFPM_AcquireFingerprintImage.argtypes = [
+            ctypes.c_void_p,  # handle
+            ctypes.POINTER(ctypes.c_ubyte),  # fpImage
+            ctypes.c_uint     # cbFPImage
+        ]
+        zkfp.ZKFPM_AcquireFingerprintImage.restype = ctypes.c_int
+
     # ZKFPM_GenRegTemplate (para combinar 3 plantillas)
     zkfp.ZKFPM_GenRegTemplate.argtypes = [
         ctypes.c_void_p,  # handle
@@ -132,7 +312,7 @@ try:
         ctypes.POINTER(ctypes.c_int)     # cbRegTemp
     ]
     zkfp.ZKFPM_GenRegTemplate.restype = ctypes.c_int
-    
+
     # ZKFPM_DBMatch (para comparar dos plantillas)
     zkfp.ZKFPM_DBMatch.argtypes = [
         ctypes.c_void_p,  # handle
@@ -142,61 +322,1826 @@ try:
         ctypes.c_int      # cbTemp2
     ]
     zkfp.ZKFPM_DBMatch.restype = ctypes.c_int
-    
+
     # ZKFPM_DBInit (basado en C# SDK 5.3.10) 
     zkfp.ZKFPM_DBInit.argtypes = []
     zkfp.ZKFPM_DBInit.restype = ctypes.c_void_p
 
-    # ZKFPM_DBFree (basado en C# SDK 5.3.11) [cite: 209]
-    zkfp.ZKFPM_DBFree.argtypes = [ctypes.c_void_p]
-    zkfp.ZKFPM_DBFree.restype = ctypes.c_int
+    # ZKFPM_DBFree (basado en C# SDK 5.3.11) [cite: 209]
+    zkfp.ZKFPM_DBFree.argtypes = [ctypes.c_void_p]
+    zkfp.ZKFPM_DBFree.restype = ctypes.c_int
+
+
+# ==================== CONFIGURACIÓN DE LA APLICACIÓN ====================
+# MODIFIQUE ESTA URL A SU ENTORNO REAL si la API no está en localhost
+PHP_API_URL = env_str('PHP_API_URL', "http://localhost/fingerprint/api.php")
+MATCH_THRESHOLD = 60 # Umbral de coincidencia (60 es un valor típico de ZKTeco)
+THRESHOLD_POLICY_FILE = env_str('THRESHOLD_POLICY_FILE', 'threshold_policy.json') # Umbrales por sitio/usuario/dedo
+SITE_ID = env_str('SITE_ID', '') # Sitio de este bridge (para la política de umbrales)
+GALLERY_PARTITION = env_str('GALLERY_PARTITION', '') # Partición por defecto (sitio/puerta/grupo) de las identificaciones de este bridge
+PARTITION_WILDCARD = '*' # Partición que habilita a un usuario en todas las demás
+SCORE_SAMPLE_RATE = env_float('SCORE_SAMPLE_RATE', 0.1) # Fracción de identificaciones 1:N cuya distribución de scores se registra
+SCORE_LOG_FILE = env_str('SCORE_LOG_FILE', 'logs/match_scores.jsonl') # Archivo rotativo de muestras (JSON por línea)
+SCORE_LOG_MAX_SIZE = env_int('SCORE_LOG_MAX_SIZE', 10) # MB por archivo
+SCORE_LOG_BACKUPS = 5 # Archivos rotados que se conservan
+SCORE_TOP_K = 5 # Mejores scores guardados por consulta
+PHP_API_TIMEOUT = 10 # Timeout (segundos) de las llamadas a la API PHP
+ACCESS_LOG_ENABLED = env_bool('ACCESS_LOG_ENABLED', True) # El bridge registra los resultados de identificación en lotes
+ACCESS_LOG_FLUSH_INTERVAL = env_float('ACCESS_LOG_FLUSH_INTERVAL', 2.0) # Segundos entre envíos a api.php?action=log_access_bulk
+ACCESS_LOG_BATCH_SIZE = env_int('ACCESS_LOG_BATCH_SIZE', 200) # Eventos por envío (api.php acepta hasta 500)
+ACCESS_LOG_MAX_PENDING = env_int('ACCESS_LOG_MAX_PENDING', 10000) # Eventos retenidos si PHP no responde (se descartan los más viejos)
+GALLERY_CHECK_INTERVAL = env_float('GALLERY_CHECK_INTERVAL', 2.0) # Segundos entre verificaciones de la firma de la galería en la BD
+GALLERY_NOTIFY_TOKEN = env_str('GALLERY_NOTIFY_TOKEN', '') # Token de api.php para notificar cambios (vacío = solo desde localhost)
+GALLERY_ADAPTIVE_ORDER = env_bool('GALLERY_ADAPTIVE_ORDER', True) # Recorrer primero las plantillas con coincidencias recientes/frecuentes
+GALLERY_HIT_HALF_LIFE = env_float('GALLERY_HIT_HALF_LIFE', 72) # Horas en que el peso de una coincidencia se reduce a la mitad
+GALLERY_REORDER_HITS = env_int('GALLERY_REORDER_HITS', 50) # Coincidencias entre reordenamientos de la galería
+MATCH_CACHE_TTL = 10.0 # Vigencia (segundos) de un resultado 1:N en cache
+MATCH_CACHE_SIZE = 256 # Número máximo de resultados 1:N en cache (LRU)
+CAPTURE_HISTORY_SIZE = env_int('CAPTURE_HISTORY_SIZE', 20) # Capturas recientes retenidas en memoria
+ENROLLMENT_SESSION_TIMEOUT = env_int('ENROLLMENT_SESSION_TIMEOUT', 120) # Segundos sin actividad antes de expirar una sesión de registro
+ENROLLMENT_MAX_SESSIONS = env_int('ENROLLMENT_MAX_SESSIONS', 8) # Sesiones de registro abiertas (activa + en cola)
+ENROLLMENT_SAMPLES = env_int('ENROLLMENT_SAMPLES', 3) # Muestras por registro (3 = flujo clásico)
+ENROLLMENT_MAX_SAMPLES = 10 # Límite de muestras por registro (los tríos crecen como N^3)
+ENROLLMENT_STORE_TEMPLATES = env_int('ENROLLMENT_STORE_TEMPLATES', 1) # Plantillas finales a guardar por dedo
+
+# Calidad de captura (requiere NumPy)
+QUALITY_CHECK_ENABLED = env_bool('QUALITY_CHECK_ENABLED', True)
+QUALITY_MIN_SCORE = env_int('QUALITY_MIN_SCORE', 40) # Puntaje mínimo (0-100) para aceptar una muestra de registro
+QUALITY_MIN_COVERAGE = env_float('QUALITY_MIN_COVERAGE', 0.25) # Fracción mínima del área con huella
+QUALITY_BLOCK_SIZE = 16 # Tamaño de bloque (px) para estadísticas locales
+QUALITY_BLOCK_STD = 12.0 # Desviación estándar mínima de un bloque para considerarlo "con crestas"
+QUALITY_BRIGHT_LEVEL = 170 # Nivel de gris sobre el cual un píxel se considera valle/fondo
+QUALITY_SHARPNESS_REF = 40.0 # Energía de laplaciano considerada "nítida"
+
+# Detección de dedo presente/levantado sobre la imagen cruda (requiere NumPy)
+PRESENCE_DETECTION_ENABLED = env_bool('PRESENCE_DETECTION_ENABLED', True)
+PRESENCE_STRIDE = 4 # Submuestreo por eje: 1 de cada N píxeles
+PRESENCE_DARK_LEVEL = 128 # Nivel de gris bajo el cual un píxel se considera cresta
+PRESENCE_MIN_DARK = 0.08 # Fracción mínima de píxeles de cresta para considerar el dedo presente
+PRESENCE_MIN_STD = 10.0 # Desviación estándar mínima (un sensor vacío es casi uniforme)
+LIFT_POLL_INTERVAL = env_int('LIFT_POLL_INTERVAL', 20) / 1000.0 # ms -> segundos, mientras se espera que levante el dedo
+LIFT_EMPTY_FRAMES = max(env_int('LIFT_EMPTY_FRAMES', 3), 1) # Cuadros vacíos seguidos (según el detector) para dar el dedo por levantado
+
+# Prefiltro de candidatos 1:N por descriptor grueso de la plantilla (requiere NumPy)
+PREFILTER_ENABLED = env_bool('PREFILTER_ENABLED', False)
+PREFILTER_FRACTION = env_float('PREFILTER_FRACTION', 0.2) # Fracción de la galería que pasa a ZKFPM_DBMatch
+PREFILTER_MIN_CANDIDATES = env_int('PREFILTER_MIN_CANDIDATES', 50) # Candidatos mínimos por consulta
+PREFILTER_MIN_GALLERY = env_int('PREFILTER_MIN_GALLERY', 500) # Galerías (o particiones) menores se recorren completas
+PREFILTER_FALLBACK = env_bool('PREFILTER_FALLBACK', True) # Sin coincidencia entre los candidatos, comparar el resto
+PREFILTER_BINS = 16 # Bins del histograma de bytes de la plantilla
+
+# Parámetros de cada lector (por número de serie) persistidos entre reaperturas y reinicios
+DEVICE_PARAMS_FILE = env_str('DEVICE_PARAMS_FILE', 'device_params.json')
+DEFAULT_IMAGE_WIDTH = 300
+DEFAULT_IMAGE_HEIGHT = 400
+
+# Salud del lector: antigüedad máxima del último contacto exitoso antes de sondear, y sondeos como mucho cada N s
+HEALTH_MAX_AGE = env_float('HEALTH_MAX_AGE', 2.0)
+HEALTH_PROBE_INTERVAL = env_float('HEALTH_PROBE_INTERVAL', 5.0)
+
+# Grabación de adquisiciones (vacío = desactivada) y backend de replay que reemplaza al lector
+CAPTURE_RECORD_FILE = env_str('CAPTURE_RECORD_FILE', '') # Archivo binario de solo-anexado
+CAPTURE_RECORD_IMAGES = env_bool('CAPTURE_RECORD_IMAGES', True) # Guardar la imagen cruda (zlib) además del template
+CAPTURE_RECORD_SLOW_MS = env_int('CAPTURE_RECORD_SLOW_MS', 200) # Sondeos sin dedo más lentos que esto también se graban
+CAPTURE_REPLAY_FILE = env_str('CAPTURE_REPLAY_FILE', '') # Grabación a reproducir en lugar del lector USB
+CAPTURE_REPLAY_SPEED = env_float('CAPTURE_REPLAY_SPEED', 1.0) # 1 = tiempo real, N = N veces más rápido, 0 = sin esperas
+CAPTURE_REPLAY_LOOP = env_bool('CAPTURE_REPLAY_LOOP', False) # Volver a empezar al terminar la grabación
+
+# Medición de las llamadas al SDK (conteos, latencias, códigos) y perfiles de muestreo bajo demanda
+SDK_CALL_STATS = env_bool('SDK_CALL_STATS', True) # Se puede alternar en caliente con POST /api/debug/sdk_calls
+PROFILE_INTERVAL = env_int('PROFILE_INTERVAL', 5) / 1000.0 # ms -> segundos entre muestras de un perfil
+PROFILE_MAX_SECONDS = 60 # Duración máxima de un perfil
+DEBUG_ADMIN_TOKEN = env_str('DEBUG_ADMIN_TOKEN', '') # Token para /api/debug/sdk_calls y /api/debug/profile (vacío = solo desde localhost)
+
+# Detección de conexión/desconexión del lector (hot-plug)
+HOTPLUG_MONITOR_ENABLED = env_bool('HOTPLUG_MONITOR_ENABLED', True)
+HOTPLUG_POLL_INTERVAL = env_int('HOTPLUG_POLL_INTERVAL', 250) / 1000.0 # ms -> segundos entre sondeos de ZKFPM_GetDeviceCount
+
+# ==================== CONFIGURACIÓN FLASK ====================
+app = Flask(__name__)
+if ENABLE_CORS:
+    CORS(app, origins=CORS_ORIGINS)
+
+# ==================== GALERÍA RESIDENTE DE PLANTILLAS ====================
+class TemplateGallery:
+    """Copia residente de las plantillas registradas en la BD (vía API PHP).
+
+    Las plantillas se decodifican una sola vez y se guardan como buffers ctypes
+    listos para ZKFPM_DBMatch. La galería solo se recarga cuando cambia la firma
+    reportada por api.php, y cada recarga incrementa `version`.
+
+    Cada usuario puede pertenecer a particiones (sitio, puerta o grupo, tabla
+    user_partitions); al cargar se arma una lista por partición para que una
+    identificación solo recorra las plantillas habilitadas allí. Los usuarios con
+    PARTITION_WILDCARD entran en todas las particiones.
+
+    Con GALLERY_ADAPTIVE_ORDER las listas se reordenan cada GALLERY_REORDER_HITS
+    coincidencias según un conteo de aciertos con decaimiento exponencial
+    (GALLERY_HIT_HALF_LIFE), de modo que la búsqueda con salida en la primera
+    coincidencia encuentre antes a los usuarios habituales. El reordenamiento no
+    cambia `version`: el contenido (y por lo tanto la cache) sigue siendo el mismo.
+
+    api.php notifica cada registro, borrado o cambio de particiones con las filas
+    vigentes del usuario afectado (`apply_change`), así que la galería se actualiza
+    sin descargar la tabla; la verificación periódica de la firma queda como red
+    de seguridad si una notificación se pierde.
+    """
+
+    def __init__(self, check_interval=GALLERY_CHECK_INTERVAL, adaptive_order=GALLERY_ADAPTIVE_ORDER,
+                 half_life=GALLERY_HIT_HALF_LIFE * 3600, reorder_hits=GALLERY_REORDER_HITS):
+        self.entries = []
+        self.partitions = {}
+        self._wildcard_entries = []
+        self.version = 0
+        self.check_interval = check_interval
+        self.adaptive_order = adaptive_order
+        self.half_life = max(half_life, 1.0)
+        self.reorder_hits = max(reorder_hits, 1)
+        self.reorders = 0
+        self.changes_applied = 0
+        self.last_change = None
+        self._hits = {} # (id interno, dedo) -> (peso, instante del último acierto)
+        self._pending_hits = 0
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch_signature(self):
+        """Obtener la firma (barata) del contenido actual de la BD"""
+        response = requests.get(f"{PHP_API_URL}?action=get_verification_version", timeout=PHP_API_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        if not data.get('success'):
+            raise RuntimeError(data.get('message', 'Error al obtener versión de la galería'))
+        return data.get('signature')
+
+    def _fetch_rows(self):
+        """Descargar todas las plantillas activas"""
+        logger.info("Obteniendo plantillas registradas desde API PHP...")
+        response = requests.get(f"{PHP_API_URL}?action=get_verification_data", timeout=PHP_API_TIMEOUT)
+        response.raise_for_status()
+        db_data = response.json()
+        if not db_data.get('success'):
+            raise RuntimeError(db_data.get('message', 'Error al obtener datos de verificación'))
+        return db_data.get('data', [])
+
+    def _build_entries(self, rows):
+        """Decodificar las filas de la BD en buffers listos para ZKFPM_DBMatch"""
+        entries = []
+        for row in rows:
+            try:
+                template_bytes = base64.b64decode(row.get('template'))
+            except Exception as e:
+                logger.error(f"Plantilla inválida para usuario {row.get('user_id_str')}: {e}")
+                continue
+            if not template_bytes:
+                continue
+            entries.append({
+                'user_internal_id': row.get('user_internal_id'),
+                'user_id_str': row.get('user_id_str'),
+                'name': row.get('name'),
+                'finger_index': row.get('finger_index'),
+                'template_size': len(template_bytes),
+                'buffer': (ctypes.c_ubyte * len(template_bytes)).from_buffer_copy(template_bytes),
+                'descriptor': TemplatePrefilter.descriptor(template_bytes),
+                'partitions': self._parse_partitions(row.get('partitions'))
+            })
+        return entries
+
+    @staticmethod
+    def _parse_partitions(value):
+        """Particiones de una fila: lista JSON o texto separado por comas (GROUP_CONCAT)"""
+        if not value:
+            return frozenset()
+        if isinstance(value, str):
+            value = value.split(',')
+        return frozenset(str(key).strip() for key in value if str(key).strip())
+
+    @staticmethod
+    def _build_partitions(entries):
+        """Índice partición -> entradas habilitadas (en el orden de la galería)"""
+        keys = {key for entry in entries for key in entry['partitions']} - {PARTITION_WILDCARD}
+        partitions = {key: [] for key in keys}
+        wildcard = []
+        for entry in entries:
+            if PARTITION_WILDCARD in entry['partitions']:
+                wildcard.append(entry)
+                for members in partitions.values():
+                    members.append(entry)
+            else:
+                for key in entry['partitions']:
+                    partitions[key].append(entry)
+        return partitions, wildcard
+
+    def _apply(self, signature, rows):
+        """Registrar una firma verificada y, si cambió, reemplazar las entradas (requiere _lock)"""
+        self._last_check = time.time()
+        if signature != self._signature and rows is not None:
+            # Se reemplazan las listas completas: los lectores con la lista anterior no se ven afectados
+            entries = self._build_entries(rows)
+            if self.adaptive_order and self._hits:
+                entries = self._order_by_hits(entries)
+            self.partitions, self._wildcard_entries = self._build_partitions(entries)
+            self.entries = entries
+            self._signature = signature
+            self.version += 1
+            logger.info(
+                f"Galería cargada: {len(self.entries)} plantillas, "
+                f"{len(self.partitions)} particiones (versión {self.version})"
+            )
+
+    @staticmethod
+    def _hit_key(entry):
+        return (entry['user_internal_id'], entry['finger_index'])
+
+    def _hit_weight(self, key, now):
+        """Peso del conteo de aciertos decaído hasta `now`"""
+        weight, last = self._hits.get(key, (0.0, now))
+        return weight * 0.5 ** ((now - last) / self.half_life)
+
+    def _order_by_hits(self, entries):
+        """Entradas ordenadas por peso descendente (orden estable entre iguales)"""
+        now = time.monotonic()
+        weights = {key: self._hit_weight(key, now) for key in self._hits}
+        return sorted(entries, key=lambda entry: -weights.get(self._hit_key(entry), 0.0))
+
+    def record_hit(self, entry):
+        """Contabilizar una coincidencia y reordenar la galería cada `reorder_hits` aciertos"""
+        if not self.adaptive_order:
+            return
+        with self._lock:
+            now = time.monotonic()
+            key = self._hit_key(entry)
+            self._hits[key] = (self._hit_weight(key, now) + 1.0, now)
+            self._pending_hits += 1
+            if self._pending_hits < self.reorder_hits:
+                return
+
+            self._pending_hits = 0
+            # Olvidar pesos ya despreciables para que el mapa no crezca sin límite
+            self._hits = {k: v for k, v in self._hits.items() if self._hit_weight(k, now) >= 0.01}
+            entries = self._order_by_hits(self.entries)
+            self.partitions, self._wildcard_entries = self._build_partitions(entries)
+            self.entries = entries
+            self.reorders += 1
+
+    def needs_check(self):
+        """¿Corresponde verificar la firma de la BD?"""
+        return self._signature is None or time.time() - self._last_check >= self.check_interval
+
+    def is_current(self, signature):
+        return signature == self._signature
+
+    def apply(self, signature, rows=None):
+        """Aplicar una firma/filas obtenidas externamente (p. ej. por la capa asyncio)"""
+        with self._lock:
+            self._apply(signature, rows)
+
+    def apply_change(self, change):
+        """Reemplazar las plantillas de un usuario por las filas notificadas por api.php.
+
+        `change` = {'user_internal_id', 'rows', 'signature'}: `rows` son todas las
+        plantillas activas del usuario (mismo formato que get_verification_data);
+        vacío = el usuario ya no debe identificarse. Devuelve False si la galería
+        aún no se cargó (la primera consulta la descargará completa).
+        """
+        user_internal_id = str(change['user_internal_id'])
+        added = self._build_entries(change.get('rows') or [])
+
+        with self._lock:
+            if self._signature is None:
+                return False
+            kept = [entry for entry in self.entries if str(entry['user_internal_id']) != user_internal_id]
+            # Recién registrado o actualizado: suele identificarse enseguida, se recorre primero
+            entries = added + kept
+            self.partitions, self._wildcard_entries = self._build_partitions(entries)
+            self.entries = entries
+            if change.get('signature'):
+                # Con la firma resultante la próxima verificación no vuelve a descargar todo;
+                # si se perdió otra notificación, la firma de la BD no coincidirá y se recarga
+                self._signature = change['signature']
+            self.version += 1
+            self.changes_applied += 1
+            self.last_change = time.time()
+
+        logger.info(
+            f"Galería actualizada por notificación: usuario {user_internal_id}, "
+            f"{len(added)} plantillas vigentes (versión {self.version})"
+        )
+        return True
+
+    def _select(self, partition):
+        """Entradas elegibles para una partición (None = galería completa)"""
+        if not partition:
+            return self.entries
+        # Partición sin miembros propios: solo los usuarios habilitados en todas
+        return self.partitions.get(partition, self._wildcard_entries)
+
+    def snapshot(self, partition=None):
+        """Devolver (entries, version) de la partición, recargando si la firma de la BD cambió"""
+        with self._lock:
+            if self.needs_check():
+                signature = self._fetch_signature()
+                rows = None if self.is_current(signature) else self._fetch_rows()
+                self._apply(signature, rows)
+            return self._select(partition), self.version
+
+    def invalidate(self):
+        """Forzar verificación de la firma en la próxima consulta"""
+        with self._lock:
+            self._last_check = 0.0
+
+    def get_status(self):
+        """Estado de la galería para debugging"""
+        return {
+            'version': self.version,
+            'templates': len(self.entries),
+            'partitions': {key: len(members) for key, members in sorted(self.partitions.items())},
+            'wildcard_templates': len(self._wildcard_entries),
+            'adaptive_order': self.adaptive_order,
+            'tracked_hits': len(self._hits),
+            'reorders': self.reorders,
+            'changes_applied': self.changes_applied,
+            'last_change': self.last_change,
+            'last_check': self._last_check
+        }
+
+
+def token_or_localhost(remote_addr, token, expected):
+    """Con `expected` definido exige ese token compartido; sin él, solo se aceptan llamadas locales"""
+    if expected:
+        return hmac.compare_digest(token or '', expected)
+    return remote_addr in ('127.0.0.1', '::1')
+
+
+def gallery_change_allowed(remote_addr, token):
+    """¿Se acepta una notificación de cambios de galería? (token compartido o, sin token, solo localhost)"""
+    return token_or_localhost(remote_addr, token, GALLERY_NOTIFY_TOKEN)
+
+
+def debug_admin_allowed(remote_addr, token):
+    """¿Se acepta una llamada a los endpoints de medición/perfil? (DEBUG_ADMIN_TOKEN o solo localhost)"""
+    return token_or_localhost(remote_addr, token, DEBUG_ADMIN_TOKEN)
+
+
+def parse_gallery_changes(data):
+    """Lista de cambios válidos de {'changes': [...]} o de un cambio suelto; None si el cuerpo es inválido"""
+    if not isinstance(data, dict):
+        return None
+    changes = data.get('changes', [data])
+    if not isinstance(changes, list):
+        return None
+    if not all(isinstance(change, dict) and change.get('user_internal_id') is not None
+               and isinstance(change.get('rows', []), list) for change in changes):
+        return None
+    return changes
+
+
+class MatchResultCache:
+    """Cache LRU con TTL corto de resultados 1:N, indexada por hash de la plantilla capturada.
+
+    Cada resultado queda asociado a la versión de la galería (y de la política de
+    umbrales) con la que se calculó; un cambio de versión invalida todas las entradas.
+    """
+
+    def __init__(self, max_entries=MATCH_CACHE_SIZE, ttl=MATCH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(template_bytes, scope=None):
+        """Clave de cache: hash de los bytes de la plantilla (y el ámbito de la búsqueda, p.ej. el sitio)"""
+        return (scope, hashlib.blake2b(template_bytes, digest_size=16).digest())
+
+    def get(self, key, gallery_version):
+        with self._lock:
+            if gallery_version != self._version:
+                self._entries.clear()
+                self._version = gallery_version
+
+            item = self._entries.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                if item is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**item[1], 'cached': True}
+
+    def put(self, key, gallery_version, result):
+        with self._lock:
+            if gallery_version != self._version:
+                self._entries.clear()
+                self._version = gallery_version
+
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_status(self):
+        """Estadísticas de la cache para debugging"""
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'gallery_version': self._version
+        }
+
+
+class TemplatePrefilter:
+    """Prefiltro barato de candidatos antes de ZKFPM_DBMatch.
+
+    Cada plantilla de la galería lleva un descriptor grueso (histograma normalizado
+    de sus bytes más su longitud relativa); la fracción PREFILTER_FRACTION más
+    cercana por distancia L1 se compara primero, pero en el orden de la galería
+    (el de aciertos de GALLERY_ADAPTIVE_ORDER), así que el prefiltro solo elige
+    candidatos y no reemplaza ese orden. Con PREFILTER_FALLBACK, si ningún candidato
+    coincide se compara el resto de la galería, así que el prefiltro solo cuesta
+    recall si se desactiva el fallback. Las estadísticas (`candidate_hits` contra
+    `fallback_hits`) indican cuánto recall aporta el prefiltro en la galería real:
+    no hay evidencia de que el descriptor se correlacione con la identidad, por eso
+    viene desactivado.
+    """
+
+    def __init__(self, enabled=PREFILTER_ENABLED, fraction=PREFILTER_FRACTION,
+                 min_candidates=PREFILTER_MIN_CANDIDATES, min_gallery=PREFILTER_MIN_GALLERY,
+                 fallback=PREFILTER_FALLBACK):
+        self.enabled = enabled and NUMPY_AVAILABLE
+        self.fraction = min(max(fraction, 0.0), 1.0)
+        self.min_candidates = max(min_candidates, 1)
+        self.min_gallery = min_gallery
+        self.fallback = fallback
+        self.stats = {'queries': 0, 'candidate_hits': 0, 'fallback_hits': 0, 'misses': 0}
+        self._matrices = {} # id(lista de entradas) -> (lista, matriz de descriptores)
+        self._lock = threading.Lock()
+
+        if enabled and not NUMPY_AVAILABLE:
+            logger.warning("⚠️ PREFILTER_ENABLED requiere NumPy - prefiltro desactivado")
+
+    @staticmethod
+    def descriptor(template_bytes):
+        """Descriptor grueso de una plantilla (None sin NumPy)"""
+        if not NUMPY_AVAILABLE or not template_bytes:
+            return None
+        data = np.frombuffer(template_bytes, dtype=np.uint8)
+        hist = np.bincount(data >> 4, minlength=PREFILTER_BINS).astype(np.float32) / len(data)
+        return np.append(hist, np.float32(len(data) / 2048.0))
+
+    def _matrix(self, entries):
+        """Matriz de descriptores de una lista de la galería (cacheada por lista)"""
+        with self._lock:
+            cached = self._matrices.get(id(entries))
+            if cached is not None and cached[0] is entries:
+                return cached[1]
+            matrix = np.stack([entry['descriptor'] for entry in entries])
+            if len(self._matrices) >= 64:
+                self._matrices.clear() # Listas reemplazadas por recargas/reordenamientos
+            self._matrices[id(entries)] = (entries, matrix)
+            return matrix
+
+    def plan(self, entries, template_bytes):
+        """Orden de recorrido: (índices, candidatos) o None si se recorre la galería completa"""
+        if not self.enabled or len(entries) < self.min_gallery:
+            return None
+        probe = self.descriptor(template_bytes)
+        if probe is None or any(entry.get('descriptor') is None for entry in entries):
+            return None
+
+        distances = np.abs(self._matrix(entries) - probe).sum(axis=1)
+        candidates = min(len(entries), max(self.min_candidates, int(len(entries) * self.fraction)))
+        order = np.argsort(distances, kind='stable')
+        # Candidatos y resto, cada grupo en el orden de la galería (aciertos recientes primero)
+        scan = sorted(order[:candidates].tolist())
+        if self.fallback:
+            scan += sorted(order[candidates:].tolist())
+        return scan, candidates
+
+    def record(self, position, candidates):
+        """Registrar dónde apareció la coincidencia (posición en el recorrido o None)"""
+        with self._lock:
+            self.stats['queries'] += 1
+            if position is None:
+                self.stats['misses'] += 1
+            elif position < candidates:
+                self.stats['candidate_hits'] += 1
+            else:
+                self.stats['fallback_hits'] += 1
+
+    def get_status(self):
+        return {
+            'enabled': self.enabled,
+            'fraction': self.fraction,
+            'min_candidates': self.min_candidates,
+            'min_gallery': self.min_gallery,
+            'fallback': self.fallback,
+            **self.stats
+        }
+
+
+# ==================== POLÍTICA DE UMBRALES ====================
+class ThresholdPolicy:
+    """Umbrales de coincidencia resueltos por dedo > usuario > sitio > global.
+
+    Se cargan de THRESHOLD_POLICY_FILE (JSON); sin archivo rige MATCH_THRESHOLD:
+
+        {
+          "default": 60,
+          "early_exit": 85,
+          "sites": {"planta-norte": 65},
+          "users": {"EMP001": 55},
+          "fingers": {"EMP001:2": 50}
+        }
+
+    `early_exit` (opcional): en la búsqueda 1:N una coincidencia por debajo de este
+    score no detiene el recorrido (se sigue buscando una mejor); sin él se detiene en
+    la primera coincidencia, como siempre. Ver calibrate_thresholds.py.
+    """
+
+    def __init__(self, path=THRESHOLD_POLICY_FILE):
+        self.path = path
+        self.version = 0
+        self.loaded_from_file = False
+        self._rules = self._normalize({})
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(raw):
+        """Validar y convertir la política (ValueError/TypeError si un umbral no es entero)"""
+        early_exit = raw.get('early_exit')
+        return {
+            'default': int(raw.get('default', MATCH_THRESHOLD)),
+            'early_exit': int(early_exit) if early_exit is not None else None,
+            'sites': {str(k): int(v) for k, v in (raw.get('sites') or {}).items()},
+            'users': {str(k): int(v) for k, v in (raw.get('users') or {}).items()},
+            'fingers': {str(k): int(v) for k, v in (raw.get('fingers') or {}).items()}
+        }
+
+    def load(self):
+        """(Re)cargar la política desde el archivo; la anterior sigue vigente si falla"""
+        raw = {}
+        from_file = bool(self.path) and os.path.exists(self.path)
+        if from_file:
+            with open(self.path, encoding='utf-8') as f:
+                raw = json.load(f)
+
+        rules = self._normalize(raw)
+        with self._lock:
+            self._rules = rules
+            self.version += 1
+            self.loaded_from_file = from_file
+
+        logger.info(f"🎚️ Política de umbrales cargada (versión {self.version}, default {rules['default']}, "
+                    f"{len(rules['users'])} usuario(s), {len(rules['fingers'])} dedo(s))")
+        return self.get_status()
+
+    @property
+    def early_exit(self):
+        return self._rules['early_exit']
+
+    def site_threshold(self, site=None):
+        rules = self._rules
+        return rules['sites'].get(site or SITE_ID, rules['default'])
+
+    def threshold_for(self, user_id, finger_index=None, site=None):
+        """Umbral efectivo para un usuario (y opcionalmente un dedo) en un sitio"""
+        rules = self._rules
+        if finger_index is not None:
+            threshold = rules['fingers'].get(f"{user_id}:{finger_index}")
+            if threshold is not None:
+                return threshold
+        threshold = rules['users'].get(str(user_id))
+        if threshold is not None:
+            return threshold
+        return self.site_threshold(site)
+
+    def resolve(self, entries, site=None):
+        """Umbral de cada entrada de la galería, resuelto una vez antes del loop 1:N"""
+        rules = self._rules
+        if not rules['users'] and not rules['fingers']:
+            return [self.site_threshold(site)] * len(entries)
+        return [
+            self.threshold_for(entry['user_id_str'], entry['finger_index'], site)
+            for entry in entries
+        ]
+
+    def get_status(self):
+        return {
+            'path': self.path,
+            'version': self.version,
+            'loaded_from_file': self.loaded_from_file,
+            'site': SITE_ID or None,
+            **self._rules
+        }
+
+# ==================== REGISTRO DE DISTRIBUCIÓN DE SCORES ====================
+class ScoreRecorder:
+    """Muestreo de la distribución completa de scores de las identificaciones 1:N.
+
+    Solo una fracción (SCORE_SAMPLE_RATE) de las consultas guarda sus scores; la
+    escritura al archivo rotativo la hace el hilo de un QueueListener, de modo que el
+    loop de matching solo paga un append por comparación y un put() al final.
+    Las muestras (JSON por línea) sirven para calibrar early_exit y dimensionar
+    particiones de la galería (ver calibrate_thresholds.py --traffic).
+    """
+
+    def __init__(self, path=SCORE_LOG_FILE, sample_rate=SCORE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = min(max(sample_rate, 0.0), 1.0) if path else 0.0
+        self.recorded = 0
+        self._listener = None
+        self._logger = logging.getLogger(f"{__name__}.scores")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+
+        if self.sample_rate > 0:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=SCORE_LOG_MAX_SIZE * 1024 * 1024, backupCount=SCORE_LOG_BACKUPS, encoding='utf-8'
+            )
+            records = queue.Queue()
+            self._logger.addHandler(logging.handlers.QueueHandler(records))
+            self._listener = logging.handlers.QueueListener(records, handler)
+            self._listener.start()
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, entries, scores, first_hit, matched, elapsed, site=None, early_exit=None, partition=None, wait=None):
+        """Guardar una consulta muestreada.
+
+        `scores`: lista de (score, índice en la galería) en orden de recorrido;
+        `first_hit`: posición de la primera coincidencia (None si no hubo);
+        `matched`: (entrada, score, umbral) elegido o None;
+        `elapsed`: segundos del recorrido con el handle tomado; `wait`: espera previa por el handle.
+        """
+        scanned = len(scores)
+        top = heapq.nlargest(SCORE_TOP_K, scores)
+        sample = {
+            'ts': round(time.time(), 3),
+            'site': site or SITE_ID or None,
+            'partition': partition,
+            'gallery_size': len(entries),
+            'scanned': scanned,
+            'first_hit': first_hit,
+            'early_exit': early_exit,
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'wait_ms': round(wait * 1000, 3) if wait is not None else None,
+            'per_match_us': round(elapsed * 1e6 / scanned, 2) if scanned else None,
+            'matched': None,
+            'top': [
+                {
+                    'score': score,
+                    'user_id': entries[index]['user_id_str'],
+                    'finger_index': entries[index]['finger_index']
+                }
+                for score, index in top
+            ]
+        }
+        if matched is not None:
+            entry, score, threshold = matched
+            sample['matched'] = {
+                'user_id': entry['user_id_str'],
+                'finger_index': entry['finger_index'],
+                'score': score,
+                'threshold': threshold
+            }
+        self._logger.info(json.dumps(sample))
+        self.recorded += 1
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def get_status(self):
+        return {
+            'path': self.path,
+            'sample_rate': self.sample_rate,
+            'recorded': self.recorded,
+            'active': self._listener is not None
+        }
+
+# ==================== BITÁCORA DE ACCESOS ====================
+class AccessLogBuffer:
+    """Resultados de identificación acumulados y enviados en lotes a la API PHP.
+
+    En lugar de un POST (y un INSERT) por evento, un hilo envía cada
+    ACCESS_LOG_FLUSH_INTERVAL segundos (o al juntar ACCESS_LOG_BATCH_SIZE eventos)
+    un lote a `api.php?action=log_access_bulk`, que lo inserta en una transacción.
+    Cada evento lleva un `event_id`, de modo que reenviar un lote tras un timeout
+    no duplica filas. Si PHP no responde, los eventos quedan pendientes (hasta
+    ACCESS_LOG_MAX_PENDING) y se reintentan en el siguiente ciclo.
+    """
+
+    def __init__(self, enabled=ACCESS_LOG_ENABLED, interval=ACCESS_LOG_FLUSH_INTERVAL,
+                 batch_size=ACCESS_LOG_BATCH_SIZE):
+        self.enabled = enabled
+        self.interval = max(interval, 0.1)
+        self.batch_size = max(1, min(batch_size, 500))
+        self.sent = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_error = None
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def record(self, user_internal_id, status, method='fingerprint'):
+        """Encolar un evento (no bloquea la identificación)"""
+        if not self.enabled:
+            return False
+        event = {
+            'event_id': uuid.uuid4().hex,
+            'user_id': user_internal_id,
+            'status': status,
+            'method': method,
+            'access_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with self._lock:
+            if len(self._pending) >= ACCESS_LOG_MAX_PENDING:
+                self._pending.popleft()
+                self.dropped += 1
+            self._pending.append(event)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Enviar todo lo pendiente en lotes; devuelve el número de eventos confirmados"""
+        sent = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    return sent
+
+                try:
+                    response = requests.post(
+                        f"{PHP_API_URL}?action=log_access_bulk",
+                        json={'events': batch},
+                        timeout=PHP_API_TIMEOUT
+                    )
+                    response.raise_for_status()
+                    data = response.json()
+                    if not data.get('success'):
+                        raise RuntimeError(data.get('message', 'Error al registrar accesos'))
+                except Exception as e:
+                    self.failures += 1
+                    if self.last_error is None:
+                        logger.warning(f"⚠️ No se pudo enviar la bitácora de accesos ({len(batch)} eventos): {e}")
+                    self.last_error = str(e)
+                    return sent
+
+                with self._lock:
+                    # Solo se quitan los eventos confirmados (pueden haber llegado otros detrás)
+                    for event in batch:
+                        if self._pending and self._pending[0] is event:
+                            self._pending.popleft()
+                if self.last_error is not None:
+                    logger.info("✅ Bitácora de accesos enviada de nuevo a la API PHP")
+                self.last_error = None
+                self.sent += len(batch)
+                sent += len(batch)
+
+    def get_status(self):
+        return {
+            'enabled': self.enabled,
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'flush_interval': self.interval,
+            'batch_size': self.batch_size
+        }
+
+# ==================== CALIDAD DE CAPTURA ====================
+def assess_capture_quality(image_bytes, width, height):
+    """Evaluar la calidad de la imagen cruda del sensor con operaciones vectorizadas.
+
+    Devuelve un dict con puntaje 0-100 y sus componentes, o None si NumPy no está
+    disponible o la imagen no tiene el tamaño esperado:
+    - coverage: fracción de bloques con crestas (varianza local alta)
+    - contrast: rango dinámico (p5-p95) dentro del área con huella
+    - dryness: exceso de píxeles claros en el área con huella (crestas cortadas o débiles)
+    - sharpness: energía media del laplaciano en el área con huella
+    """
+    if not NUMPY_AVAILABLE or not image_bytes or len(image_bytes) < width * height:
+        return None
+
+    img = np.frombuffer(image_bytes, dtype=np.uint8, count=width * height).reshape(height, width).astype(np.float32)
+    core = img[1:-1, 1:-1]
+    laplacian = np.abs(4 * core - img[:-2, 1:-1] - img[2:, 1:-1] - img[1:-1, :-2] - img[1:-1, 2:])
+
+    b = QUALITY_BLOCK_SIZE
+    rows, cols = core.shape[0] // b, core.shape[1] // b
+    if rows == 0 or cols == 0:
+        return None
+
+    # Vista por bloques (rows, cols, b, b) sin copiar los datos
+    blocks = core[:rows * b, :cols * b].reshape(rows, b, cols, b).swapaxes(1, 2)
+    lap_blocks = laplacian[:rows * b, :cols * b].reshape(rows, b, cols, b).swapaxes(1, 2)
+
+    foreground = blocks.std(axis=(2, 3)) > QUALITY_BLOCK_STD
+    coverage = float(foreground.mean())
+    if not foreground.any():
+        return {
+            'score': 0, 'coverage': 0.0, 'contrast': 0.0, 'dryness': 1.0, 'sharpness': 0.0,
+            'acceptable': False, 'reason': 'No se detectó huella'
+        }
+
+    pixels = blocks[foreground]
+    p5, p95 = np.percentile(pixels, (5, 95))
+    contrast = float((p95 - p5) / 255.0)
+    bright_fraction = float((pixels > QUALITY_BRIGHT_LEVEL).mean())
+    dryness = min(max((bright_fraction - 0.5) * 2.0, 0.0), 1.0)
+    sharpness = min(float(lap_blocks[foreground].mean()) / QUALITY_SHARPNESS_REF, 1.0)
+
+    score = int(round(100 * (
+        0.35 * min(coverage / 0.6, 1.0) +
+        0.25 * min(contrast / 0.6, 1.0) +
+        0.25 * sharpness +
+        0.15 * (1.0 - dryness)
+    )))
+
+    reason = None
+    if coverage < QUALITY_MIN_COVERAGE:
+        reason = 'Huella parcial: apoye más superficie del dedo'
+    elif score < QUALITY_MIN_SCORE:
+        # Informar el componente más débil
+        weakest = min(
+            (contrast / 0.6, 'Poco contraste: presione con firmeza'),
+            (sharpness, 'Imagen borrosa: no mueva el dedo'),
+            (1.0 - dryness, 'Dedo seco: humedézcalo ligeramente')
+        )
+        reason = weakest[1]
+
+    return {
+        'score': score,
+        'coverage': round(coverage, 3),
+        'contrast': round(contrast, 3),
+        'dryness': round(dryness, 3),
+        'sharpness': round(sharpness, 3),
+        'acceptable': reason is None,
+        'reason': reason
+    }
+
+def detect_finger_presence(image, width, height):
+    """Decidir si hay un dedo sobre el sensor a partir de la imagen cruda.
+
+    Acepta bytes o el arreglo ctypes del loop de captura (sin copiarlo) y trabaja sobre una
+    submuestra de 1 de cada PRESENCE_STRIDE píxeles por eje, de modo que el costo por cuadro
+    queda muy por debajo de 1 ms. Devuelve True/False, o None si NumPy no está disponible.
+    """
+    if not NUMPY_AVAILABLE or image is None or len(image) < width * height:
+        return None
+
+    img = np.frombuffer(image, dtype=np.uint8, count=width * height).reshape(height, width)
+    sample = img[::PRESENCE_STRIDE, ::PRESENCE_STRIDE]
+    dark_fraction = float((sample < PRESENCE_DARK_LEVEL).mean())
+    return dark_fraction >= PRESENCE_MIN_DARK and float(sample.std()) >= PRESENCE_MIN_STD
+
+# ==================== REGISTROS INMUTABLES DE CAPTURA ====================
+# El hilo de captura publica objetos inmutables reemplazando la referencia (asignación
+# atómica); los lectores HTTP leen la referencia sin locks ni copias.
+
+@dataclass(frozen=True)
+class CaptureFrame:
+    """Adquisición del sensor, inmutable y numerada secuencialmente"""
+    seq: int
+    timestamp: float
+    mode: str
+    width: int
+    height: int
+    template_bytes: bytes
+    image_bytes: bytes
+    quality: Optional[dict] = None
+
+    # La codificación base64 se calcula una sola vez, y solo si alguien la pide
+    @cached_property
+    def template(self):
+        return base64.b64encode(self.template_bytes).decode('utf-8')
+
+    @cached_property
+    def image(self):
+        return base64.b64encode(self.image_bytes).decode('utf-8')
+
+    def summary(self):
+        """Metadatos de la captura (sin imagen ni plantilla)"""
+        return {
+            'seq': self.seq,
+            'timestamp': self.timestamp,
+            'mode': self.mode,
+            'width': self.width,
+            'height': self.height,
+            'template_size': len(self.template_bytes),
+            'quality': self.quality
+        }
+
+    def to_dict(self, include_image=True):
+        data = self.summary()
+        data['template'] = self.template
+        if include_image:
+            data['image'] = self.image
+        return data
+
+
+@dataclass(frozen=True)
+class RegistrationStatus:
+    """Estado publicado del proceso de registro (los campos None no se informan)"""
+    seq: int = 0
+    register_count: Optional[int] = None
+    in_progress: Optional[bool] = None
+    complete: Optional[bool] = None
+    error: Optional[str] = None
+    final_template: Optional[str] = None
+    final_template_size: Optional[int] = None
+    final_templates: Optional[tuple] = None
+    consistency_score: Optional[int] = None
+    samples_required: Optional[int] = None
+    completion_timestamp: Optional[float] = None
+
+    def to_dict(self):
+        fields = {
+            'register_count': self.register_count,
+            'samples_required': self.samples_required,
+            'registration_in_progress': self.in_progress,
+            'registration_complete': self.complete,
+            'registration_error': self.error,
+            'final_template': self.final_template,
+            'final_template_size': self.final_template_size,
+            'final_templates': list(self.final_templates) if self.final_templates else None,
+            'consistency_score': self.consistency_score,
+            'completion_timestamp': self.completion_timestamp
+        }
+        return {key: value for key, value in fields.items() if value is not None}
+
+
+@dataclass(frozen=True)
+class VerificationStatus:
+    """Estado publicado de la verificación de una captura concreta (frame_seq)"""
+    seq: int = 0
+    frame_seq: Optional[int] = None
+    ready: bool = False
+    identification: Optional[dict] = None
+    identification_time_ms: Optional[float] = None
+
+    def to_dict(self):
+        data = {}
+        if self.ready:
+            data['ready_for_verification'] = True
+        if self.identification is not None:
+            data['identification'] = self.identification
+            data['identification_time_ms'] = self.identification_time_ms
+        return data
+
+# ==================== SESIONES DE REGISTRO ====================
+class EnrollmentSession:
+    """Registro de un operador: plantillas, paso de la FSM y estado publicado propios.
+
+    Varias sesiones pueden estar abiertas a la vez; el dispositivo atiende solo a la
+    activa y las demás esperan en cola por orden de apertura (ver ZKTecoDevice).
+    """
+
+    def __init__(self, session_id, label=None, samples=None, store_templates=None):
+        self.session_id = session_id
+        self.label = label
+        self.samples = min(max(int(samples or ENROLLMENT_SAMPLES), 3), ENROLLMENT_MAX_SAMPLES)
+        self.store_templates = max(int(store_templates or ENROLLMENT_STORE_TEMPLATES), 1)
+        self.state = "queued" # queued -> active -> complete | cancelled | expired
+        self.created_at = time.time()
+        self.last_activity = self.created_at
+        self.templates = []
+        self.count = 0
+        self.step = "CAPTURE"
+        self.status = RegistrationStatus()
+
+    @property
+    def finished(self):
+        return self.state in ("complete", "cancelled", "expired")
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def is_stale(self, now):
+        return now - self.last_activity > ENROLLMENT_SESSION_TIMEOUT
+
+    def to_dict(self, queue_position=None, include_template=True):
+        data = {
+            'session_id': self.session_id,
+            'label': self.label,
+            'enrollment_state': self.state,
+            'created_at': self.created_at,
+            'last_activity': self.last_activity,
+            'version': self.status.seq
+        }
+        if queue_position is not None:
+            data['queue_position'] = queue_position
+        data.update(self.status.to_dict())
+        if not include_template:
+            data.pop('final_template', None)
+            data.pop('final_templates', None)
+        return data
+
+# ==================== CACHE DE PARÁMETROS DEL LECTOR ====================
+class DeviceParameterCache:
+    """Geometría, DPI y datos de fabricante de cada lector, indexados por número de serie.
+
+    Se guarda en DEVICE_PARAMS_FILE (JSON) para que una reapertura o un reinicio del
+    servicio con el mismo lector no vuelva a consultar cada parámetro al SDK:
+
+        {"ZK4500-1234": {"width": 300, "height": 400, "dpi": 500,
+                         "vendor": "ZKTeco Inc.", "product": "ZK4500", "updated_at": ...}}
+    """
+
+    def __init__(self, path=DEVICE_PARAMS_FILE):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._entries = {
+                str(serial): params for serial, params in data.items()
+                if isinstance(params, dict) and int(params.get('width', 0)) > 0 and int(params.get('height', 0)) > 0
+            }
+            logger.info(f"Parámetros de {len(self._entries)} lector(es) cargados de {self.path}")
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"No se pudo leer {self.path}: {e} - se consultará al dispositivo")
+
+    def get(self, serial):
+        with self._lock:
+            params = self._entries.get(serial) if serial else None
+            return dict(params) if params else None
+
+    def put(self, serial, params):
+        """Guardar los parámetros de un lector (escritura atómica del archivo)"""
+        if not serial:
+            return
+        with self._lock:
+            self._entries[serial] = {**params, 'updated_at': time.time()}
+            if not self.path:
+                return
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._entries, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"No se pudo guardar {self.path}: {e}")
+
+    def get_status(self):
+        with self._lock:
+            return {'path': self.path, 'devices': sorted(self._entries)}
+
+# ==================== MONITOR DE HOT-PLUG ====================
+class HotplugMonitor:
+    """Sondeo barato de ZKFPM_GetDeviceCount para detectar que el lector se desconectó o volvió.
+
+    No toca el handle del dispositivo: solo publica `present` y marca una reapertura
+    pendiente cuando el lector reaparece. El hilo de captura (dueño del handle mientras
+    captura) hace la reapertura rápida con sus buffers ya creados; sin captura en
+    curso, la reapertura la hace el propio monitor.
+    """
+
+    def __init__(self, device, interval=HOTPLUG_POLL_INTERVAL):
+        self.device = device
+        self.interval = max(interval, 0.05)
+        self.present = None # None = aún no sondeado
+        self.device_count = None
+        self.detached_at = None
+        self.events = deque(maxlen=20)
+        self._reopen_pending = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if not HOTPLUG_MONITOR_ENABLED:
+                return
+            if self._thread and self._thread.is_alive():
+                if not self._stop.is_set():
+                    return
+                self._thread.join(self.interval * 2) # Monitor anterior terminando tras stop()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='hotplug', daemon=True)
+            self._thread.start()
+            logger.info(f"Monitor de hot-plug iniciado (cada {int(self.interval * 1000)} ms)")
+
+    def stop(self):
+        self._stop.set()
+        self.present = None
+        self._reopen_pending.clear()
+
+    def take_reopen(self):
+        """¿Hay una reapertura pendiente? (la consume)"""
+        if self._reopen_pending.is_set():
+            self._reopen_pending.clear()
+            return True
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.debug(f"Error en sondeo de hot-plug: {e}")
+
+    def poll(self):
+        device = self.device
+        if not SDK_AVAILABLE or not device.is_initialized:
+            return
+
+        # Con init/open/close/reconexión en curso el recuento no es confiable y la
+        # llamada se serializaría detrás de ellos: se omite este sondeo
+        if not device._device_lock.acquire(blocking=False):
+            return
+        try:
+            count = zkfp.ZKFPM_GetDeviceCount()
+        finally:
+            device._device_lock.release()
+        self.device_count = count
+        present = count > device.device_index
+        if present == self.present:
+            return
+
+        previous = self.present
+        self.present = present
+        if previous is None:
+            return
+
+        now = time.time()
+        if not present:
+            self.detached_at = now
+            self.events.append({'timestamp': now, 'event': 'detached', 'device_count': count})
+            logger.warning(f"🔌 Lector {device.device_index} desconectado (dispositivos: {count})")
+            return
+
+        self.events.append({'timestamp': now, 'event': 'attached', 'device_count': count})
+        logger.info(f"🔌 Lector {device.device_index} conectado de nuevo - reapertura rápida")
+        if device.is_capturing:
+            self._reopen_pending.set()
+        elif device.device_handle:
+            device._reopen_device()
+
+    def get_status(self):
+        return {
+            'enabled': HOTPLUG_MONITOR_ENABLED,
+            'running': bool(self._thread and self._thread.is_alive()),
+            'interval_ms': int(self.interval * 1000),
+            'present': self.present,
+            'device_count': self.device_count,
+            'detached_at': self.detached_at,
+            'events': list(self.events)
+        }
+
+# ==================== ESTADO DE SALUD DEL LECTOR ====================
+class DeviceHealth:
+    """Salud del lector a partir de la última interacción exitosa con el SDK.
+
+    El hilo de captura registra cada adquisición que el lector contestó (con o sin
+    dedo), así que mientras captura la salud se responde desde memoria. Solo cuando
+    ese dato es más viejo que `max_age` se hace un sondeo activo (GetParameters), y
+    como mucho uno cada HEALTH_PROBE_INTERVAL segundos: un monitor que consulta cada
+    segundo no compite con las adquisiciones por el USB.
+    """
+
+    def __init__(self, device, probe_interval=HEALTH_PROBE_INTERVAL):
+        self.device = device
+        self.probe_interval = probe_interval
+        self.probes = 0
+        self._last_ok = None # time.monotonic() de la última interacción exitosa
+        self._last_ok_source = None
+        self._last_probe = None
+        self._last_probe_ok = None
+        self._last_error = None
+        self._probe_lock = threading.Lock()
+
+    def record_ok(self, source):
+        self._last_ok = time.monotonic()
+        self._last_ok_source = source
+
+    def record_error(self, code):
+        self._last_error = {'code': code, 'timestamp': time.time()}
+
+    def reset(self):
+        self._last_ok = None
+        self._last_ok_source = None
+        self._last_probe = None
+        self._last_probe_ok = None
+
+    def age(self):
+        return time.monotonic() - self._last_ok if self._last_ok is not None else None
+
+    def is_fresh(self, max_age=HEALTH_MAX_AGE):
+        age = self.age()
+        return age is not None and age <= max_age
+
+    def last_known(self):
+        """Último estado observado: True, False o None si todavía no hay ninguno"""
+        if self._last_probe_ok is False and (self._last_ok is None or self._last_ok < self._last_probe):
+            return False
+        return True if self._last_ok is not None else None
+
+    def _probe(self):
+        """Sondeo activo, limitado a uno por probe_interval (los demás usan el último resultado)"""
+        if not self._probe_lock.acquire(blocking=False):
+            # Otro hilo está sondeando: no inventar una desconexión antes de que termine
+            return self.last_known(), 'probe_in_progress'
+        try:
+            now = time.monotonic()
+            if self._last_probe is not None and now - self._last_probe < self.probe_interval:
+                return self._last_probe_ok, 'recent_probe'
+            self._last_probe = now
+            self.probes += 1
+            ok = self.device._verify_device_connection()
+            self._last_probe_ok = ok
+            if ok:
+                self.record_ok('probe')
+            return ok, 'probe'
+        finally:
+            self._probe_lock.release()
+
+    def check(self, max_age=HEALTH_MAX_AGE):
+        """Estado de conexión; sondea el lector solo si la información es más vieja que `max_age`"""
+        device = self.device
+        if not device.device_handle or not SDK_AVAILABLE:
+            connected, source = False, 'closed'
+        elif device.hotplug.present is False:
+            connected, source = False, 'hotplug'
+        elif self.is_fresh(max_age):
+            connected, source = True, 'cached'
+        else:
+            connected, source = self._probe()
+            if connected is not None:
+                connected = bool(connected)
+
+        return {
+            'connected': connected,
+            'source': source,
+            **self.get_status()
+        }
+
+    def get_status(self):
+        age = self.age()
+        return {
+            'age_s': round(age, 3) if age is not None else None,
+            'last_ok_source': self._last_ok_source,
+            'last_error': self._last_error,
+            'probes': self.probes
+        }
+
+# ==================== GRABACIÓN Y REPLAY DE CAPTURAS ====================
+# Registro binario de solo-anexado: CAPTURE_FILE_MAGIC al inicio del archivo y luego
+# registros CAPTURE_RECORD (tipo, instante en s desde el inicio de la sesión, código de
+# retorno, duración de la llamada en us, bytes de template, bytes de imagen comprimida)
+# seguidos del template y de la imagen (zlib). Cada apertura del loop de captura empieza
+# con un registro de sesión cuyo "template" está vacío y cuya "imagen" es JSON sin comprimir.
+CAPTURE_FILE_MAGIC = b'ZKCAP1\n'
+CAPTURE_RECORD = struct.Struct('<BdiIHI')
+CAPTURE_KIND_SESSION = 0
+CAPTURE_KIND_FINGERPRINT = 1 # ZKFPM_AcquireFingerprint (imagen + template)
+CAPTURE_KIND_IMAGE = 2 # ZKFPM_AcquireFingerprintImage (solo imagen)
+
+
+class CaptureRecorder:
+    """Grabación de las adquisiciones de `_capture_loop` para reproducirlas después.
+
+    Se guardan las capturas con dedo, los errores del SDK y el primer "sin dedo"
+    tras cada captura (el flanco que la FSM usa para detectar que se levantó el
+    dedo); los sondeos vacíos repetidos solo se guardan si la llamada tardó más de
+    CAPTURE_RECORD_SLOW_MS, para que un atasco del lector quede registrado sin
+    llenar el disco. La compresión y escritura ocurren en un hilo aparte: el loop
+    de captura solo encola, y si la cola se llena el registro se descarta.
+    """
+
+    def __init__(self, path=CAPTURE_RECORD_FILE, include_images=CAPTURE_RECORD_IMAGES,
+                 slow_call=CAPTURE_RECORD_SLOW_MS / 1000.0):
+        self.path = path
+        self.include_images = include_images
+        self.slow_call = slow_call
+        self.records = 0
+        self.skipped_idle = 0
+        self.dropped = 0
+        self.sessions = 0
+        self._queue = queue.Queue(maxsize=256)
+        self._thread = None
+        self._session_start = None
+        self._last_ret = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def active(self):
+        return self._session_start is not None
+
+    def begin(self, width, height, device_info):
+        """Abrir una sesión de grabación (al iniciar el loop de captura)"""
+        if not self.enabled:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name='capture-recorder', daemon=True)
+            self._thread.start()
+        self._session_start = time.monotonic()
+        self._last_ret = None
+        self.sessions += 1
+        meta = {
+            'width': width,
+            'height': height,
+            'device_info': device_info,
+            'started_at': datetime.now().isoformat(),
+            'images': self.include_images
+        }
+        self._put((CAPTURE_KIND_SESSION, 0.0, 0, 0, b'', json.dumps(meta).encode('utf-8')))
+        logger.info(f"⏺️ Grabando capturas en {self.path}")
+
+    def record(self, kind, ret, duration, template_bytes=b'', image_bytes=b''):
+        """Registrar una adquisición (llamado desde el hilo de captura)"""
+        if self._session_start is None:
+            return
+        idle = ret == ZKFP_ERR_CAPTURE and self._last_ret == ZKFP_ERR_CAPTURE
+        self._last_ret = ret
+        if idle and duration < self.slow_call:
+            self.skipped_idle += 1
+            return
+        self._put((
+            kind,
+            time.monotonic() - self._session_start,
+            ret,
+            min(int(duration * 1e6), 0xFFFFFFFF),
+            template_bytes if ret == ZKFP_ERR_OK else b'',
+            image_bytes if ret == ZKFP_ERR_OK and self.include_images else b''
+        ))
+
+    def end(self):
+        self._session_start = None
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(CAPTURE_FILE_MAGIC)
+            while True:
+                kind, offset, ret, duration_us, template_bytes, payload = self._queue.get()
+                if kind != CAPTURE_KIND_SESSION and payload:
+                    payload = zlib.compress(payload, 1)
+                f.write(CAPTURE_RECORD.pack(kind, offset, ret, duration_us, len(template_bytes), len(payload)))
+                f.write(template_bytes)
+                f.write(payload)
+                self.records += 1
+                if self._queue.empty():
+                    f.flush()
+
+    def get_status(self):
+        return {
+            'enabled': self.enabled,
+            'active': self.active,
+            'path': self.path or None,
+            'images': self.include_images,
+            'sessions': self.sessions,
+            'records': self.records,
+            'skipped_idle': self.skipped_idle,
+            'dropped': self.dropped,
+            'pending': self._queue.qsize()
+        }
+
+
+def read_capture_recording(path):
+    """Leer una grabación: lista de (metadatos de la sesión, [eventos]) en orden"""
+    sessions = []
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_FILE_MAGIC)) != CAPTURE_FILE_MAGIC:
+            raise ValueError(f"{path} no es una grabación de capturas")
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                break # Fin del archivo (o último registro truncado por un corte)
+            kind, offset, ret, duration_us, template_len, payload_len = CAPTURE_RECORD.unpack(header)
+            template_bytes = f.read(template_len)
+            payload = f.read(payload_len)
+            if len(template_bytes) < template_len or len(payload) < payload_len:
+                break
+            if kind == CAPTURE_KIND_SESSION:
+                sessions.append((json.loads(payload.decode('utf-8')), []))
+            elif sessions:
+                sessions[-1][1].append({
+                    'kind': kind,
+                    'offset': offset,
+                    'ret': ret,
+                    'duration': duration_us / 1e6,
+                    'template': template_bytes,
+                    'image': zlib.decompress(payload) if payload else b''
+                })
+    return sessions
+
+
+class ReplaySDK:
+    """Backend de dispositivo que reproduce una grabación de CaptureRecorder.
+
+    Expone las mismas funciones ZKFPM_* que usa ZKTecoDevice, así que todo el
+    pipeline (FSM de registro, presencia, calidad, 1:N) corre sin lector. Las
+    adquisiciones devuelven los eventos grabados cuando llega su instante,
+    escalado por `speed` (1 = tiempo real, 10 = diez veces más rápido, 0 = sin
+    esperas), simulando también la duración original de cada llamada; entre
+    eventos el lector responde "sin dedo". Las funciones de algoritmo (DBInit,
+    DBMatch, GenRegTemplate) se delegan en la DLL real si está disponible; sin
+    ella se usa un comparador exacto de bytes, útil solo para medir el pipeline.
+    """
+
+    HANDLE = 1
+
+    def __init__(self, path, speed=CAPTURE_REPLAY_SPEED, loop=CAPTURE_REPLAY_LOOP, algorithms=None):
+        self.path = path
+        self.speed = max(speed, 0.0)
+        self.loop = loop
+        self.algorithms = algorithms
+        sessions = read_capture_recording(path)
+        if not sessions:
+            raise ValueError(f"La grabación {path} no tiene sesiones")
+        self.meta = sessions[0][0]
+
+        # Una sola línea de tiempo: cada sesión continúa donde terminó la anterior
+        self.events = []
+        base = 0.0
+        for _, events in sessions:
+            for event in events:
+                self.events.append({**event, 'offset': base + event['offset']})
+            if events:
+                base += events[-1]['offset'] + events[-1]['duration']
+        self.replayed = 0
+        self.loops = 0
+        self._position = 0
+        self._clock = None
+        self._lock = threading.Lock()
+        logger.info(f"▶️ Reproduciendo {len(self.events)} eventos de {len(sessions)} sesiones desde {path} "
+                    f"(velocidad {'máxima' if self.speed == 0 else f'x{self.speed:g}'})")
+
+    # --- Dispositivo ---
+    def ZKFPM_Init(self):
+        return ZKFP_ERR_OK
+
+    def ZKFPM_Terminate(self):
+        return ZKFP_ERR_OK
+
+    def ZKFPM_GetDeviceCount(self):
+        return 1
+
+    def ZKFPM_OpenDevice(self, index):
+        return self.HANDLE
+
+    def ZKFPM_CloseDevice(self, handle):
+        return ZKFP_ERR_OK
+
+    def ZKFPM_GetParameters(self, handle, code, buffer, size_ref):
+        info = self.meta.get('device_info') or {}
+        values = {
+            PARAM_CODE_IMAGE_WIDTH: self.meta.get('width'),
+            PARAM_CODE_IMAGE_HEIGHT: self.meta.get('height'),
+            PARAM_CODE_IMAGE_DPI: info.get('dpi'),
+            PARAM_CODE_VENDOR: info.get('vendor'),
+            PARAM_CODE_PRODUCT: info.get('product'),
+            PARAM_CODE_SERIAL: info.get('serial')
+        }
+        value = values.get(code)
+        if value is None:
+            return ZKFP_ERR_NOT_SUPPORT
+        data = value.to_bytes(4, 'little') if isinstance(value, int) else str(value).encode('ascii', 'replace') + b'\x00'
+        size = size_ref._obj
+        count = min(len(data), size.value, len(buffer))
+        ctypes.memmove(buffer, data, count)
+        size.value = count
+        return ZKFP_ERR_OK
+
+    def _next_event(self):
+        """Siguiente evento si ya corresponde (None = el lector responde "sin dedo")"""
+        with self._lock:
+            if self._position >= len(self.events):
+                if not self.loop or not self.events:
+                    return None
+                self._position = 0
+                self._clock = None
+                self.loops += 1
+            event = self.events[self._position]
+            now = time.monotonic()
+            if self._clock is None:
+                self._clock = now - event['offset'] / self.speed if self.speed else now
+            if self.speed and (now - self._clock) * self.speed < event['offset']:
+                return None
+            self._position += 1
+            self.replayed += 1
+            if self._position == len(self.events) and not self.loop:
+                logger.info("⏹️ Grabación reproducida completa: el lector queda sin dedo")
+            return event
+
+    def _acquire(self, image_buffer, image_size, template_buffer=None, template_size_ref=None):
+        event = self._next_event()
+        if event is None:
+            return ZKFP_ERR_CAPTURE
+        if self.speed:
+            time.sleep(event['duration'] / self.speed)
+        if event['ret'] == ZKFP_ERR_OK:
+            image = event['image']
+            ctypes.memmove(image_buffer, image, min(len(image), image_size))
+            if template_buffer is not None:
+                template_size = template_size_ref._obj
+                count = min(len(event['template']), template_size.value)
+                ctypes.memmove(template_buffer, event['template'], count)
+                template_size.value = count
+        return event['ret']
+
+    def ZKFPM_AcquireFingerprint(self, handle, image_buffer, image_size, template_buffer, template_size_ref):
+        return self._acquire(image_buffer, image_size, template_buffer, template_size_ref)
+
+    def ZKFPM_AcquireFingerprintImage(self, handle, image_buffer, image_size):
+        return self._acquire(image_buffer, image_size)
+
+    # --- Algoritmos ---
+    def ZKFPM_DBInit(self):
+        return self.algorithms.ZKFPM_DBInit() if self.algorithms else self.HANDLE
+
+    def ZKFPM_DBFree(self, handle):
+        return self.algorithms.ZKFPM_DBFree(handle) if self.algorithms else ZKFP_ERR_OK
+
+    def ZKFPM_DBMatch(self, handle, template1, size1, template2, size2):
+        if self.algorithms:
+            return self.algorithms.ZKFPM_DBMatch(handle, template1, size1, template2, size2)
+        return 100 if ctypes.string_at(template1, size1) == ctypes.string_at(template2, size2) else 0
+
+    def ZKFPM_GenRegTemplate(self, handle, template1, template2, template3, reg_template, reg_size_ref):
+        if self.algorithms:
+            return self.algorithms.ZKFPM_GenRegTemplate(handle, template1, template2, template3,
+                                                       reg_template, reg_size_ref)
+        reg_size = reg_size_ref._obj
+        count = min(len(template1), reg_size.value)
+        ctypes.memmove(reg_template, template1, count)
+        reg_size.value = count
+        return ZKFP_ERR_OK
+
+    def get_status(self):
+        return {
+            'path': self.path,
+            'speed': self.speed,
+            'loop': self.loop,
+            'events': len(self.events),
+            'position': self._position,
+            'replayed': self.replayed,
+            'loops': self.loops,
+            'algorithms': 'sdk' if self.algorithms else 'exact_bytes'
+        }
+
+# ==================== INSTRUMENTACIÓN DEL SDK Y PERFILADO ====================
+SDK_FUNCTIONS = (
+    'ZKFPM_Init', 'ZKFPM_Terminate', 'ZKFPM_GetDeviceCount', 'ZKFPM_OpenDevice', 'ZKFPM_CloseDevice',
+    'ZKFPM_GetParameters', 'ZKFPM_AcquireFingerprint', 'ZKFPM_AcquireFingerprintImage',
+    'ZKFPM_GenRegTemplate', 'ZKFPM_DBMatch', 'ZKFPM_DBInit', 'ZKFPM_DBFree'
+)
+SDK_HANDLE_FUNCTIONS = ('ZKFPM_OpenDevice', 'ZKFPM_DBInit') # Devuelven un handle (nulo = fallo), no un código
+SDK_LATENCY_BUCKETS_US = (10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+                          100000, 200000, 500000, 1000000, 2000000, 5000000)
+
+
+class SDKCallStats:
+    """Conteo, histograma de latencia y códigos de retorno de una función del SDK"""
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.exceptions = 0
+        self.buckets = [0] * (len(SDK_LATENCY_BUCKETS_US) + 1) # El último cubre lo que excede el mayor límite
+        self.codes = {}
+        self._lock = threading.Lock()
+
+    def add(self, elapsed, code):
+        with self._lock:
+            self.calls += 1
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+            self.buckets[bisect.bisect_left(SDK_LATENCY_BUCKETS_US, elapsed * 1e6)] += 1
+            if code is not None:
+                self.codes[code] = self.codes.get(code, 0) + 1
+
+    def add_exception(self, elapsed):
+        with self._lock:
+            self.exceptions += 1
+        self.add(elapsed, None)
+
+    def percentile(self, p):
+        """Límite superior (us) del bucket que contiene el percentil p"""
+        target = self.calls * p / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return SDK_LATENCY_BUCKETS_US[index] if index < len(SDK_LATENCY_BUCKETS_US) else None
+        return None
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'mean_us': round(self.total / self.calls * 1e6, 1) if self.calls else None,
+                'max_us': round(self.max * 1e6, 1),
+                'p50_us': self.percentile(50),
+                'p99_us': self.percentile(99),
+                'exceptions': self.exceptions,
+                'histogram_us': {
+                    (f"<={bound}" if index < len(SDK_LATENCY_BUCKETS_US) else f">{SDK_LATENCY_BUCKETS_US[-1]}"): count
+                    for index, (bound, count) in enumerate(zip(SDK_LATENCY_BUCKETS_US + (None,), self.buckets))
+                    if count
+                },
+                'codes': {SDK_ERROR_NAMES.get(code, str(code)): count for code, count in self.codes.items()}
+            }
+
+
+class InstrumentedSDK:
+    """Capa de llamadas al SDK con medición por función.
+
+    Envuelve el backend (DLL o ReplaySDK): cada función ZKFPM_* queda como
+    atributo propio, medido o directo según `enabled`. Desactivado, el atributo
+    es la función original del backend, así que el costo es el de siempre (una
+    búsqueda de atributo); activado se agregan dos perf_counter y un bloqueo por
+    llamada. Los códigos negativos (y los handles nulos) se contabilizan por
+    código; un score de DBMatch no es un código y no se cuenta.
+    """
+
+    def __init__(self, library, enabled=SDK_CALL_STATS):
+        self.library = library
+        self.stats = {}
+        self.started = time.time()
+        self._raw = {name: getattr(library, name) for name in SDK_FUNCTIONS if hasattr(library, name)}
+        self.set_enabled(enabled)
+
+    def __getattr__(self, name):
+        # Atributos del backend que no son funciones medidas (p. ej. get_status del replay)
+        return getattr(self.library, name)
+
+    def _wrap(self, name, func):
+        stats = self.stats.setdefault(name, SDKCallStats())
+        handle_result = name in SDK_HANDLE_FUNCTIONS
+
+        def call(*args):
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception:
+                stats.add_exception(time.perf_counter() - start)
+                raise
+            elapsed = time.perf_counter() - start
+            if handle_result:
+                stats.add(elapsed, None if result else 'null')
+            else:
+                stats.add(elapsed, result if isinstance(result, int) and result < 0 else None)
+            return result
+
+        return call
+
+    def set_enabled(self, enabled):
+        self.enabled = bool(enabled)
+        for name, func in self._raw.items():
+            setattr(self, name, self._wrap(name, func) if self.enabled else func)
+
+    def reset(self):
+        self.stats = {}
+        self.started = time.time()
+        self.set_enabled(self.enabled)
+
+    def get_status(self):
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.library).__name__,
+            'since': self.started,
+            'functions': {name: stats.to_dict() for name, stats in sorted(self.stats.items()) if stats.calls}
+        }
+
+
+class SamplingProfiler:
+    """Perfil de muestreo bajo demanda de los hilos del servicio.
+
+    Durante `seconds` toma cada `interval` la pila de los hilos seleccionados
+    (sys._current_frames) y cuenta las pilas repetidas. Sin un perfil en curso no
+    hay ningún costo; durante el perfil solo el hilo de muestreo trabaja. El
+    resultado incluye las funciones con más muestras y las pilas en formato
+    "collapsed" (hilo;f1;f2 N), compatible con flamegraph.pl y speedscope.
+    """
+
+    def __init__(self):
+        self.last = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _label(frame):
+        code = frame.f_code
+        return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+    def run(self, seconds=5.0, interval=PROFILE_INTERVAL, threads=None, top=20):
+        """Muestrear (bloquea `seconds`). `threads`: subcadenas de nombres de hilo (None = todos)"""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            seconds = min(max(float(seconds), 0.1), PROFILE_MAX_SECONDS)
+            interval = max(float(interval), 0.001)
+            me = threading.get_ident()
+            stacks = {}
+            samples = 0
+            started = time.monotonic()
+            deadline = started + seconds
+
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    name = names.get(ident, str(ident))
+                    if ident == me or (threads and not any(t in name for t in threads)):
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame))
+                        frame = frame.f_back
+                    key = (name, tuple(reversed(stack)))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
 
-    # Constantes del SDK
-    ZKFP_ERR_OK = 0
-    ZKFP_ERR_INITLIB = -1
-    ZKFP_ERR_INIT = -2
-    ZKFP_ERR_NO_DEVICE = -3
-    ZKFP_ERR_NOT_SUPPORT = -4
-    ZKFP_ERR_INVALID_PARAM = -5
-    ZKFP_ERR_OPEN = -6
-    ZKFP_ERR_INVALID_HANDLE = -7
-    ZKFP_ERR_CAPTURE = -8
-    ZKFP_ERR_EXTRACT_FP = -9
-    ZKFP_ERR_ABSORT = -10
-    ZKFP_ERR_MEMORY_NOT_ENOUGH = -11
-    ZKFP_ERR_BUSY = -12
-    ZKFP_ERR_ADD_FINGER = -13
-    ZKFP_ERR_DEL_FINGER = -14
-    ZKFP_ERR_FAIL = -17
-    ZKFP_ERR_CANCEL = -18
-    ZKFP_ERR_VERIFY_FP = -20
-    ZKFP_ERR_MERGE = -22
-    ZKFP_ERR_NOT_OPENED = -23
-    ZKFP_ERR_NOT_INIT = -24
-    ZKFP_ERR_ALREADY_INIT = -25
-    ZKFP_ERR_LOADIMAGE = -26
-    ZKFP_ERR_ANALYZE_FP = -27
-    
-    # Códigos de parámetros
-    PARAM_CODE_IMAGE_WIDTH = 1
-    PARAM_CODE_IMAGE_HEIGHT = 2
-    
-    SDK_AVAILABLE = True
-    logger.info("SDK de ZKTeco cargado correctamente con prototipos seguros")
-    
-except Exception as e:
-    SDK_AVAILABLE = False
-    logger.error(f"Error crítico al cargar SDK: {e}")
-    logger.warning("El servicio funcionará en modo simulación")
+            per_thread = {}
+            own = {}
+            total = {}
+            for (name, stack), count in stacks.items():
+                per_thread[name] = per_thread.get(name, 0) + count
+                own[stack[-1]] = own.get(stack[-1], 0) + count
+                for label in set(stack):
+                    total[label] = total.get(label, 0) + count
 
-# ==================== CONFIGURACIÓN DE LA APLICACIÓN ====================
-# MODIFIQUE ESTA URL A SU ENTORNO REAL si la API no está en localhost
-PHP_API_URL = "http://localhost/fingerprint/api.php" 
-MATCH_THRESHOLD = 60 # Umbral de coincidencia (60 es un valor típico de ZKTeco)
+            self.last = {
+                'started_at': datetime.now().isoformat(),
+                'duration': round(time.monotonic() - started, 3),
+                'interval_ms': round(interval * 1000, 2),
+                'samples': samples,
+                'threads': per_thread,
+                'top_functions': [
+                    {'function': label, 'self': count, 'total': total[label]}
+                    for label, count in heapq.nlargest(top, own.items(), key=lambda item: item[1])
+                ],
+                'collapsed': [
+                    f"{name};{';'.join(stack)} {count}"
+                    for (name, stack), count in sorted(stacks.items(), key=lambda item: -item[1])
+                ]
+            }
+            return self.last
+        finally:
+            self._lock.release()
 
-# ==================== CONFIGURACIÓN FLASK ====================
-app = Flask(__name__)
-CORS(app)
+    @property
+    def running(self):
+        return self._lock.locked()
+
+
+def replay_status():
+    """Estado del backend de replay si el lector es una grabación (None si es la DLL real)"""
+    backend = getattr(zkfp, 'library', zkfp)
+    return backend.get_status() if isinstance(backend, ReplaySDK) else None
 
 # ==================== CLASE ZKTecoDevice COMPLETAMENTE CORREGIDA ====================
 class ZKTecoDevice:
@@ -204,20 +2149,92 @@ class ZKTecoDevice:
 
     def __init__(self):
         self.device_handle = None
+        self.device_index = 0
         self.db_handle = None        
         self.capture_thread = None
         self.is_capturing = False
-        self.width = 300  # Valores por defecto
-        self.height = 400
-        self.last_capture = {}  # Inicializado como dict vacío
-        self.register_count = 0
-        self.register_templates = []
+        self.width = DEFAULT_IMAGE_WIDTH  # Valores por defecto
+        self.height = DEFAULT_IMAGE_HEIGHT
+        self.device_info = {} # serial, dpi, vendor, product y origen de los parámetros
+        self.param_cache = DeviceParameterCache()
+        # Capturas publicadas como registros inmutables (ver CaptureFrame)
+        self.latest_frame = None
+        self.frame_history = deque(maxlen=CAPTURE_HISTORY_SIZE)
+        self.verification_status = VerificationStatus()
+        self._seq = itertools.count(1)
+        # Sesiones de registro (session_id -> EnrollmentSession). La FSM trabaja siempre sobre
+        # la sesión que tiene el sensor; sin sesión activa se usa una sesión de reposo.
+        self.enrollments = OrderedDict()
+        self._enrollment = None
+        self._idle_enrollment = EnrollmentSession("idle")
         self.current_mode = "idle"
         self.is_initialized = False
-        self._lock = threading.Lock()
-        self.register_step = "CAPTURE" # Estado para la FSM de registro        
+        # Dominios de sincronización independientes (orden de adquisición: device -> db):
+        # - _device_lock: E/S del SDK sobre el dispositivo (init, open, close, reconexión). Reentrante,
+        #   porque la reconexión reutiliza initialize()/open_device().
+        # - _db_lock: handle de algoritmos (DBMatch, GenRegTemplate, DBInit/DBFree).
+        # - _registration_lock: sesiones de registro, estado de la FSM y su registro publicado.
+        #   No se toma _db_lock con él tomado: las comparaciones del registro se hacen fuera.
+        # La galería de plantillas tiene su propio lock (TemplateGallery).
+        self._device_lock = threading.RLock()
+        self._db_lock = threading.Lock()
+        self._registration_lock = threading.RLock()
+        self.auto_identify = False # Identificación 1:N dentro del loop de captura (modo verifying)
+        self.verify_step = "CAPTURE" # Estado de la pulsación en verificación automática
+        self._capture_listeners = [] # Callbacks notificados con cada nueva captura (push streams)
+        self.gallery = TemplateGallery()
+        self.match_cache = MatchResultCache()
+        self.prefilter = TemplatePrefilter()
+        self.score_recorder = ScoreRecorder()
+        self.access_log = AccessLogBuffer()
+        self.threshold_policy = ThresholdPolicy()
+        try:
+            self.threshold_policy.load()
+        except Exception as e:
+            logger.error(f"Error al cargar política de umbrales ({THRESHOLD_POLICY_FILE}): {e} - usando {MATCH_THRESHOLD}")
+        self._match_slots = threading.BoundedSemaphore(max(1, MATCH_CONCURRENCY))
+        self.hotplug = HotplugMonitor(self)
+        self.health = DeviceHealth(self)
+        self.capture_recorder = CaptureRecorder()
         logger.info("Instancia de ZKTecoDevice creada correctamente")
 
+    # Estado de la FSM de registro: siempre el de la sesión que tiene el sensor
+    @property
+    def _current_enrollment(self):
+        return self._enrollment or self._idle_enrollment
+
+    @property
+    def register_templates(self):
+        return self._current_enrollment.templates
+
+    @register_templates.setter
+    def register_templates(self, value):
+        self._current_enrollment.templates = value
+
+    @property
+    def register_count(self):
+        return self._current_enrollment.count
+
+    @register_count.setter
+    def register_count(self, value):
+        self._current_enrollment.count = value
+
+    @property
+    def register_step(self):
+        return self._current_enrollment.step
+
+    @register_step.setter
+    def register_step(self, value):
+        self._current_enrollment.step = value
+
+    @property
+    def registration_status(self):
+        return self._current_enrollment.status
+
+    @registration_status.setter
+    def registration_status(self, value):
+        self._current_enrollment.status = value
+
     # Métodos privados (con _)
     def _get_error_message(self, error_code):
         """Convertir código de error a mensaje legible"""
@@ -272,6 +2289,124 @@ class ZKTecoDevice:
             logger.debug(f"Error en verificación de conexión: {e}")
             return False
     
+    def _get_parameter(self, code, size=4):
+        """Leer un parámetro del lector (bytes, o None si el SDK lo rechaza)"""
+        param_buffer = (ctypes.c_ubyte * size)()
+        param_size = ctypes.c_int(size)
+        try:
+            ret = zkfp.ZKFPM_GetParameters(self.device_handle, code, param_buffer, ctypes.byref(param_size))
+        except Exception as e:
+            logger.debug(f"Error al leer parámetro {code}: {e}")
+            return None
+        if ret != ZKFP_ERR_OK:
+            return None
+        return bytes(param_buffer[:max(0, min(param_size.value, size))])
+
+    def _get_int_parameter(self, code):
+        value = self._get_parameter(code)
+        return int.from_bytes(value[:4], byteorder='little') if value and len(value) >= 4 else None
+
+    def _get_text_parameter(self, code):
+        value = self._get_parameter(code, 64)
+        if not value:
+            return None
+        return value.split(b'\x00', 1)[0].decode('ascii', errors='replace').strip() or None
+
+    def _load_device_parameters(self):
+        """Geometría e información del lector abierto: de la cache por número de serie o del SDK.
+
+        Con la serie ya conocida solo se hace una llamada (la lectura de la serie);
+        un lector nuevo se consulta completo y se guarda en DEVICE_PARAMS_FILE.
+        Devuelve True si el lector es el mismo que estaba abierto antes.
+        """
+        serial = self._get_text_parameter(PARAM_CODE_SERIAL)
+        same_reader = bool(serial) and serial == self.device_info.get('serial')
+        cached = self.param_cache.get(serial)
+
+        if cached:
+            params, source = cached, 'cache'
+        else:
+            width = self._get_int_parameter(PARAM_CODE_IMAGE_WIDTH)
+            height = self._get_int_parameter(PARAM_CODE_IMAGE_HEIGHT)
+            params = {
+                'width': width or DEFAULT_IMAGE_WIDTH,
+                'height': height or DEFAULT_IMAGE_HEIGHT,
+                'dpi': self._get_int_parameter(PARAM_CODE_IMAGE_DPI),
+                'vendor': self._get_text_parameter(PARAM_CODE_VENDOR),
+                'product': self._get_text_parameter(PARAM_CODE_PRODUCT)
+            }
+            source = 'device'
+            if width and height:
+                self.param_cache.put(serial, params)
+            else:
+                source = 'default'
+                logger.warning(f"No se pudo obtener la geometría, usando valores por defecto: "
+                               f"{DEFAULT_IMAGE_WIDTH}x{DEFAULT_IMAGE_HEIGHT}")
+
+        self.width = int(params['width'])
+        self.height = int(params['height'])
+        self.device_info = {
+            'serial': serial,
+            'dpi': params.get('dpi'),
+            'vendor': params.get('vendor'),
+            'product': params.get('product'),
+            'params_source': source
+        }
+        return same_reader
+
+    def _reopen_device(self):
+        """Reabrir solo el handle del lector, sin ZKFPM_Terminate/Init ni esperas fijas.
+
+        Si el número de serie coincide se conserva la geometría ya conocida, así que el
+        hilo de captura sigue con sus buffers; otro lector toma la suya de la cache de
+        parámetros. Devuelve False si el lector no responde (ver _recover_device).
+        """
+        if not SDK_AVAILABLE or not self.is_initialized:
+            return False
+
+        start = time.perf_counter()
+        with self._device_lock:
+            old_handle, self.device_handle = self.device_handle, None
+            if old_handle:
+                try:
+                    zkfp.ZKFPM_CloseDevice(old_handle)
+                except Exception as e:
+                    logger.debug(f"Error al cerrar el handle anterior: {e}")
+
+            try:
+                handle = zkfp.ZKFPM_OpenDevice(self.device_index)
+            except Exception as e:
+                logger.warning(f"⚠️ Reapertura rápida fallida: {e}")
+                return False
+            if not handle:
+                logger.warning("⚠️ Reapertura rápida fallida: handle inválido")
+                return False
+
+            self.device_handle = handle
+            if not self._verify_device_connection():
+                logger.warning("⚠️ Reapertura rápida fallida: el lector no responde")
+                try:
+                    zkfp.ZKFPM_CloseDevice(handle)
+                except Exception:
+                    pass
+                self.device_handle = None
+                return False
+
+            previous_serial = self.device_info.get('serial')
+            if not self._load_device_parameters():
+                logger.info(f"Lector distinto tras la reapertura ({previous_serial} -> {self.device_info.get('serial')}): "
+                            f"{self.width}x{self.height}")
+
+        logger.info(f"✅ Lector reabierto en {(time.perf_counter() - start) * 1000:.0f} ms (sin reiniciar el SDK)")
+        return True
+
+    def _recover_device(self):
+        """Recuperar el lector: reapertura rápida y, si no alcanza, reconexión completa"""
+        if self.hotplug.present is False:
+            logger.info("Lector ausente según el monitor de hot-plug - esperando reconexión")
+            return False
+        return self._reopen_device() or self._reconnect_device()
+
     def _reconnect_device(self):
         """Reconectar dispositivo automáticamente - VERSIÓN MEJORADA Y CORREGIDA DEADLOCK"""
         try:
@@ -307,22 +2442,23 @@ class ZKTecoDevice:
             else:
                 logger.warning("🔧 Omitiendo espera de thread (auto-llamada).")
             
-            with self._lock:
+            with self._device_lock:
                 # ✅ MEJORA: Cerrar dispositivo de forma más segura
                 # --- INICIO DE CORRECCIÓN ---
                 # Liberar DB Handle antes de Terminate
-                if self.db_handle and SDK_AVAILABLE:
-                    try:
-                        logger.info("🔒 Liberando cache de algoritmos (db_handle)...")
-                        ret = zkfp.ZKFPM_DBFree(self.db_handle)
-                        if ret == ZKFP_ERR_OK:
-                            logger.info("✅ db_handle liberado correctamente")
-                        else:
-                            logger.warning(f"⚠️ Código al liberar db_handle: {ret}")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Error al liberar db_handle: {e}")
-                    finally:
-                        self.db_handle = None
+                with self._db_lock:
+                    if self.db_handle and SDK_AVAILABLE:
+                        try:
+                            logger.info("🔒 Liberando cache de algoritmos (db_handle)...")
+                            ret = zkfp.ZKFPM_DBFree(self.db_handle)
+                            if ret == ZKFP_ERR_OK:
+                                logger.info("✅ db_handle liberado correctamente")
+                            else:
+                                logger.warning(f"⚠️ Código al liberar db_handle: {ret}")
+                        except Exception as e:
+                            logger.warning(f"⚠️ Error al liberar db_handle: {e}")
+                        finally:
+                            self.db_handle = None
                 # --- FIN DE CORRECCIÓN ---
                 
                 # ✅ MEJORA: Terminar SDK de forma controlada
@@ -406,7 +2542,10 @@ class ZKTecoDevice:
             self.is_capturing = False
             return
         
+        self.capture_recorder.begin(self.width, self.height, dict(self.device_info))
+        
         consecutive_errors = 0
+        empty_frames = 0 # Cuadros seguidos sin dedo según el detector, esperando el levantamiento
         max_consecutive_errors = 5
         connection_check_interval = 10
         capture_count = 0
@@ -415,22 +2554,36 @@ class ZKTecoDevice:
             while self.is_capturing:
                 try:
                     # Verificación periódica de conexión
+                    # Lector desenchufado: no insistir con el handle viejo hasta que vuelva
+                    if self.hotplug.present is False:
+                        time.sleep(self.hotplug.interval)
+                        continue
+                    
+                    # Reaparecido: reapertura rápida reutilizando los buffers actuales
+                    if self.hotplug.take_reopen():
+                        capture_count = 0
+                        consecutive_errors = 0
+                        if not self._recover_device():
+                            logger.error("No se pudo reabrir el lector - deteniendo captura")
+                            break
+                        if self.width * self.height != image_buffer_size:
+                            image_buffer_size = self.width * self.height
+                            image_buffer = (ctypes.c_ubyte * image_buffer_size)()
+                    
+                    # Sondeo explícito solo si el lector lleva un rato sin contestar adquisiciones
                     capture_count += 1
-                    if capture_count >= connection_check_interval:
+                    if capture_count >= connection_check_interval and not self.health.is_fresh():
                         capture_count = 0
                         if not self._verify_device_connection():
+                            if self.hotplug.present is False:
+                                continue # El monitor ya lo vio: esperar a que vuelva
                             logger.warning("Dispositivo desconectado durante captura - intentando reconexión")
-                            if self._reconnect_device():
+                            if self._recover_device():
                                 logger.info("Reconexión exitosa - continuando captura")
-                                # Recrear buffers después de reconexión
-                                try:
+                                # Los buffers solo se recrean si la geometría cambió (otro lector)
+                                if self.width * self.height != image_buffer_size:
                                     image_buffer_size = self.width * self.height
                                     image_buffer = (ctypes.c_ubyte * image_buffer_size)()
-                                    template_buffer = (ctypes.c_ubyte * 2048)()
-                                    template_size = ctypes.c_int(2048)
-                                except Exception as e:
-                                    logger.error(f"Error al recrear buffers: {e}")
-                                    break
                             else:
                                 logger.error("No se pudo reconectar - deteniendo captura")
                                 break
@@ -443,22 +2596,78 @@ class ZKTecoDevice:
                         logger.error("Handle perdido durante captura")
                         break
                     
-                    template_size.value = 2048
+                    if self.current_mode == "registering":
+                        self._expire_enrollments()
                     
-                    # Capturar huella
-                    ret = zkfp.ZKFPM_AcquireFingerprint(
-                        self.device_handle,
-                        image_buffer,
-                        image_buffer_size,
-                        template_buffer,
-                        ctypes.byref(template_size)
+                    # Mientras se espera que levante el dedo no hace falta extraer template:
+                    # basta la imagen para que el detector de presencia decida
+                    lift_watch = (
+                        self.register_step == "WAIT_FOR_LIFT"
+                        if self.current_mode == "registering"
+                        else self.verify_step == "WAIT_FOR_LIFT"
                     )
                     
+                    acquire_start = time.perf_counter()
+                    if lift_watch and ACQUIRE_IMAGE_AVAILABLE:
+                        capture_kind = CAPTURE_KIND_IMAGE
+                        ret = zkfp.ZKFPM_AcquireFingerprintImage(
+                            self.device_handle,
+                            image_buffer,
+                            image_buffer_size
+                        )
+                    else:
+                        capture_kind = CAPTURE_KIND_FINGERPRINT
+                        template_size.value = 2048
+                        
+                        # Capturar huella
+                        ret = zkfp.ZKFPM_AcquireFingerprint(
+                            self.device_handle,
+                            image_buffer,
+                            image_buffer_size,
+                            template_buffer,
+                            ctypes.byref(template_size)
+                        )
+                    
+                    if self.capture_recorder.active:
+                        ok = ret == ZKFP_ERR_OK
+                        self.capture_recorder.record(
+                            capture_kind,
+                            ret,
+                            time.perf_counter() - acquire_start,
+                            ctypes.string_at(template_buffer, template_size.value)
+                            if ok and capture_kind == CAPTURE_KIND_FINGERPRINT else b'',
+                            ctypes.string_at(image_buffer, image_buffer_size) if ok else b''
+                        )
+                    
+                    # Cualquier respuesta normal del lector (con o sin dedo) cuenta como contacto exitoso
+                    if ret == ZKFP_ERR_OK or ret == ZKFP_ERR_CAPTURE:
+                        self.health.record_ok('capture')
+                    else:
+                        self.health.record_error(ret)
+                    
+                    # El SDK solo informa ZKFP_ERR_CAPTURE cuando el sensor ya está vacío en su
+                    # propio ciclo; el detector lo adelanta, pero un apoyo leve o parcial también
+                    # se ve "vacío": se exigen LIFT_EMPTY_FRAMES cuadros vacíos seguidos para no
+                    # tomar el mismo toque como una muestra nueva
+                    if (lift_watch and ret == ZKFP_ERR_OK and PRESENCE_DETECTION_ENABLED and
+                            detect_finger_presence(image_buffer, self.width, self.height) is False):
+                        empty_frames += 1
+                    else:
+                        empty_frames = 0
+                    finger_lifted = ret == ZKFP_ERR_CAPTURE or empty_frames >= LIFT_EMPTY_FRAMES
+                    if finger_lifted:
+                        empty_frames = 0
+                    
                     # =================== INICIO DE FSM DE REGISTRO ===================
                     
                     # Manejo de estado para MODO REGISTRO
                     if self.current_mode == "registering":
                         
+                        # Toda lectura con dedo cuenta como actividad del operador, aunque
+                        # después se rechace por calidad o por duplicada
+                        if ret == ZKFP_ERR_OK:
+                            self._touch_enrollment()
+                        
                         # --- ESTADO 1: ESPERANDO DEDO ---
                         if self.register_step == "CAPTURE":
                             if ret == ZKFP_ERR_OK:
@@ -468,34 +2677,41 @@ class ZKTecoDevice:
                                 template_bytes = bytes(template_buffer[:template_size.value])
                                 image_bytes = bytes(image_buffer[:image_buffer_size])
                                 
-                                self.last_capture = {
-                                    'template': base64.b64encode(template_bytes).decode('utf-8'),
-                                    'image': base64.b64encode(image_bytes).decode('utf-8'),
-                                    'timestamp': time.time(),
-                                    'width': self.width, 'height': self.height,
-                                    'template_size': template_size.value
-                                }
-                                
-                                # Procesar el registro (usando la función que ya teníamos)
-                                registration_complete = self._process_registration(template_bytes)
+                                frame = self._publish_frame(template_bytes, image_bytes)
                                 
-                                if registration_complete:
-                                    logger.info("Registro completado, deteniendo loop de captura...")
-                                    self.is_capturing = False # Flag para detener
-                                    break # Salir del 'while'
+                                # Rechazo temprano: una muestra pobre no llega a GenRegTemplate
+                                if frame.quality is not None and not frame.quality['acceptable']:
+                                    logger.info(f"Muestra rechazada por calidad ({frame.quality['score']}/100): {frame.quality['reason']}")
+                                    self.register_step = "WAIT_FOR_LIFT"
+                                    self._update_registration(
+                                        error=f"Calidad insuficiente ({frame.quality['score']}/100). {frame.quality['reason']}"
+                                    )
+                                    self._publish_capture()
                                 
-                                # Si no está completo, cambiar de estado
-                                self.register_step = "WAIT_FOR_LIFT"
-                                if self.last_capture:
-                                    self.last_capture['registration_error'] = "¡Bien! Ahora levante el dedo."
-                                logger.info(f"Captura {self.register_count}/3. Cambiando a estado 'WAIT_FOR_LIFT'")
+                                else:
+                                    # Procesar el registro (usando la función que ya teníamos)
+                                    registration_complete = self._process_registration(template_bytes)
+                                    
+                                    if registration_complete:
+                                        self._publish_capture()
+                                        if self._complete_enrollment():
+                                            # Otra sesión en cola tomó el sensor: seguir capturando para ella
+                                            time.sleep(CAPTURE_INTERVAL)
+                                            continue
+                                        logger.info("Registro completado, deteniendo loop de captura...")
+                                        self.is_capturing = False # Flag para detener
+                                        break # Salir del 'while'
+                                    
+                                    # Si no está completo, cambiar de estado
+                                    self.register_step = "WAIT_FOR_LIFT"
+                                    self._update_registration(error="¡Bien! Ahora levante el dedo.")
+                                    logger.info(f"Captura {self.register_count}/{self._current_enrollment.samples}. Cambiando a estado 'WAIT_FOR_LIFT'")
+                                    self._publish_capture()
                             
                             elif ret == ZKFP_ERR_CAPTURE:
                                 # Normal, esperando dedo
                                 consecutive_errors = 0
-                                if self.last_capture:
-                                    self.last_capture.pop('registration_error', None)
-                                pass
+                                self._update_registration(error=None)
                             
                             else:
                                 # Otro error
@@ -505,19 +2721,18 @@ class ZKTecoDevice:
                         
                         # --- ESTADO 2: ESPERANDO QUE LEVANTE EL DEDO ---
                         elif self.register_step == "WAIT_FOR_LIFT":
-                            if ret == ZKFP_ERR_OK:
-                                # El dedo SIGUE puesto. Ignorar.
-                                consecutive_errors = 0
-                                pass 
-                            
-                            elif ret == ZKFP_ERR_CAPTURE:
-                                # ¡Dedo levantado! (Error -8) 
+                            if finger_lifted:
+                                # ¡Dedo levantado! (Error -8 o sensor vacío según el detector)
                                 consecutive_errors = 0
                                 # Volver al estado de captura para la siguiente huella
                                 self.register_step = "CAPTURE"
-                                if self.last_capture:
-                                    self.last_capture.pop('registration_error', None)
+                                self._update_registration(error=None)
                                 logger.info("Dedo levantado. Cambiando a estado 'CAPTURE'")
+                                self._publish_capture()
+                            
+                            elif ret == ZKFP_ERR_OK:
+                                # El dedo SIGUE puesto. Ignorar.
+                                consecutive_errors = 0
                             
                             else:
                                 # Otro error
@@ -526,29 +2741,30 @@ class ZKTecoDevice:
 
                     # Manejo de estado para OTROS MODOS (verifying, idle)
                     else:
-                        if ret == ZKFP_ERR_OK:
+                        if finger_lifted:
                             consecutive_errors = 0
-                            try:
-                                template_bytes = bytes(template_buffer[:template_size.value])
-                                image_bytes = bytes(image_buffer[:image_buffer_size])
-                                
-                                self.last_capture = {
-                                    'template': base64.b64encode(template_bytes).decode('utf-8'),
-                                    'image': base64.b64encode(image_bytes).decode('utf-8'),
-                                    'timestamp': time.time(),
-                                    'width': self.width, 'height': self.height,
-                                    'template_size': template_size.value
-                                }
-                                
-                                if self.current_mode == "verifying":
-                                    self._process_verification(template_bytes)
-                                
-                            except Exception as e:
-                                logger.error(f"Error al procesar captura (modo no-registro): {e}")
-                            
-                        elif ret == ZKFP_ERR_CAPTURE:
+                            # Dedo levantado: la próxima pulsación se vuelve a identificar
+                            self.verify_step = "CAPTURE"
+                        
+                        elif ret == ZKFP_ERR_OK:
                             consecutive_errors = 0
-                            pass
+                            if self.verify_step == "WAIT_FOR_LIFT":
+                                # Esta pulsación ya fue identificada: conservar el resultado publicado
+                                pass
+                            else:
+                                try:
+                                    template_bytes = bytes(template_buffer[:template_size.value])
+                                    image_bytes = bytes(image_buffer[:image_buffer_size])
+                                    
+                                    self._publish_frame(template_bytes, image_bytes)
+                                    
+                                    if self.current_mode == "verifying":
+                                        self._process_verification(template_bytes)
+                                    
+                                    self._publish_capture()
+                                    
+                                except Exception as e:
+                                    logger.error(f"Error al procesar captura (modo no-registro): {e}")
                         
                         else:
                             # ESTA ES LA LÓGICA DE MANEJO DE ERRORES (copiarla arriba también)
@@ -561,16 +2777,23 @@ class ZKTecoDevice:
                             if consecutive_errors >= max_consecutive_errors:
                                 logger.error(f"Demasiados errores consecutivos ({consecutive_errors}), verificando conexión")
                                 if not self._verify_device_connection():
+                                    if self.hotplug.present is False:
+                                        consecutive_errors = 0
+                                        continue # Desenchufado: esperar al monitor de hot-plug
                                     logger.warning("Problema de conexión detectado - intentando reconexión")
-                                    if self._reconnect_device():
+                                    if self._recover_device():
                                         consecutive_errors = 0
+                                        if self.width * self.height != image_buffer_size:
+                                            image_buffer_size = self.width * self.height
+                                            image_buffer = (ctypes.c_ubyte * image_buffer_size)()
                                         continue
                                 logger.error("No se pudo resolver el problema - deteniendo captura")
                                 break
                     
                     # =================== FIN DE FSM DE REGISTRO ===================
                     
-                    time.sleep(0.1)
+                    # Sondeo más rápido mientras se espera el levantamiento, para no perder retoques
+                    time.sleep(LIFT_POLL_INTERVAL if lift_watch else CAPTURE_INTERVAL)
                     
                 except Exception as e:
                     consecutive_errors += 1
@@ -588,6 +2811,7 @@ class ZKTecoDevice:
         finally:
             # Asegurarse de que el flag esté desactivado
             self.is_capturing = False
+            self.capture_recorder.end()
             logger.info("Loop de captura finalizado")
 
     def _process_registration(self, template):
@@ -596,18 +2820,21 @@ class ZKTecoDevice:
             if self.current_mode != "registering":
                 return False # No detener el loop
             
-            if not self._verify_device_connection():
+            if self.health.check()['connected'] is False:
                 logger.error("❌ Dispositivo desconectado al procesar registro")
-                if self._reconnect_device():
+                # Reapertura rápida del handle (hot-plug); reconexión completa solo si no alcanza
+                if self._recover_device():
                     logger.info("✅ Reconexión exitosa - continuando registro")
                 else:
                     logger.error("❌ No se pudo reconectar - abortando registro")
                     self._reset_registration_state()
                     return True # Detener el loop por error crítico
             
+            required = self._current_enrollment.samples
+            
             # Evitar acumulación de plantillas
-            if self.register_count >= 3:
-                logger.warning("⚠️ Ya se tienen 3 plantillas, ignorando captura adicional")
+            if self.register_count >= required:
+                logger.warning(f"⚠️ Ya se tienen {required} plantillas, ignorando captura adicional")
                 return False # No detener el loop
 
             # =================== INICIO DE CORRECCIÓN (Intento 2) ===================
@@ -618,40 +2845,41 @@ class ZKTecoDevice:
                 logger.warning(f"⚠️ Plantilla duplicada exacta detectada. Por favor, levante el dedo y colóquelo de nuevo.")
                 
                 # Informar al frontend del error
-                if self.last_capture:
-                    self.last_capture['registration_error'] = "Huella duplicada. Levante el dedo e intente de nuevo"
+                self._update_registration(error="Huella duplicada. Levante el dedo e intente de nuevo")
                 
                 return False # No agregar esta huella, no detener el loop
 
             # Si llegamos aquí, es una huella nueva.
             # Limpiamos cualquier error anterior.
-            if self.last_capture:
-                 self.last_capture.pop('registration_error', None)
+            self._update_registration(error=None)
             # =================== FIN DE CORRECCIÓN (Intento 2) ===================
             
             # Agregar plantilla
-            self.register_templates.append(template)
-            self.register_count = len(self.register_templates)
+            with self._registration_lock:
+                self.register_templates.append(template)
+                self.register_count = len(self.register_templates)
+                self._current_enrollment.touch()
             
-            logger.info(f"✅ Captura {self.register_count}/3 completada - Tamaño: {len(template)} bytes")
+            logger.info(f"✅ Captura {self.register_count}/{required} completada - Tamaño: {len(template)} bytes")
             
             # Actualizar información de progreso
-            if self.last_capture:
-                self.last_capture['register_count'] = self.register_count
-                self.last_capture['registration_in_progress'] = True
-                # ✅ CRÍTICO: Asegurar que se actualice el estado
-                self.last_capture['registration_complete'] = False
+            # ✅ CRÍTICO: Asegurar que se actualice el estado
+            self._update_registration(
+                register_count=self.register_count,
+                in_progress=True,
+                complete=False
+            )
             
-            # Si tenemos 3 capturas, generar plantilla final
-            if self.register_count >= 3:
-                logger.info("🎯 3 CAPTURAS COMPLETADAS - Preparando generación de plantilla final...")
+            # Si tenemos todas las capturas, generar plantilla final
+            if self.register_count >= required:
+                logger.info(f"🎯 {required} CAPTURAS COMPLETADAS - Preparando generación de plantilla final...")
                # logger.info("⏳ Pausa de 1.5 segundos para estabilizar dispositivo...")
                 time.sleep(1.5)
                 
                 # Verificar conexión antes de generar
-                if not self._verify_device_connection():
+                if self.health.check()['connected'] is False:
                     logger.error("❌ Dispositivo desconectado antes de generar plantilla")
-                    if not self._reconnect_device():
+                    if not self._recover_device():
                         logger.error("❌ No se pudo reconectar - reiniciando registro")
                         self._reset_registration_state()
                         return True # Detener el loop por error crítico
@@ -663,35 +2891,45 @@ class ZKTecoDevice:
                     logger.info("✅ REGISTRO COMPLETADO EXITOSAMENTE")
                  #   return True # *** DEVOLVER TRUE PARA DETENER EL LOOP ***
       
-                    # ✅ VERIFICAR que la plantilla final esté en last_capture
-                    if self.last_capture and 'final_template' in self.last_capture:
-                        logger.info(f"✅ Plantilla final confirmada en last_capture (tamaño: {len(self.last_capture['final_template'])})")
+                    # ✅ VERIFICAR que la plantilla final esté publicada
+                    final_template = self.registration_status.final_template
+                    if final_template:
+                        logger.info(f"✅ Plantilla final confirmada en estado de registro (tamaño: {len(final_template)})")
                         
                         # ✅ FORZAR actualización del estado
-                        self.last_capture['registration_complete'] = True
-                        self.last_capture['registration_in_progress'] = False
-                        
                         # ✅ AGREGAR: Timestamp para verificar actualización
-                        self.last_capture['completion_timestamp'] = time.time()
+                        self._update_registration(
+                            complete=True,
+                            in_progress=False,
+                            completion_timestamp=time.time()
+                        )
                         
                         logger.info("✅ Estado de registro actualizado: registration_complete=True")
                     else:
-                        logger.error("❌ Plantilla final NO encontrada en last_capture después de generación")
+                        logger.error("❌ Plantilla final NO encontrada en estado de registro después de generación")
                         return False
                     
                     return True                                     
                 else:
                     logger.error("❌ No se pudo generar plantilla final")
-                    # Mantener 2 plantillas para reintentar
-                    if len(self.register_templates) >= 2:
-                        self.register_count = 2
-                        self.register_templates = self.register_templates[:2]
-                        if self.last_capture:
-                            self.last_capture['register_count'] = 2
-                            self.last_capture['registration_error'] = "Error al generar plantilla final"
+                    # Descartar la muestra menos consistente y pedir otra pulsación. Las
+                    # comparaciones (DBMatch, bajo _db_lock) se hacen sobre una copia y sin
+                    # _registration_lock: una identificación 1:N en curso no debe bloquear a
+                    # quienes consultan el estado del registro
+                    with self._registration_lock:
+                        session = self._current_enrollment
+                        templates = list(self.register_templates)
+                    if len(templates) >= 2:
+                        kept = self._drop_least_consistent(templates)
+                        with self._registration_lock:
+                            # Solo si nadie reinició ni cambió la sesión mientras tanto
+                            if self._current_enrollment is session and self.register_templates == templates:
+                                self.register_templates = kept
+                                self.register_count = len(kept)
+                                self._update_registration(register_count=self.register_count, error="Error al generar plantilla final")
                     return False # No detener, permitir reintento
             else:
-                logger.info(f"⏳ Progreso: {self.register_count}/3 capturas")
+                logger.info(f"⏳ Progreso: {self.register_count}/{required} capturas")
                 return False # No detener, continuar capturando
                         
         except Exception as e:
@@ -699,44 +2937,80 @@ class ZKTecoDevice:
             self._reset_registration_state()
             return True # Detener el loop por error crítico
 
-    def _generate_final_template_robust(self):
-        """Genera plantilla final con reintentos y manejo robusto de errores"""
-        try:
-            if not self._validate_templates():
-                logger.error("❌ Validación de plantillas falló")
-                return False
+    def _pairwise_scores(self, templates):
+        """Matriz simétrica de scores DBMatch entre todas las muestras del registro"""
+        buffers = [(ctypes.c_ubyte * len(t)).from_buffer_copy(t) for t in templates]
+        n = len(templates)
+        scores = [[0] * n for _ in range(n)]
+        with self._db_lock:
+            for i in range(n):
+                for j in range(i + 1, n):
+                    score = zkfp.ZKFPM_DBMatch(
+                        self.db_handle,
+                        buffers[i],
+                        len(templates[i]),
+                        buffers[j],
+                        len(templates[j])
+                    )
+                    scores[i][j] = scores[j][i] = max(score, 0)
+        return scores
 
-            # ✅ VERIFICAR db_handle
-            if not self.db_handle:
-                logger.error("❌ db_handle no disponible para GenRegTemplate")
-                return False
+    @staticmethod
+    def _rank_triples(scores):
+        """Tríos de muestras ordenados de más a menos consistente.
 
-            max_attempts = 3
-            
-            for attempt in range(1, max_attempts + 1):
-                try:
-                    logger.info(f"🔄 Intento {attempt} de {max_attempts}")
-                    
-                    # Verificar handle válido
-                    if not self.device_handle or self.device_handle <= 0:
-                        logger.error("❌ Handle inválido detectado")
-                        if not self._reconnect_device():
-                            continue
-                    
-                    # Crear buffers para las 3 plantillas
-                    logger.info("🔧 Creando buffers para plantillas...")
-                    template1 = (ctypes.c_ubyte * len(self.register_templates[0]))(*self.register_templates[0])
-                    template2 = (ctypes.c_ubyte * len(self.register_templates[1]))(*self.register_templates[1])
-                    template3 = (ctypes.c_ubyte * len(self.register_templates[2]))(*self.register_templates[2])
-                    
-                    # Buffer para plantilla final
-                    reg_temp_len = 2048
-                    reg_temp = (ctypes.c_ubyte * reg_temp_len)()
-                    reg_temp_size = ctypes.c_int(reg_temp_len)
-                    
-                    logger.info("🎯 Llamando ZKFPM_GenRegTemplate...")
-                    
-                    # Llamar a GenRegTemplate
+        Un trío vale lo que su peor par (desempate: suma de los tres pares), porque
+        GenRegTemplate falla en cuanto una de las tres muestras no coincide con las otras.
+        """
+        ranked = []
+        for triple in itertools.combinations(range(len(scores)), 3):
+            pairs = [scores[a][b] for a, b in itertools.combinations(triple, 2)]
+            ranked.append((min(pairs), sum(pairs), triple))
+        ranked.sort(reverse=True)
+        return ranked
+
+    def _drop_least_consistent(self, templates):
+        """Quitar la muestra que peor coincide con las demás"""
+        if len(templates) < 3 or not self.db_handle:
+            return templates[:-1]
+        try:
+            scores = self._pairwise_scores(templates)
+        except Exception as e:
+            logger.error(f"Error al comparar muestras de registro: {e}")
+            return templates[:-1]
+        worst = min(range(len(templates)), key=lambda i: sum(scores[i]))
+        logger.info(f"🗑️ Descartando muestra {worst + 1} (la menos consistente)")
+        return [t for i, t in enumerate(templates) if i != worst]
+
+    def _merge_templates(self, triple):
+        """ZKFPM_GenRegTemplate con reintentos sobre un trío de muestras. Devuelve bytes o None"""
+        max_attempts = MAX_RETRIES
+        
+        for attempt in range(1, max_attempts + 1):
+            try:
+                logger.info(f"🔄 Intento {attempt} de {max_attempts}")
+                
+                # Verificar handle válido
+                if not self.device_handle or self.device_handle <= 0:
+                    logger.error("❌ Handle inválido detectado")
+                    if not self._recover_device():
+                        continue
+                
+                # Crear buffers para las 3 plantillas
+                logger.info("🔧 Creando buffers para plantillas...")
+                template1, template2, template3 = [
+                    (ctypes.c_ubyte * len(t)).from_buffer_copy(t) for t in triple
+                ]
+                
+                # Buffer para plantilla final
+                reg_temp_len = 2048
+                reg_temp = (ctypes.c_ubyte * reg_temp_len)()
+                reg_temp_size = ctypes.c_int(reg_temp_len)
+                
+                logger.info("🎯 Llamando ZKFPM_GenRegTemplate...")
+                
+                # Llamar a GenRegTemplate
+                with self._db_lock:
                     ret = zkfp.ZKFPM_GenRegTemplate(
                         self.db_handle,
                         template1,
@@ -745,52 +3019,92 @@ class ZKTecoDevice:
                         reg_temp,
                         ctypes.byref(reg_temp_size)
                     )
+                
+                logger.info(f"📊 Resultado de GenRegTemplate: {ret} ({self._get_error_message(ret)})")
+                
+                if ret == ZKFP_ERR_OK:
+                    final_size = reg_temp_size.value
+                    logger.info(f"✅ Plantilla final generada - Tamaño: {final_size} bytes")
+                    return bytes(reg_temp[:final_size])
                     
-                    logger.info(f"📊 Resultado de GenRegTemplate: {ret} ({self._get_error_message(ret)})")
+                elif ret == ZKFP_ERR_INVALID_HANDLE:
+                    logger.error(f"❌ Error al generar plantilla (intento {attempt}): Handle inválido")
                     
-                    if ret == ZKFP_ERR_OK:
-                        final_size = reg_temp_size.value
-                        logger.info(f"✅ Plantilla final generada - Tamaño: {final_size} bytes")
-                        
-                        # Convertir a bytes y base64
-                        final_template = bytes(reg_temp[:final_size])
-                        final_template_b64 = base64.b64encode(final_template).decode('utf-8')
-                        
-                        # Actualizar last_capture con plantilla final
-                        if self.last_capture:
-                            self.last_capture['final_template'] = final_template_b64
-                            self.last_capture['registration_complete'] = True
-                            self.last_capture['final_template_size'] = final_size
-                            self.last_capture['registration_in_progress'] = False
-                        
-                        logger.info("✅ Plantilla final guardada en last_capture")
-                        return True
-                        
-                    elif ret == ZKFP_ERR_INVALID_HANDLE:
-                        logger.error(f"❌ Error al generar plantilla (intento {attempt}): Handle inválido")
-                      #  logger.warning("🔧 Error de handle inválido - intentando recuperación...")
-                        
-                        if self._reconnect_device():
-                            continue
-                        else:
-                            logger.error("❌ No se pudo recuperar el handle")
-                            
+                    # Primero la reapertura rápida; si el handle sigue inválido en el siguiente
+                    # intento, reconexión completa (también reinicia el handle de algoritmos)
+                    if self._recover_device() if attempt == 1 else self._reconnect_device():
+                        continue
                     else:
-                        error_msg = self._get_error_message(ret)
-                        logger.error(f"❌ Error al generar plantilla: {error_msg}")
+                        logger.error("❌ No se pudo recuperar el handle")
                         
-                        # Para errores no relacionados con handle, no reintentar
-                        if ret != ZKFP_ERR_MERGE:
-                            return False
-                        
-                except Exception as e:
-                    logger.exception(f"💥 Excepción en intento {attempt}: {e}")
-                    if attempt < max_attempts:
-                        time.sleep(2)
-                        continue
+                else:
+                    error_msg = self._get_error_message(ret)
+                    logger.error(f"❌ Error al generar plantilla: {error_msg}")
+                    
+                    # Para errores no relacionados con handle, no reintentar
+                    if ret != ZKFP_ERR_MERGE:
+                        return None
+                    
+            except Exception as e:
+                logger.exception(f"💥 Excepción en intento {attempt}: {e}")
+                if attempt < max_attempts:
+                    time.sleep(RETRY_DELAY)
+                    continue
+        
+        return None
+
+    def _generate_final_template_robust(self):
+        """Genera plantilla final con reintentos y manejo robusto de errores.
+
+        Con más de tres muestras se comparan todas entre sí (DBMatch) y se combinan
+        los tríos más consistentes primero; si la sesión pide varias plantillas por
+        dedo se publican las de los mejores tríos que se pudieron combinar.
+        """
+        try:
+            if not self._validate_templates():
+                logger.error("❌ Validación de plantillas falló")
+                return False
+
+            # ✅ VERIFICAR db_handle
+            if not self.db_handle:
+                logger.error("❌ db_handle no disponible para GenRegTemplate")
+                return False
+
+            session = self._current_enrollment
+            templates = list(self.register_templates)
+            scores = self._pairwise_scores(templates)
+            ranked = self._rank_triples(scores)
+            logger.info(f"📐 {len(ranked)} trío(s) candidatos - mejor par mínimo: {ranked[0][0]}")
+
+            finals = []
+            for consistency, _, triple in ranked:
+                logger.info(f"🧩 Combinando muestras {[i + 1 for i in triple]} (consistencia: {consistency})")
+                final_template = self._merge_templates([templates[i] for i in triple])
+                if final_template is None:
+                    continue
+                finals.append((final_template, consistency))
+                if len(finals) >= session.store_templates:
+                    break
+
+            if not finals:
+                logger.error("❌ Todos los intentos fallaron para generar plantilla")
+                return False
+
+            best_template, best_consistency = finals[0]
+            encoded = tuple(base64.b64encode(t).decode('utf-8') for t, _ in finals)
             
-            logger.error("❌ Todos los intentos fallaron para generar plantilla")
-            return False
+            # Publicar la plantilla final en el estado de registro
+            self._update_registration(
+                final_template=encoded[0],
+                final_templates=encoded if session.store_templates > 1 else None,
+                consistency_score=best_consistency,
+                complete=True,
+                final_template_size=len(best_template),
+                in_progress=False
+            )
+            
+            logger.info(f"✅ {len(finals)} plantilla(s) final(es) guardada(s) en estado de registro")
+            return True
             
         except Exception as e:
             logger.exception(f"❌ Error crítico en _generate_final_template_robust: {e}")
@@ -799,7 +3113,7 @@ class ZKTecoDevice:
     def _validate_templates(self):
         """Validar que las plantillas sean consistentes y válidas"""
         try:
-            if len(self.register_templates) != 3:
+            if len(self.register_templates) < 3:
                 logger.error(f"❌ Número incorrecto de plantillas: {len(self.register_templates)}")
                 return False
             
@@ -812,9 +3126,7 @@ class ZKTecoDevice:
                     logger.warning(f"⚠️ Plantilla {i+1} muy pequeña: {len(template)} bytes")
             
             # Verificar que las plantillas no sean idénticas (posible error)
-            if (self.register_templates[0] == self.register_templates[1] or 
-                self.register_templates[1] == self.register_templates[2] or
-                self.register_templates[0] == self.register_templates[2]):
+            if len(set(self.register_templates)) != len(self.register_templates):
                 logger.warning("⚠️ Algunas plantillas son idénticas - posible error de captura")
             
             logger.info(f"✅ Plantillas validadas - tamaños: {[len(t) for t in self.register_templates]}")
@@ -825,36 +3137,313 @@ class ZKTecoDevice:
             return False
 
     def _process_verification(self, template):
-        """Marcar que hay una plantilla disponible para verificar"""
-        if self.last_capture:
-            self.last_capture['ready_for_verification'] = True
+        """Marcar que hay una plantilla disponible para verificar.
+
+        Con auto_identify activo, la plantilla se identifica aquí mismo (1:N) y el
+        resultado se publica junto con la captura, evitando el ida y vuelta
+        navegador -> /api/db/match_one_to_many.
+        """
+        frame = self.latest_frame
+        if frame is None:
+            return
+
+        if self.auto_identify:
+            start_time = time.time()
+            try:
+                result = self.identify_template(template)
+            except Exception as e:
+                logger.error(f"Error en identificación automática: {e}")
+                result = {'success': False, 'message': 'Error interno durante el matching.'}
+
+            # Una sola publicación: los lectores nunca ven el resultado sin la marca de listo
+            self.verification_status = VerificationStatus(
+                seq=next(self._seq),
+                frame_seq=frame.seq,
+                ready=True,
+                identification=result,
+                identification_time_ms=round((time.time() - start_time) * 1000, 2)
+            )
+            # No volver a identificar hasta que se levante el dedo
+            self.verify_step = "WAIT_FOR_LIFT"
+        else:
+            self.verification_status = VerificationStatus(seq=next(self._seq), frame_seq=frame.seq, ready=True)
+
+    def _publish_frame(self, template_bytes, image_bytes):
+        """Publicar una nueva adquisición como CaptureFrame inmutable (con su calidad)"""
+        quality = None
+        if QUALITY_CHECK_ENABLED:
+            try:
+                quality = assess_capture_quality(image_bytes, self.width, self.height)
+            except Exception as e:
+                logger.warning(f"Error al evaluar calidad de captura: {e}")
+
+        frame = CaptureFrame(
+            seq=next(self._seq),
+            timestamp=time.time(),
+            mode=self.current_mode,
+            width=self.width,
+            height=self.height,
+            template_bytes=template_bytes,
+            image_bytes=image_bytes,
+            quality=quality
+        )
+        self.frame_history.append(frame)
+        self.latest_frame = frame
+        return frame
+
+    def _update_registration(self, **changes):
+        """Publicar una nueva versión del estado de registro (solo si algo cambió)"""
+        with self._registration_lock:
+            current = self.registration_status
+            if all(getattr(current, field) == value for field, value in changes.items()):
+                return
+            self.registration_status = replace(current, seq=next(self._seq), **changes)
+
+    def _compose_capture(self, include_image=True):
+        """Vista de la última captura compatible con el antiguo dict last_capture.
+
+        Combina la captura con el estado de registro (solo en modo registro) y con
+        el estado de verificación correspondiente a esa misma captura.
+        """
+        frame = self.latest_frame
+        if frame is None:
+            return None
+
+        data = frame.to_dict(include_image)
+        if self.current_mode == "registering":
+            data.update(self.registration_status.to_dict())
+            if self._enrollment is not None:
+                data['session_id'] = self._enrollment.session_id
+        verification = self.verification_status
+        if verification.frame_seq == frame.seq:
+            data.update(verification.to_dict())
+        data['version'] = max(frame.seq, self.registration_status.seq, verification.seq)
+        return data
+
+    @property
+    def last_capture(self):
+        """Compatibilidad: vista dict (nueva en cada lectura) de la última captura"""
+        return self._compose_capture() or {}
     
+    def _publish_capture(self):
+        """Notificar la captura actual a los suscriptores (llamado desde el hilo de captura)"""
+        if not self._capture_listeners:
+            return
+
+        capture = self._compose_capture()
+        if not capture:
+            return
+
+        for listener in list(self._capture_listeners):
+            try:
+                listener(capture)
+            except Exception as e:
+                logger.error(f"Error al notificar captura a suscriptor: {e}")
+
     def _reset_registration_state(self):
-        """Resetear estado de registro"""
-        with self._lock:
-            self.register_count = 0
-            self.register_templates = []
-            self.current_mode = "idle"
-            self.register_step = "CAPTURE"            
-            # Limpiar solo datos de registro del last_capture
-            if self.last_capture:
-                for field in ['registration_complete', 'final_template', 'register_count', 'registration_in_progress', 'registration_error']:
-                    if field in self.last_capture:
-                        del self.last_capture[field]
+        """Abortar la sesión de registro activa (error crítico) y pasar el sensor a la siguiente"""
+        with self._registration_lock:
+            session = self._enrollment
+            if session is not None and not session.finished:
+                # La sesión abortada conserva el motivo para que su operador lo vea
+                session.templates = []
+                session.count = 0
+                session.step = "CAPTURE"
+                session.status = RegistrationStatus(
+                    seq=next(self._seq),
+                    in_progress=False,
+                    error="Registro abortado por un error del dispositivo"
+                )
+                self._release_enrollment(session, "cancelled", keep=True)
+            else:
+                self._enrollment = None
+                self.current_mode = "idle"
+                self._idle_enrollment.status = RegistrationStatus(seq=next(self._seq))
             
             logger.info("Estado de registro reseteado")
 
-    # Métodos públicos
+    # ==================== PLANIFICACIÓN DE SESIONES DE REGISTRO ====================
+    # Todos estos métodos se llaman con _registration_lock tomado (salvo los públicos).
+    def _queue_position(self, session):
+        """0 si la sesión tiene el sensor, 1..N si está en cola, None si terminó"""
+        if session is self._enrollment and session.state == "active":
+            return 0
+        if session.state != "queued":
+            return None
+        queued = [s for s in self.enrollments.values() if s.state == "queued"]
+        return queued.index(session) + 1
+
+    def _schedule_enrollment(self):
+        """Entregar el sensor a la siguiente sesión en cola si la actual ya terminó"""
+        current = self._enrollment
+        if current is not None and not current.finished:
+            return current
+
+        next_session = next((s for s in self.enrollments.values() if s.state == "queued"), None)
+        if next_session is None:
+            return current
+
+        next_session.state = "active"
+        next_session.touch()
+        next_session.templates = []
+        next_session.count = 0
+        next_session.step = "CAPTURE"
+        next_session.status = RegistrationStatus(seq=next(self._seq), samples_required=next_session.samples)
+        self._enrollment = next_session
+        self.current_mode = "registering"
+        self.auto_identify = False
+        self.verify_step = "CAPTURE"
+        # La nueva sesión no debe ver la imagen ni la plantilla del operador anterior
+        self.latest_frame = None
+
+        # Las sesiones que siguen en cola avanzaron de posición: nueva versión para sus clientes
+        for session in self.enrollments.values():
+            if session.state == "queued":
+                session.status = replace(session.status, seq=next(self._seq))
+
+        logger.info(f"📝 Sesión de registro {next_session.session_id} ({next_session.label or 'sin etiqueta'}) tiene el sensor")
+
+        if self.device_handle and not self.is_capturing:
+            self.start_capture()
+        return next_session
+
+    def _release_enrollment(self, session, state, keep=False):
+        """Cerrar una sesión (cancelada/expirada) y pasar el sensor a la siguiente"""
+        session.state = state
+        if not keep:
+            self.enrollments.pop(session.session_id, None)
+
+        if session is self._enrollment:
+            self._enrollment = None
+            if self._schedule_enrollment() is None:
+                self.current_mode = "idle"
+                self._idle_enrollment.status = RegistrationStatus(seq=next(self._seq))
+
+    def _complete_enrollment(self):
+        """Marcar completa la sesión activa. True si otra sesión en cola tomó el sensor.
+
+        Si nadie espera, la sesión completa sigue publicada (compatibilidad con el
+        flujo de un solo operador que lee la plantilla final de /api/capture/get).
+        """
+        with self._registration_lock:
+            session = self._enrollment
+            if session is None or not session.status.complete:
+                return False
+            session.state = "complete"
+            session.touch()
+            logger.info(f"✅ Sesión de registro {session.session_id} completada")
+            return self._schedule_enrollment() is not session
+
+    def _expire_enrollments(self):
+        """Expirar sesiones sin actividad durante ENROLLMENT_SESSION_TIMEOUT segundos.
+
+        La sesión expirada sigue publicada (`enrollment_state: "expired"`) otro
+        ENROLLMENT_SESSION_TIMEOUT para que su cliente vea por qué se detuvo; las
+        sesiones ya terminadas se descartan al cumplirse ese plazo.
+        """
+        now = time.time()
+        with self._registration_lock:
+            for session in [s for s in self.enrollments.values() if s.is_stale(now)]:
+                if session.finished:
+                    self.enrollments.pop(session.session_id, None)
+                    continue
+                logger.warning(f"⌛ Sesión de registro {session.session_id} expirada por inactividad")
+                session.status = replace(session.status, seq=next(self._seq), in_progress=False,
+                                         error="Sesión de registro expirada por inactividad")
+                session.touch()
+                self._release_enrollment(session, "expired", keep=True)
+
+    def _touch_enrollment(self, session_id=None):
+        """Mantener viva la sesión que tiene el sensor (opcionalmente solo si es `session_id`)"""
+        with self._registration_lock:
+            session = self._enrollment
+            if session is not None and session.state == "active" and session_id in (None, session.session_id):
+                session.touch()
+
+    # Métodos públicos
+    def open_enrollment(self, label=None, samples=None, store_templates=None):
+        """Abrir una sesión de registro; si otra tiene el sensor queda en cola.
+
+        `samples`: muestras a capturar (3..ENROLLMENT_MAX_SAMPLES); con más de tres se
+        combinan los tríos más consistentes. `store_templates`: plantillas finales por dedo.
+        """
+        self._expire_enrollments()
+        with self._registration_lock:
+            pending = [s for s in self.enrollments.values() if not s.finished]
+            if len(pending) >= ENROLLMENT_MAX_SESSIONS:
+                return {
+                    'success': False,
+                    'busy': True,
+                    'message': f'Demasiadas sesiones de registro abiertas ({len(pending)})'
+                }
+
+            try:
+                session = EnrollmentSession(uuid.uuid4().hex[:12], label, samples, store_templates)
+            except (TypeError, ValueError):
+                return {
+                    'success': False,
+                    'message': 'Parámetros "samples" y "store_templates" deben ser enteros'
+                }
+            self.enrollments[session.session_id] = session
+            self._schedule_enrollment()
+            position = self._queue_position(session)
+
+        logger.info(f"Sesión de registro {session.session_id} abierta (posición en cola: {position})")
+        return {
+            'success': True,
+            'message': 'Sesión de registro iniciada' if position == 0 else f'Sensor ocupado: sesión en cola (posición {position})',
+            'session': session.to_dict(position)
+        }
+
+    def get_enrollment(self, session_id, since=None):
+        """Estado de una sesión de registro (también mantiene viva la sesión)"""
+        self._expire_enrollments()
+        with self._registration_lock:
+            session = self.enrollments.get(session_id)
+            if session is None:
+                return {
+                    'success': False,
+                    'message': 'Sesión de registro no encontrada o expirada'
+                }
+            # Una sesión terminada se conserva un plazo fijo desde que terminó
+            if not session.finished:
+                session.touch()
+            if since is not None and session.status.seq <= since:
+                return {
+                    'success': True,
+                    'unchanged': True,
+                    'version': session.status.seq
+                }
+            return {
+                'success': True,
+                'session': session.to_dict(self._queue_position(session))
+            }
+
+    def list_enrollments(self):
+        """Sesiones de registro abiertas (sin plantillas)"""
+        self._expire_enrollments()
+        with self._registration_lock:
+            sessions = [
+                session.to_dict(self._queue_position(session), include_template=False)
+                for session in self.enrollments.values()
+            ]
+            active = self._enrollment.session_id if self._enrollment is not None else None
+        return {
+            'success': True,
+            'active_session': active,
+            'sessions': sessions
+        }
+
     def initialize(self):
         """Inicializar el SDK y detectar dispositivos"""
         try:
-            if not SDK_AVAILABLE:
+            if not load_sdk():
                 return {
                     'success': False,
                     'message': 'SDK no disponible. Instale ZKFingerSDK 5.x'
                 }
             
-            with self._lock:
+            with self._device_lock:
                 logger.info("Inicializando dispositivo...")
                 
                 try:
@@ -871,20 +3460,21 @@ class ZKTecoDevice:
                     self.is_initialized = True
                     # --- INICIO DE CORRECCIÓN ---
                     # Crear el handle de la caché de algoritmos (DB Handle)
-                    if not self.db_handle:
-                        try:
-                            self.db_handle = zkfp.ZKFPM_DBInit()
-                            if self.db_handle:
-                                logger.info(f"✅ Cache de algoritmos (db_handle) creada: {self.db_handle}")
-                            else:
-                                logger.error("❌ No se pudo crear la cache de algoritmos (db_handle)")
-                                return {
-                                    'success': False,
-                                    'message': 'No se pudo inicializar la caché de algoritmos'
-                                }
-                        except Exception as e:
-                            logger.error(f"Excepción en ZKFPM_DBInit: {e}")
-                            return {'success': False, 'message': f'Error en DBInit: {str(e)}'}
+                    with self._db_lock:
+                        if not self.db_handle:
+                            try:
+                                self.db_handle = zkfp.ZKFPM_DBInit()
+                                if self.db_handle:
+                                    logger.info(f"✅ Cache de algoritmos (db_handle) creada: {self.db_handle}")
+                                else:
+                                    logger.error("❌ No se pudo crear la cache de algoritmos (db_handle)")
+                                    return {
+                                        'success': False,
+                                        'message': 'No se pudo inicializar la caché de algoritmos'
+                                    }
+                            except Exception as e:
+                                logger.error(f"Excepción en ZKFPM_DBInit: {e}")
+                                return {'success': False, 'message': f'Error en DBInit: {str(e)}'}
                     # --- FIN DE CORRECCIÓN ---                    
                     try:
                         device_count = zkfp.ZKFPM_GetDeviceCount()
@@ -922,7 +3512,7 @@ class ZKTecoDevice:
     def open_device(self, index=0):
         """Abrir conexión con el dispositivo - VERSIÓN MEJORADA"""
         try:
-            if not SDK_AVAILABLE:
+            if not load_sdk():
                 return {
                     'success': False,
                     'message': 'SDK no disponible'
@@ -934,7 +3524,7 @@ class ZKTecoDevice:
                 if not init_result.get('success'):
                     return init_result
             
-            with self._lock:
+            with self._device_lock:
                 logger.info(f"Intentando abrir dispositivo con índice {index}...")
                 
                 # Cerrar conexión existente si hay una
@@ -959,6 +3549,7 @@ class ZKTecoDevice:
                         }
                     
                     self.device_handle = handle
+                    self.device_index = index
                     logger.info(f"Dispositivo abierto correctamente")
                     
                     # VERIFICAR QUE EL DISPOSITIVO RESPONDE
@@ -982,54 +3573,24 @@ class ZKTecoDevice:
                         'message': f'Error al abrir dispositivo: {str(e)}'
                     }
                 
-                # Obtener parámetros del dispositivo
+                # Geometría e información del lector (de la cache por número de serie si ya se conoce)
                 try:
-                    # Obtener ancho de imagen
-                    param_buffer = (ctypes.c_ubyte * 4)()
-                    size = ctypes.c_int(4)
-                    
-                    ret = zkfp.ZKFPM_GetParameters(
-                        self.device_handle,
-                        PARAM_CODE_IMAGE_WIDTH,
-                        param_buffer,
-                        ctypes.byref(size)
-                    )
-                    
-                    if ret == ZKFP_ERR_OK:
-                        self.width = int.from_bytes(bytes(param_buffer[:4]), byteorder='little')
-                    else:
-                        self.width = 300
-                        logger.warning(f"No se pudo obtener ancho, usando valor por defecto: {self.width}")
-                    
-                    # Obtener alto de imagen
-                    param_buffer = (ctypes.c_ubyte * 4)()
-                    size = ctypes.c_int(4)
-                    
-                    ret = zkfp.ZKFPM_GetParameters(
-                        self.device_handle,
-                        PARAM_CODE_IMAGE_HEIGHT,
-                        param_buffer,
-                        ctypes.byref(size)
-                    )
-                    
-                    if ret == ZKFP_ERR_OK:
-                        self.height = int.from_bytes(bytes(param_buffer[:4]), byteorder='little')
-                    else:
-                        self.height = 400
-                        logger.warning(f"No se pudo obtener alto, usando valor por defecto: {self.height}")
-                    
+                    self._load_device_parameters()
                 except Exception as e:
                     logger.warning(f"Error al obtener parámetros: {e}, usando valores por defecto")
-                    self.width = 300
-                    self.height = 400
+                    self.width = DEFAULT_IMAGE_WIDTH
+                    self.height = DEFAULT_IMAGE_HEIGHT
                 
                 logger.info(f"Dimensiones de imagen: {self.width}x{self.height}")
+                self.health.record_ok('open')
+                self.hotplug.start()
                 
                 return {
                     'success': True,
                     'message': 'Dispositivo conectado exitosamente',
                     'width': self.width,
-                    'height': self.height
+                    'height': self.height,
+                    'device_info': dict(self.device_info)
                 }
                 
         except Exception as e:
@@ -1043,9 +3604,11 @@ class ZKTecoDevice:
         """Cerrar conexión con el dispositivo"""
         try:
             logger.info("Cerrando dispositivo...")
+            self.hotplug.stop()
+            self.health.reset()
             self.stop_capture()
             
-            with self._lock:
+            with self._device_lock:
                 if self.device_handle and SDK_AVAILABLE:
                     try:
                         zkfp.ZKFPM_CloseDevice(self.device_handle)
@@ -1083,7 +3646,7 @@ class ZKTecoDevice:
         
         if not self.is_capturing:
             self.is_capturing = True
-            self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
+            self.capture_thread = threading.Thread(target=self._capture_loop, name='capture', daemon=True)
             self.capture_thread.start()
             logger.info("Captura iniciada")
             return {
@@ -1127,7 +3690,7 @@ class ZKTecoDevice:
             'message': 'Captura detenida'
         }
 
-    def set_mode(self, mode):
+    def set_mode(self, mode, auto_identify=False, label=None, samples=None, store_templates=None):
         """Establecer modo de operación"""
         valid_modes = ['idle', 'registering', 'verifying']
         
@@ -1137,28 +3700,77 @@ class ZKTecoDevice:
                 'message': f'Modo inválido. Opciones: {", ".join(valid_modes)}'
             }
         
-        self.current_mode = mode
-        logger.info(f"Modo cambiado a: {mode}")
-        
         if mode == "registering":
-            self.register_count = 0
-            self.register_templates = []
-            self.register_step = "CAPTURE"        
+            # Cada registro es una sesión propia; si el sensor está ocupado queda en cola
+            result = self.open_enrollment(label, samples, store_templates)
+            if not result.get('success'):
+                return result
+            session = result['session']
+            return {
+                'success': True,
+                'mode': mode,
+                'auto_identify': False,
+                'session_id': session['session_id'],
+                'session': session,
+                'message': result['message']
+            }
+        
+        with self._registration_lock:
+            self._expire_enrollments()
+            pending = [s for s in self.enrollments.values() if not s.finished]
+            if pending:
+                return {
+                    'success': False,
+                    'mode': self.current_mode,
+                    'message': f'Sensor reservado por {len(pending)} sesión(es) de registro'
+                }
+            # Una sesión completa deja de publicarse al cambiar de modo (sigue consultable por su ID)
+            self._enrollment = None
+            self.current_mode = mode
+        
+        self.auto_identify = bool(auto_identify) and mode == "verifying"
+        self.verify_step = "CAPTURE"
+        logger.info(f"Modo cambiado a: {mode}" + (" (identificación automática)" if self.auto_identify else ""))
+        
+        if mode == "verifying":
+            # Descartar capturas de una sesión anterior para no re-verificar una huella vieja
+            self.latest_frame = None
+            self.verification_status = VerificationStatus(seq=next(self._seq))
         return {
             'success': True,
             'mode': mode,
+            'auto_identify': self.auto_identify,
             'message': f'Modo establecido a: {mode}'
         }
 
-    def get_last_capture(self):
-        """Obtener última captura de forma segura"""
+    def get_last_capture(self, since=None, include_image=True, session_id=None):
+        """Obtener última captura de forma segura.
+
+        Con `since` (versión ya vista por el cliente) se evita reenviar la misma
+        captura: si no hubo cambios se responde solo {'unchanged': True}.
+        Con `session_id` una sesión de registro que no tiene el sensor recibe solo
+        su propio estado, nunca la captura ni la plantilla de otra sesión.
+        """
         try:
-            if self.last_capture:
-                # Crear una copia para evitar problemas de referencia
-                capture_copy = self.last_capture.copy()
+            if session_id is not None and (self._enrollment is None or self._enrollment.session_id != session_id):
+                result = self.get_enrollment(session_id, since)
+                if result.get('success') and 'session' in result:
+                    return {'success': True, 'data': result.pop('session')}
+                return result
+            if session_id is not None:
+                self._touch_enrollment(session_id)
+
+            capture = self._compose_capture(include_image)
+            if capture:
+                if since is not None and capture['version'] <= since:
+                    return {
+                        'success': True,
+                        'unchanged': True,
+                        'version': capture['version']
+                    }
                 return {
                     'success': True,
-                    'data': capture_copy
+                    'data': capture
                 }
             else:
                 return {
@@ -1188,6 +3800,14 @@ class ZKTecoDevice:
             'message': f'Modo establecido a: {mode}'
         }
     
+    def add_capture_listener(self, listener):
+        """Registrar un callback que recibe una copia de cada nueva captura"""
+        self._capture_listeners.append(listener)
+
+    def remove_capture_listener(self, listener):
+        if listener in self._capture_listeners:
+            self._capture_listeners.remove(listener)
+
     def get_status(self):
         """Obtener estado actual del dispositivo"""
         return {
@@ -1195,11 +3815,15 @@ class ZKTecoDevice:
             'connected': self.device_handle is not None,
             'capturing': self.is_capturing,
             'mode': self.current_mode,
+            'auto_identify': self.auto_identify,
             'width': self.width,
             'height': self.height,
+            'device_info': dict(self.device_info),
             'initialized': self.is_initialized,
             'register_count': self.register_count,
-            'sdk_available': SDK_AVAILABLE
+            'sdk_available': SDK_AVAILABLE,
+            'hotplug': self.hotplug.get_status(),
+            'health': self.health.get_status()
         }
     
     def get_thread_status(self):
@@ -1214,8 +3838,11 @@ class ZKTecoDevice:
         logger.info(f"Estado del thread: {thread_status}")
         return thread_status
     
-    def compare_templates(self, template1_b64, template2_b64):
-        """Comparar dos plantillas de huellas dactilares"""
+    def compare_templates(self, template1_b64, template2_b64, user_id=None, finger_index=None, site=None):
+        """Comparar dos plantillas de huellas dactilares.
+
+        Con `user_id` (y `finger_index`) se aplica el umbral de ese usuario/dedo.
+        """
         try:
             if not SDK_AVAILABLE or not self.device_handle:
                 return {
@@ -1247,25 +3874,29 @@ class ZKTecoDevice:
             temp2 = (ctypes.c_ubyte * len(template2_bytes))(*template2_bytes)
             
             # Comparar plantillas
-            score = zkfp.ZKFPM_DBMatch(
-                self.db_handle,
-                temp1,
-                len(template1_bytes),
-                temp2,
-                len(template2_bytes)
-            )
+            with self._db_lock:
+                score = zkfp.ZKFPM_DBMatch(
+                    self.db_handle,
+                    temp1,
+                    len(template1_bytes),
+                    temp2,
+                    len(template2_bytes)
+                )
             
             logger.info(f"Comparación de plantillas - Score: {score}")
             
-            # Umbral de coincidencia
-            # MATCH_THRESHOLD = 60
-            is_match = score >= MATCH_THRESHOLD
+            # Umbral de coincidencia según la política (usuario/dedo > sitio > global)
+            if user_id is not None:
+                threshold = self.threshold_policy.threshold_for(user_id, finger_index, site)
+            else:
+                threshold = self.threshold_policy.site_threshold(site)
+            is_match = score >= threshold
             
             return {
                 'success': True,
                 'match': is_match,
                 'score': score,
-                'threshold': MATCH_THRESHOLD,
+                'threshold': threshold,
                 'message': 'Coincidencia encontrada' if is_match else 'No coincide'
             }
             
@@ -1276,36 +3907,271 @@ class ZKTecoDevice:
                 'message': f'Error al comparar: {str(e)}'
             }
     
+    def cached_identification(self, template_bytes, site=None, partition=None):
+        """Resultado 1:N ya calculado para esta plantilla con la versión residente de la galería.
+
+        Sin E/S ni SDK (se puede llamar desde el loop de asyncio); None si no está en la cache.
+        """
+        partition = partition or GALLERY_PARTITION or None
+        cached = self.match_cache.get(
+            MatchResultCache.make_key(template_bytes, (site, partition)),
+            (self.gallery.version, self.threshold_policy.version)
+        )
+        if cached is not None:
+            logger.info(f"⚡ Resultado 1:N servido desde cache (match: {cached.get('match')})")
+        return cached
+
+    def identify_template(self, template_bytes, site=None, partition=None):
+        """Identificación 1:N de una plantilla contra la galería residente.
+
+        Cada entrada se compara con su propio umbral (ThresholdPolicy); `site`
+        selecciona el umbral de sitio (por defecto SITE_ID). `partition` (por
+        defecto GALLERY_PARTITION) limita la búsqueda a los usuarios habilitados
+        en ese sitio/puerta/grupo; vacío recorre la galería completa.
+        """
+        if not SDK_AVAILABLE:
+            return {'success': False, 'message': 'SDK no disponible para matching.'}
+
+        if not self.db_handle:
+            logger.error("❌ db_handle no disponible para matching 1:N")
+            return {'success': False, 'message': 'Cache de algoritmos no inicializado.'}
+
+        partition = partition or GALLERY_PARTITION or None
+
+        # Reintentos del mismo kiosco: devolver el resultado ya calculado antes de
+        # snapshot(), que puede pedir la firma a api.php
+        cached = self.cached_identification(template_bytes, site, partition)
+        if cached is not None:
+            return cached
+        policy = self.threshold_policy
+        cache_key = MatchResultCache.make_key(template_bytes, (site, partition))
+
+        try:
+            entries, gallery_version = self.gallery.snapshot(partition)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error de conexión con API PHP: {e}")
+            return {'success': False, 'message': f'Error de conexión con el servicio API PHP: {e}'}
+        except Exception as e:
+            logger.error(f"Error al obtener datos de verificación desde API: {e}")
+            return {'success': False, 'message': 'Error al cargar datos de verificación de la BD.'}
+
+        if not entries:
+            if partition:
+                logger.warning(f"No hay plantillas habilitadas en la partición '{partition}'.")
+                return {'success': True, 'match': False, 'partition': partition,
+                        'message': 'No hay huellas habilitadas para este acceso.'}
+            logger.warning("No hay plantillas registradas en la BD para comparar.")
+            return {'success': True, 'match': False, 'message': 'No hay huellas registradas en el sistema.'}
+
+        cache_version = (gallery_version, policy.version)
+
+        # Limitar cuántas identificaciones pueden esperar turno en el SDK
+        if not self._match_slots.acquire(timeout=MATCH_QUEUE_TIMEOUT):
+            logger.warning("⚠️ Demasiadas identificaciones simultáneas - solicitud rechazada")
+            return {'success': False, 'busy': True, 'message': 'Servicio de matching ocupado, intente de nuevo.'}
+
+        # Convertir la plantilla capturada UNA SOLA VEZ
+        probe = (ctypes.c_ubyte * len(template_bytes)).from_buffer_copy(template_bytes)
+        thresholds = policy.resolve(entries, site)
+        early_exit = policy.early_exit
+        matched_entry = None
+        matched_score = 0
+        matched_threshold = None
+        best_score = 0
+        first_hit = None
+        # Distribución completa de scores solo para las consultas muestreadas
+        sampled_scores = [] if self.score_recorder.should_sample() else None
+
+        try:
+            # Candidatos más parecidos primero (y, con fallback, el resto después)
+            plan = self.prefilter.plan(entries, template_bytes)
+        except Exception as e:
+            logger.warning(f"Error en prefiltro de candidatos, se recorre la galería completa: {e}")
+            plan = None
+        scan = plan[0] if plan else range(len(entries))
+
+        try:
+            # Acceso exclusivo al handle de algoritmos (no bloquea al dispositivo ni al registro)
+            wait_start = time.perf_counter()
+            with self._db_lock:
+                # El recorrido se mide desde que se tiene el handle; la espera por el lock va aparte
+                scan_start = time.perf_counter()
+                for position, index in enumerate(scan):
+                    entry = entries[index]
+                    threshold = thresholds[index]
+                    try:
+                        score = zkfp.ZKFPM_DBMatch(
+                            self.db_handle,
+                            probe,
+                            len(template_bytes),
+                            entry['buffer'],
+                            entry['template_size']
+                        )
+                    except Exception as e:
+                        logger.error(f"Error en ZKFPM_DBMatch para usuario {entry['user_id_str']}: {e}")
+                        continue
+
+                    if sampled_scores is not None:
+                        sampled_scores.append((score, index))
+
+                    if score > best_score:
+                        best_score = score
+
+                    if score >= threshold and first_hit is None:
+                        first_hit = position
+
+                    if score >= threshold and score > matched_score:
+                        matched_entry = entry
+                        matched_score = score
+                        matched_threshold = threshold
+                        # Sin early_exit basta la primera coincidencia; con él, solo un score
+                        # suficientemente alto evita seguir buscando un mejor candidato
+                        if early_exit is None or score >= early_exit:
+                            break # Encontrado! Salir del loop 1:N
+                scan_end = time.perf_counter()
+        finally:
+            self._match_slots.release()
+
+        if plan:
+            self.prefilter.record(first_hit, plan[1])
+
+        if sampled_scores is not None:
+            try:
+                self.score_recorder.record(
+                    entries, sampled_scores, first_hit,
+                    (matched_entry, matched_score, matched_threshold) if matched_entry else None,
+                    scan_end - scan_start, site, early_exit, partition, scan_start - wait_start
+                )
+            except Exception as e:
+                logger.warning(f"Error al registrar distribución de scores: {e}")
+
+        if matched_entry:
+            logger.info(f"✅ Coincidencia encontrada para {matched_entry['user_id_str']} con score {matched_score}")
+            self.gallery.record_hit(matched_entry)
+            result = {
+                'success': True,
+                'match': True,
+                'matched_user': {
+                    'id': matched_entry['user_internal_id'],
+                    'user_id': matched_entry['user_id_str'],
+                    'name': matched_entry['name'],
+                    'finger_index': matched_entry['finger_index'],
+                    'score': matched_score,
+                    'threshold': matched_threshold
+                },
+                'best_score': best_score
+            }
+        else:
+            logger.info(f"❌ No se encontró coincidencia (Mejor score: {best_score})")
+            result = {
+                'success': True,
+                'match': False,
+                'message': 'Huella no reconocida',
+                'best_score': best_score
+            }
+        if partition:
+            result['partition'] = partition
+        if plan:
+            result['prefilter_candidates'] = plan[1]
+
+        # El cache guarda el resultado sin `access_logged`: un reintento servido desde
+        # cache no pasa por la bitácora del bridge y el frontend lo registra él mismo
+        self.match_cache.put(cache_key, cache_version, result)
+
+        # Bitácora en lote desde el bridge
+        return {**result, 'access_logged': self.access_log.record(
+            matched_entry['user_internal_id'] if matched_entry else None,
+            'success' if matched_entry else 'failed'
+        )}
+
+    def warm_up(self):
+        """Primera comparación fuera del camino crítico (la DLL inicializa su matcher en el primer uso)"""
+        if not SDK_AVAILABLE or not self.db_handle:
+            return {'success': False, 'message': 'Cache de algoritmos no inicializado.'}
+
+        entries = self.gallery.entries
+        if not entries:
+            return {'success': True, 'message': 'Galería vacía - sin calentamiento'}
+
+        entry = entries[0]
+        with self._db_lock:
+            score = zkfp.ZKFPM_DBMatch(
+                self.db_handle, entry['buffer'], entry['template_size'], entry['buffer'], entry['template_size']
+            )
+        return {'success': True, 'message': f'Comparación de calentamiento completada (score {score})'}
+
+    def get_capture_history(self):
+        """Metadatos de las capturas recientes (sin imagen ni plantilla)"""
+        return [frame.summary() for frame in list(self.frame_history)]
+
+    def get_last_capture_debug(self):
+        """Resumen de last_capture sin la imagen ni la plantilla (para debugging)"""
+        capture = self._compose_capture(include_image=False)
+        if not capture:
+            return {
+                'success': False,
+                'message': 'No hay datos en last_capture',
+                'current_mode': self.current_mode,
+                'register_count': self.register_count
+            }
+
+        # Excluir la plantilla para reducir payload
+        debug_data = {k: v for k, v in capture.items() if k not in ['image', 'template']}
+        
+        # Agregar información de longitud de datos grandes
+        if 'final_template' in capture:
+            debug_data['final_template_length'] = len(capture['final_template'])
+        if 'template' in capture:
+            debug_data['template_length'] = len(capture['template'])
+        
+        return {
+            'success': True,
+            'last_capture': debug_data,
+            'current_mode': self.current_mode,
+            'register_count': self.register_count,
+            'is_capturing': self.is_capturing
+        }
+
     def get_registration_status(self):
         """Obtener estado detallado del registro para debugging"""
+        capture = self._compose_capture(include_image=False)
         status = {
             'current_mode': self.current_mode,
             'register_count': self.register_count,
             'templates_stored': len(self.register_templates),
             'device_connected': self.device_handle is not None,
             'is_capturing': self.is_capturing,
-            'last_capture_has_final': self.last_capture.get('final_template') if self.last_capture else False,
-            'last_capture_complete': self.last_capture.get('registration_complete') if self.last_capture else False
+            'last_capture_has_final': capture.get('final_template') if capture else False,
+            'last_capture_complete': capture.get('registration_complete') if capture else False
         }
         
         logger.info(f"Estado registro: {status}")
         return status
     
-    def reset_registration(self):
-        """Resetear estado de registro - llamado por el frontend después de guardar"""
+    def reset_registration(self, session_id=None):
+        """Cerrar una sesión de registro - llamado por el frontend después de guardar.
+
+        Sin `session_id` se cierra la sesión que tiene el sensor (compatibilidad);
+        las sesiones en cola de otros operadores no se tocan.
+        """
         try:
-            with self._lock:
-                logger.info("Reset manual de registro solicitado por frontend")
+            with self._registration_lock:
+                logger.info(f"Reset manual de registro solicitado por frontend (sesión: {session_id or 'activa'})")
                 
-                self.register_count = 0
-                self.register_templates = []
-                self.current_mode = "idle"
+                if session_id is not None:
+                    session = self.enrollments.get(session_id)
+                    if session is None:
+                        return {
+                            'success': False,
+                            'message': 'Sesión de registro no encontrada o expirada'
+                        }
+                else:
+                    session = self._enrollment
                 
-                # Limpiar datos de registro del last_capture
-                if self.last_capture:
-                    for field in ['registration_complete', 'final_template', 'register_count', 'registration_in_progress', 'registration_error']:
-                        if field in self.last_capture:
-                            del self.last_capture[field]
+                if session is not None:
+                    self._release_enrollment(session, session.state if session.finished else "cancelled")
+                elif self.current_mode == "registering":
+                    self.current_mode = "idle"
                 
                 logger.info("Estado de registro reseteado completamente")
             
@@ -1323,21 +4189,145 @@ class ZKTecoDevice:
                 'message': f'Error al resetear: {str(e)}'
             }
 
+# ==================== ARRANQUE EN SEGUNDO PLANO ====================
+class ServiceBootstrap:
+    """Arranque del servicio en etapas, fuera del hilo que levanta el servidor HTTP.
+
+    sdk -> device -> gallery -> warmup. Las etapas del SDK y del dispositivo se
+    reintentan (con espera creciente hasta BOOTSTRAP_MAX_RETRY_INTERVAL) hasta que
+    funcionen, p. ej. mientras Windows termina de reinstalar el driver USB tras una
+    actualización; la galería y el calentamiento son de mejor esfuerzo (la galería
+    se vuelve a cargar sola en la primera identificación). El servicio está listo
+    (`ready`) cuando el dispositivo quedó abierto y capturando.
+    """
+
+    STAGES = ('sdk', 'device', 'gallery', 'warmup')
+
+    def __init__(self, device, retry_interval=BOOTSTRAP_RETRY_INTERVAL):
+        self.device = device
+        self.retry_interval = max(retry_interval, 0.1)
+        self.started_at = None
+        self.ready_at = None
+        self.stages = {
+            name: {'state': 'pending', 'attempts': 0, 'duration_ms': None, 'message': None}
+            for name in self.STAGES
+        }
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.stages['device']['state'] == 'done'
+
+    def start(self):
+        """Lanzar el arranque (una sola vez mientras siga en curso)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return False
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='bootstrap', daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run_stage(self, name, func, retry=False):
+        """Ejecutar una etapa; con `retry` se repite hasta lograrlo o hasta stop()"""
+        stage = self.stages[name]
+        delay = self.retry_interval
+        while not self._stop.is_set():
+            stage['state'] = 'running'
+            stage['attempts'] += 1
+            start = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                result = {'success': False, 'message': f'Excepción: {e}'}
+            stage['duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+            stage['message'] = result.get('message')
+
+            if result.get('success'):
+                stage['state'] = 'done'
+                logger.info(f"✅ Arranque [{name}]: {stage['message']} ({stage['duration_ms']} ms)")
+                return True
+
+            if not retry:
+                stage['state'] = 'failed'
+                logger.warning(f"⚠️ Arranque [{name}] falló: {stage['message']}")
+                return False
+
+            stage['state'] = 'retrying'
+            if stage['attempts'] == 1:
+                logger.warning(f"⚠️ Arranque [{name}] falló: {stage['message']} - reintentando en segundo plano")
+            self._stop.wait(delay)
+            delay = min(delay * 2, BOOTSTRAP_MAX_RETRY_INTERVAL)
+        return False
+
+    def _load_sdk(self):
+        if load_sdk():
+            return {'success': True, 'message': 'SDK cargado'}
+        return {'success': False, 'message': 'SDK no disponible. Instale ZKFingerSDK 5.x'}
+
+    def _open_device(self):
+        device = self.device
+        if device.device_handle and device.is_capturing:
+            return {'success': True, 'message': 'Dispositivo ya abierto'}
+        result = device.open_device(DEVICE_INDEX)
+        if result.get('success'):
+            device.start_capture()
+        return result
+
+    def _load_gallery(self):
+        entries, version = self.device.gallery.snapshot()
+        return {'success': True, 'message': f'{len(entries)} plantillas (versión {version})'}
+
+    def _run(self):
+        logger.info("🚀 Arranque en segundo plano iniciado")
+        if not self._run_stage('sdk', self._load_sdk, retry=True):
+            return
+        if not self._run_stage('device', self._open_device, retry=True):
+            return
+        self.ready_at = time.time()
+        logger.info(f"✅ Servicio listo en {self.ready_at - self.started_at:.1f} s")
+        self._run_stage('gallery', self._load_gallery)
+        self._run_stage('warmup', self.device.warm_up)
+
+    def get_status(self):
+        return {
+            'ready': self.ready,
+            'started_at': self.started_at,
+            'ready_in_s': round(self.ready_at - self.started_at, 2) if self.ready_at and self.started_at else None,
+            'stages': {name: dict(stage) for name, stage in self.stages.items()}
+        }
+
 # ==================== INSTANCIA GLOBAL ====================
 device = ZKTecoDevice()
+bootstrap = ServiceBootstrap(device)
+profiler = SamplingProfiler()
 
 # ==================== RUTAS DE LA API ====================
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Health check del servicio"""
+    """Health check del servicio (responde desde el arranque; `ready` indica si el dispositivo está listo)"""
     return jsonify({
         'success': True,
         'message': 'ZKTeco Bridge Service Running',
         'version': '4.0.0',
         'timestamp': datetime.now().isoformat(),
-        'sdk_available': SDK_AVAILABLE
+        'sdk_available': SDK_AVAILABLE,
+        'ready': bootstrap.ready,
+        'bootstrap': bootstrap.get_status()
     })
 
+@app.route('/api/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness para monitores/balanceadores: 503 hasta que el dispositivo esté abierto"""
+    status = bootstrap.get_status()
+    return jsonify({'success': status['ready'], **status}), (200 if status['ready'] else 503)
+
 @app.route('/api/device/initialize', methods=['POST'])
 def initialize_device():
     """Inicializar dispositivo"""
@@ -1374,15 +4364,22 @@ def device_status():
 
 @app.route('/api/device/verify_connection', methods=['GET'])
 def verify_connection():
-    """Verificar estado de conexión del dispositivo"""
-    logger.info("Solicitud: Verificar conexión del dispositivo")
-    
-    is_connected = device._verify_device_connection()
+    """Verificar estado de conexión del dispositivo.
+
+    Responde desde el estado de salud cacheado; solo sondea el lector si la última
+    interacción exitosa es más vieja que `max_age` (segundos, por defecto HEALTH_MAX_AGE).
+    """
+    max_age = request.args.get('max_age', HEALTH_MAX_AGE, type=float)
+    health = device.health.check(max_age)
+    is_connected = health['connected']
     
     return jsonify({
-        'success': is_connected,
-        'connected': is_connected,
-        'message': 'Dispositivo conectado y respondiendo' if is_connected else 'Dispositivo desconectado o no responde'
+        'success': bool(is_connected),
+        'connected': is_connected, # None: otro sondeo en curso y aún sin estado conocido
+        'message': 'Dispositivo conectado y respondiendo' if is_connected
+                   else 'Verificando el dispositivo' if is_connected is None
+                   else 'Dispositivo desconectado o no responde',
+        'health': health
     })
 
 @app.route('/api/capture/start', methods=['POST'])
@@ -1401,10 +4398,20 @@ def stop_capture():
 
 @app.route('/api/capture/get', methods=['GET'])
 def get_capture():
-    """Obtener última captura"""
-    result = device.get_last_capture()
+    """Obtener última captura (?since=<version>&include_image=0&session=<id> opcionales)"""
+    since = request.args.get('since', type=int)
+    include_image = request.args.get('include_image', '1').lower() not in ('0', 'false', 'no')
+    result = device.get_last_capture(since, include_image, request.args.get('session'))
     return jsonify(result)
 
+@app.route('/api/capture/history', methods=['GET'])
+def capture_history():
+    """Metadatos de las capturas recientes"""
+    return jsonify({
+        'success': True,
+        'frames': device.get_capture_history()
+    })
+
 @app.route('/api/mode/set', methods=['POST'])
 def set_mode():
     """Establecer modo (idle, registering, verifying)"""
@@ -1417,10 +4424,39 @@ def set_mode():
         }), 400
     
     mode = data.get('mode', 'idle')
+    auto_identify = data.get('auto_identify', False)
     logger.info(f"Solicitud: Cambiar modo a '{mode}'")
-    result = device.set_mode(mode)
+    result = device.set_mode(mode, auto_identify, data.get('label'), data.get('samples'), data.get('store_templates'))
     return jsonify(result)
 
+@app.route('/api/enrollment', methods=['GET'])
+def list_enrollments():
+    """Sesiones de registro abiertas (activa y en cola)"""
+    return jsonify(device.list_enrollments())
+
+@app.route('/api/enrollment/open', methods=['POST'])
+def open_enrollment():
+    """Abrir una sesión de registro (queda en cola si el sensor está ocupado)"""
+    data = request.get_json(silent=True) or {}
+    logger.info(f"Solicitud: Abrir sesión de registro ({data.get('label') or 'sin etiqueta'})")
+    result = device.open_enrollment(data.get('label'), data.get('samples'), data.get('store_templates'))
+    if result.get('success'):
+        return jsonify(result)
+    return jsonify(result), 429 if result.get('busy') else 400
+
+@app.route('/api/enrollment/<session_id>', methods=['GET'])
+def get_enrollment(session_id):
+    """Estado de una sesión de registro (?since=<version> opcional)"""
+    result = device.get_enrollment(session_id, request.args.get('since', type=int))
+    return jsonify(result), 200 if result.get('success') else 404
+
+@app.route('/api/enrollment/<session_id>/cancel', methods=['POST'])
+def cancel_enrollment(session_id):
+    """Cerrar una sesión de registro sin afectar a las demás"""
+    logger.info(f"Solicitud: Cerrar sesión de registro {session_id}")
+    result = device.reset_registration(session_id)
+    return jsonify(result), 200 if result.get('success') else 404
+
 @app.route('/api/compare', methods=['POST'])
 def compare_templates():
     """Comparar dos plantillas de huellas"""
@@ -1442,153 +4478,156 @@ def compare_templates():
         }), 400
     
     logger.info("Solicitud: Comparar plantillas")
-    result = device.compare_templates(template1, template2)
+    result = device.compare_templates(
+        template1, template2,
+        data.get('user_id'), data.get('finger_index'), data.get('site')
+    )
     return jsonify(result)
 
-# bridge_service.py - Agregar la nueva ruta (por ejemplo, después de @app.route('/api/registration/reset', methods=['POST']))
-
 @app.route('/api/db/match_one_to_many', methods=['POST'])
 def match_one_to_many_api():
     """
-    Verifica una plantilla capturada contra TODAS las plantillas en la BD (1:N).
-    Esta es la nueva arquitectura segura.
+    Verifica una plantilla capturada contra las plantillas de la BD (1:N), todas
+    o solo las de la partición indicada ("partition": sitio/puerta/grupo).
+    Las plantillas se mantienen en una galería residente y los reintentos de la
+    misma plantilla se responden desde la cache de resultados.
     """
-    if not SDK_AVAILABLE:
-        return jsonify({'success': False, 'message': 'SDK no disponible para matching.'}), 500
-
-    data = request.get_json()
+    data = request.get_json() or {}
     captured_template_b64 = data.get('captured_template')
 
     if not captured_template_b64:
         return jsonify({'success': False, 'message': 'Plantilla de huella capturada faltante.'}), 400
 
-    # ✅ VERIFICAR db_handle
-    if not device.db_handle:
-        logger.error("❌ db_handle no disponible para matching 1:N")
-        return jsonify({'success': False, 'message': 'Cache de algoritmos no inicializado.'}), 500
+    try:
+        template_bytes = base64.b64decode(captured_template_b64)
+    except Exception as e:
+        logger.error(f"Error al decodificar plantilla capturada: {e}")
+        return jsonify({'success': False, 'message': 'Plantilla de huella capturada inválida.'}), 400
 
-    # 1. Recuperar plantillas registradas desde la API PHP (SEGURIDAD)
     try:
-        logger.info(f"Obteniendo plantillas registradas desde API PHP...")
-        # Llama a la nueva ruta segura en api.php
-        response = requests.get(f"{PHP_API_URL}?action=get_verification_data")
-        response.raise_for_status() # Lanza excepción para errores HTTP
-        
-        db_data = response.json()
-        if not db_data.get('success'):
-            logger.error(f"Error al obtener datos de verificación desde API: {db_data.get('message')}")
-            return jsonify({'success': False, 'message': 'Error al cargar datos de verificación de la BD.'}), 500
-        
-        registered_templates = db_data.get('data', [])
-        if not registered_templates:
-            logger.warning("No hay plantillas registradas en la BD para comparar.")
-            return jsonify({'success': True, 'match': False, 'message': 'No hay huellas registradas en el sistema.'})
+        result = device.identify_template(template_bytes, data.get('site'), data.get('partition'))
+    except Exception as e:
+        logger.error(f"Error crítico en match_one_to_many_api: {e}")
+        return jsonify({'success': False, 'message': 'Error interno durante el matching.'}), 500
 
-        logger.info(f"Plantillas obtenidas para matching: {len(registered_templates)}")
+    if result.get('success'):
+        return jsonify(result)
+    return jsonify(result), (503 if result.get('busy') else 500)
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error de conexión con API PHP: {e}")
-        return jsonify({'success': False, 'message': f'Error de conexión con el servicio API PHP: {e}'}), 500
-    
-    # except Exception as e:
-    #    logger.error(f"Error inesperado al procesar datos de la API: {e}")
-    #    return jsonify({'success': False, 'message': 'Error interno al procesar plantillas.'}), 500
+@app.route('/api/policy/thresholds', methods=['GET'])
+def get_threshold_policy():
+    """Política de umbrales vigente"""
+    return jsonify({
+        'success': True,
+        'policy': device.threshold_policy.get_status()
+    })
 
-    # 2. Convertir la plantilla capturada
+@app.route('/api/policy/thresholds/reload', methods=['POST'])
+def reload_threshold_policy():
+    """Recargar la política de umbrales desde THRESHOLD_POLICY_FILE"""
+    logger.info("Solicitud: Recargar política de umbrales")
     try:
-        template_bytes = base64.b64decode(captured_template_b64)
-        
-        # Bloqueo del dispositivo para asegurar el acceso exclusivo al SDK.
-        with device._lock:
-            # Convertir la plantilla capturada UNA SOLA VEZ
-            template1 = (ctypes.c_ubyte * len(template_bytes)).from_buffer_copy(template_bytes)
-
-            # 3. Realizar el matching 1:N
-            matched_user = None
-            best_score = 0
-            
-            for template_data in registered_templates:
-                try:
-                    registered_template_bytes = base64.b64decode(template_data.get('template'))
-                    template2 = (ctypes.c_ubyte * len(registered_template_bytes)).from_buffer_copy(registered_template_bytes)
+        policy = device.threshold_policy.load()
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f"Política de umbrales inválida: {e}")
+        return jsonify({'success': False, 'message': f'Política de umbrales inválida: {e}'}), 400
+    return jsonify({'success': True, 'policy': policy})
 
-                    # ZKFPM_DBMatch (handle, temp1, len1, temp2, len2)
-                    score = zkfp.ZKFPM_DBMatch(
-                        device.db_handle,
-                        template1,
-                        len(template_bytes),
-                        template2,
-                        len(registered_template_bytes)
-                    )
+@app.route('/api/gallery/changes', methods=['POST'])
+def gallery_changes():
+    """Cambios puntuales de la galería notificados por api.php (registro, borrado, particiones)"""
+    if not gallery_change_allowed(request.remote_addr, request.headers.get('X-Gallery-Token')):
+        return jsonify({'success': False, 'message': 'Notificación no autorizada'}), 403
 
-                    if score > best_score:
-                        best_score = score
+    changes = parse_gallery_changes(request.get_json(silent=True))
+    if changes is None:
+        return jsonify({'success': False, 'message': 'Se requiere {"changes": [{"user_internal_id", "rows", "signature"}]}'}), 400
 
-                    if score >= MATCH_THRESHOLD:
-                        matched_user = template_data
-                        matched_user['score'] = score
-                        break # Encontrado! Salir del loop 1:N
+    applied = sum(1 for change in changes if device.gallery.apply_change(change))
+    return jsonify({'success': True, 'applied': applied, 'version': device.gallery.version})
 
-                except Exception as e:
-                    logger.error(f"Error en ZKFPM_DBMatch para usuario {template_data.get('user_id_str')}: {e}")
-                    # Continuar con el siguiente
-                    
-        # 3. Devolver resultado
-        if matched_user:
-            logger.info(f"✅ Coincidencia encontrada para {matched_user.get('user_id_str')} con score {matched_user.get('score')}")
-            return jsonify({
-                'success': True,
-                'match': True,
-                'matched_user': {
-                    'id': matched_user.get('user_internal_id'),
-                    'user_id': matched_user.get('user_id_str'),
-                    'name': matched_user.get('name'),
-                    'finger_index': matched_user.get('finger_index'),
-                    'score': matched_user.get('score')
-                },
-                'best_score': best_score
-            })
-        else:
-            logger.info(f"❌ No se encontró coincidencia (Mejor score: {best_score})")
-            return jsonify({
-                'success': True,
-                'match': False,
-                'message': 'Huella no reconocida',
-                'best_score': best_score
-            })
-            
-    except Exception as e:
-        logger.error(f"Error crítico en match_one_to_many_api: {e}")
-        return jsonify({'success': False, 'message': 'Error interno durante el matching.'}), 500
+@app.route('/api/debug/match_cache', methods=['GET'])
+def debug_match_cache():
+    """Endpoint de debugging para la galería residente y la cache de resultados 1:N"""
+    return jsonify({
+        'success': True,
+        'gallery': device.gallery.get_status(),
+        'cache': device.match_cache.get_status(),
+        'prefilter': device.prefilter.get_status()
+    })
+
+@app.route('/api/debug/capture_recorder', methods=['GET'])
+def debug_capture_recorder():
+    """Estado de la grabación de capturas y, si el lector es una grabación, del replay"""
+    return jsonify({
+        'success': True,
+        'recorder': device.capture_recorder.get_status(),
+        'replay': replay_status()
+    })
+
+@app.route('/api/debug/sdk_calls', methods=['GET', 'POST'])
+def debug_sdk_calls():
+    """Conteos, histogramas de latencia y códigos de retorno por función del SDK.
+
+    POST {"enabled": true|false, "reset": true} activa/desactiva la medición o reinicia los conteos.
+    """
+    if not debug_admin_allowed(request.remote_addr, request.headers.get('X-Admin-Token')):
+        return jsonify({'success': False, 'message': 'No autorizado'}), 403
+    if not isinstance(zkfp, InstrumentedSDK):
+        return jsonify({'success': False, 'message': 'SDK no cargado'}), 503
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if data.get('reset'):
+            zkfp.reset()
+        if 'enabled' in data:
+            zkfp.set_enabled(data['enabled'])
+    return jsonify({'success': True, 'sdk_calls': zkfp.get_status()})
+
+@app.route('/api/debug/profile', methods=['GET', 'POST'])
+def debug_profile():
+    """Perfil de muestreo de los hilos (POST {"seconds", "interval_ms", "threads": ["capture", ...]}).
+
+    El POST bloquea durante el perfil y lo devuelve; GET devuelve el último.
+    """
+    if not debug_admin_allowed(request.remote_addr, request.headers.get('X-Admin-Token')):
+        return jsonify({'success': False, 'message': 'No autorizado'}), 403
+    if request.method == 'GET':
+        return jsonify({'success': True, 'running': profiler.running, 'profile': profiler.last})
+
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 5))
+        interval = float(data.get('interval_ms', PROFILE_INTERVAL * 1000)) / 1000.0
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'seconds e interval_ms deben ser números'}), 400
+    threads = data.get('threads')
+    if isinstance(threads, str):
+        threads = [threads]
+    # Un solo perfil a la vez: no ocupar otro worker esperando
+    if profiler.running:
+        return jsonify({'success': False, 'message': 'Ya hay un perfil en curso'}), 409
+
+    logger.info(f"Solicitud: Perfil de muestreo ({seconds}s, hilos: {threads or 'todos'})")
+    profile = profiler.run(seconds, interval, threads)
+    if profile is None:
+        return jsonify({'success': False, 'message': 'Ya hay un perfil en curso'}), 409
+    return jsonify({'success': True, 'profile': profile})
+
+@app.route('/api/debug/access_log', methods=['GET'])
+def debug_access_log():
+    """Estado de la bitácora de accesos en lote"""
+    return jsonify({'success': True, 'access_log': device.access_log.get_status()})
+
+@app.route('/api/debug/score_recorder', methods=['GET'])
+def debug_score_recorder():
+    """Estado del muestreo de distribuciones de scores 1:N"""
+    return jsonify({'success': True, 'recorder': device.score_recorder.get_status()})
 
 @app.route('/api/debug/last_capture', methods=['GET'])
 def debug_last_capture():
     """Endpoint para inspeccionar el estado actual de last_capture"""
     try:
-        if device.last_capture:
-            # Crear copia sin la imagen para reducir payload
-            debug_data = {k: v for k, v in device.last_capture.items() if k not in ['image', 'template']}
-            
-            # Agregar información de longitud de datos grandes
-            if 'final_template' in device.last_capture:
-                debug_data['final_template_length'] = len(device.last_capture['final_template'])
-            if 'template' in device.last_capture:
-                debug_data['template_length'] = len(device.last_capture['template'])
-            
-            return jsonify({
-                'success': True,
-                'last_capture': debug_data,
-                'current_mode': device.current_mode,
-                'register_count': device.register_count,
-                'is_capturing': device.is_capturing
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': 'No hay datos en last_capture',
-                'current_mode': device.current_mode,
-                'register_count': device.register_count
-            })
+        return jsonify(device.get_last_capture_debug())
     except Exception as e:
         logger.error(f"Error en debug_last_capture: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -1615,9 +4654,10 @@ def debug_thread_status():
 
 @app.route('/api/registration/reset', methods=['POST'])
 def reset_registration():
-    """Resetear estado de registro"""
+    """Resetear estado de registro ({"session_id": ...} opcional)"""
+    data = request.get_json(silent=True) or {}
     logger.info("Solicitud: Resetear registro")
-    result = device.reset_registration()
+    result = device.reset_registration(data.get('session_id'))
     return jsonify(result)
 
 @app.errorhandler(404)
@@ -1640,18 +4680,52 @@ def internal_error(error):
     }), 500
 
 # ==================== INICIO DEL SERVICIO ====================
+def run_server():
+    """Servir la aplicación según SERVER_MODE.
+
+    En modo 'production' se usa waitress: un único proceso (dueño exclusivo del
+    dispositivo USB) con HTTP_THREADS hilos atendiendo solicitudes. Con AUTO_START
+    el SDK y el dispositivo se preparan en segundo plano mientras el servidor ya responde.
+    """
+    if AUTO_START:
+        bootstrap.start()
+
+    if SERVER_MODE == 'production':
+        try:
+            from waitress import serve
+        except ImportError:
+            logger.error("waitress no está instalado (pip install waitress) - usando servidor de desarrollo")
+        else:
+            logger.info(f"Servidor de producción (waitress) en {HOST}:{PORT} - "
+                        f"hilos HTTP: {HTTP_THREADS}, matching simultáneo: {MATCH_CONCURRENCY}")
+            serve(
+                app,
+                host=HOST,
+                port=PORT,
+                threads=HTTP_THREADS,
+                connection_limit=HTTP_CONNECTION_LIMIT,
+                ident='ZKTecoBridge'
+            )
+            return
+
+    logger.info(f"Servidor de desarrollo (Werkzeug) en {HOST}:{PORT}")
+    app.run(
+        host=HOST,
+        port=PORT,
+        debug=DEBUG,
+        threaded=True,
+        use_reloader=False
+    )
+
 if __name__ == '__main__':
     print("=" * 60)
     print("ZKTeco USB Bridge Service v4.0.0 - VERSIÓN FINAL")
     print("Sistema de Registro Biométrico de Usuarios")
     print("=" * 60)
-    print(f"SDK Disponible: {'Sí' if SDK_AVAILABLE else 'No'}")
-    print(f"Iniciando servicio en http://localhost:5000")
-    
-    if not SDK_AVAILABLE:
-        print("\nADVERTENCIA: SDK no disponible")
-        print("Instale ZKFingerSDK 5.x desde:")
-        print("https://www.zkteco.com/en/index/Service/load/id/632.html")
+    print(f"Arranque automático: {'Sí (SDK y dispositivo en segundo plano, ver /api/health)' if AUTO_START else 'No'}")
+    print(f"Iniciando servicio en http://{HOST}:{PORT} (modo: {SERVER_MODE})")
+    print("Si el SDK no carga, instale ZKFingerSDK 5.x desde:")
+    print("https://www.zkteco.com/en/index/Service/load/id/632.html")
     
     print("=" * 60)
     print("\nCaracterísticas implementadas:")
@@ -1669,15 +4743,10 @@ if __name__ == '__main__':
     print("\nPresione Ctrl+C para detener el servicio\n")
     
     try:
-        app.run(
-            host='0.0.0.0',
-            port=5000,
-            debug=False,
-            threaded=True,
-            use_reloader=False
-        )
+        run_server()
     except KeyboardInterrupt:
         print("\nDeteniendo servicio...")
+        device.access_log.flush()
         device.close_device()
         print("Servicio detenido correctamente")
     except Exception as e:
@@ -0,0 +1,297 @@
+"""
+Calibración de umbrales para ZKTeco Bridge Service
+Calcula curvas FAR/FRR a partir de scores de comparación genuinos e impostores
+y recomienda el umbral de operación, el score de salida temprana (early_exit)
+y umbrales por usuario para la política de bridge_service.py.
+
+Formato de entrada (CSV con encabezado o JSON por línea):
+    score,genuine,user_id,finger_index
+    74,1,EMP001,2
+    31,0,EMP001,2
+
+    {"score": 74, "genuine": true, "user_id": "EMP001", "finger_index": 2}
+
+`user_id` y `finger_index` son opcionales (solo para recomendaciones por usuario).
+
+Con --traffic los archivos son las muestras de SCORE_LOG_FILE (distribuciones de
+scores de identificaciones 1:N reales) y se resume profundidad de búsqueda,
+posición de la primera coincidencia, tiempos y separación top-1/top-2.
+
+Uso:
+    python calibrate_thresholds.py scores.csv [scores2.jsonl ...]
+        [--target-far 0.001] [--curve curva.csv] [--write-policy threshold_policy.json]
+    python calibrate_thresholds.py --traffic logs/match_scores.jsonl*
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from collections import defaultdict
+
+TARGET_FARS = (1e-2, 1e-3, 1e-4)
+
+
+def print_header(text):
+    print("\n" + "=" * 60)
+    print(f"  {text}")
+    print("=" * 60)
+
+
+def parse_bool(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'si', 'sí', 'genuine', 'genuino')
+
+
+def load_samples(paths):
+    """Leer muestras (score, genuino, usuario, dedo) de archivos CSV o JSON por línea"""
+    samples = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            first = f.readline()
+            f.seek(0)
+            if first.lstrip().startswith('{'):
+                rows = (json.loads(line) for line in f if line.strip())
+            else:
+                rows = csv.DictReader(f)
+
+            for row in rows:
+                try:
+                    score = int(float(row['score']))
+                except (KeyError, TypeError, ValueError):
+                    continue
+                samples.append((
+                    score,
+                    parse_bool(row.get('genuine', '0')),
+                    row.get('user_id') or None,
+                    row.get('finger_index') or None
+                ))
+    return samples
+
+
+def rate_curve(genuine, impostor, max_score):
+    """FAR(t) y FRR(t) para cada umbral t en [0, max_score + 1].
+
+    Se acepta cuando score >= t: FAR = impostores aceptados, FRR = genuinos rechazados.
+    """
+    genuine_hist = [0] * (max_score + 2)
+    impostor_hist = [0] * (max_score + 2)
+    for score in genuine:
+        genuine_hist[score] += 1
+    for score in impostor:
+        impostor_hist[score] += 1
+
+    curve = []
+    impostor_accepted = len(impostor)
+    genuine_rejected = 0
+    for t in range(max_score + 2):
+        far = impostor_accepted / len(impostor) if impostor else 0.0
+        frr = genuine_rejected / len(genuine) if genuine else 0.0
+        curve.append((t, far, frr))
+        impostor_accepted -= impostor_hist[t]
+        genuine_rejected += genuine_hist[t]
+    return curve
+
+
+def operating_point(curve, target_far):
+    """Menor umbral cuyo FAR no supera el objetivo (el de menor FRR posible)"""
+    for t, far, frr in curve:
+        if far <= target_far:
+            return t, far, frr
+    return curve[-1]
+
+
+def equal_error_rate(curve):
+    t, far, frr = min(curve, key=lambda point: abs(point[1] - point[2]))
+    return t, (far + frr) / 2
+
+
+def early_exit_score(curve, genuine, margin):
+    """Score desde el cual ningún impostor observado llega (más un margen de seguridad).
+
+    Devuelve el score y la fracción de consultas genuinas que podrían detener la
+    búsqueda 1:N en ese punto.
+    """
+    clean = next((t for t, far, _ in curve if far == 0.0), curve[-1][0])
+    score = clean + margin
+    fraction = sum(1 for s in genuine if s >= score) / len(genuine) if genuine else 0.0
+    return score, fraction
+
+
+def user_recommendations(samples, threshold, floor, max_user_frr, min_samples):
+    """Usuarios/dedos cuyo FRR al umbral global supera max_user_frr.
+
+    Se recomienda el mayor umbral (nunca por debajo de `floor`) que deja su FRR
+    dentro del máximo, solo si hay al menos `min_samples` muestras genuinas.
+    Devuelve (recomendaciones, bloqueados): los bloqueados son los dedos que no
+    se pueden bajar del umbral global sin superar el FAR permitido.
+    """
+    by_finger = defaultdict(list)
+    for score, is_genuine, user_id, finger_index in samples:
+        if is_genuine and user_id:
+            by_finger[(user_id, finger_index)].append(score)
+
+    recommendations = {}
+    blocked = {}
+    for (user_id, finger_index), scores in sorted(by_finger.items()):
+        if len(scores) < min_samples:
+            continue
+        frr = sum(1 for s in scores if s < threshold) / len(scores)
+        if frr <= max_user_frr:
+            continue
+
+        candidate = threshold
+        while candidate > floor and sum(1 for s in scores if s < candidate) / len(scores) > max_user_frr:
+            candidate -= 1
+
+        key = f"{user_id}:{finger_index}" if finger_index else str(user_id)
+        if candidate >= threshold:
+            # El piso detuvo la baja: fijar el umbral de hoy no aporta nada a la política
+            blocked[key] = {'samples': len(scores), 'frr_at_global': round(frr, 4)}
+            continue
+        recommendations[key] = {
+            'samples': len(scores),
+            'frr_at_global': round(frr, 4),
+            'threshold': candidate
+        }
+    return recommendations, blocked
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Percentiles por rango más cercano (valores ya sin None)"""
+    values = sorted(values)
+    if not values:
+        return {p: None for p in points}
+    return {p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] for p in points}
+
+
+def traffic_summary(paths):
+    """Resumen de las muestras del ScoreRecorder del bridge"""
+    samples = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:
+                    continue
+
+    if not samples:
+        print("❌ No hay muestras de tráfico")
+        sys.exit(1)
+
+    matched = [s for s in samples if s.get('matched')]
+    gaps = [s['top'][0]['score'] - s['top'][1]['score'] for s in samples if len(s.get('top') or []) >= 2]
+    rows = (
+        ('Tamaño de galería', [s.get('gallery_size') for s in samples]),
+        ('Plantillas comparadas', [s.get('scanned') for s in samples]),
+        ('Primera coincidencia', [s.get('first_hit') for s in matched]),
+        ('Tiempo total (ms)', [s.get('elapsed_ms') for s in samples]),
+        ('Espera del handle (ms)', [s.get('wait_ms') for s in samples]),
+        ('Tiempo por match (us)', [s.get('per_match_us') for s in samples]),
+        ('Score del mejor', [s['top'][0]['score'] for s in samples if s.get('top')]),
+        ('Brecha top-1/top-2', gaps),
+    )
+
+    print_header("TRÁFICO 1:N MUESTREADO")
+    print(f"   Consultas: {len(samples)}   Con coincidencia: {len(matched)} ({len(matched) / len(samples):.1%})")
+    print(f"\n   {'':<24}{'p50':>10}{'p90':>10}{'p99':>10}")
+    for label, values in rows:
+        p = percentiles([v for v in values if v is not None])
+        print(f"   {label:<24}" + "".join(f"{'-' if p[k] is None else round(p[k], 2):>10}" for k in (50, 90, 99)))
+
+
+def write_curve(path, curve):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['threshold', 'far', 'frr'])
+        for t, far, frr in curve:
+            writer.writerow([t, f"{far:.6f}", f"{frr:.6f}"])
+
+
+def write_policy(path, threshold, early_exit, users):
+    """Actualizar (o crear) el archivo de política conservando sitios y entradas existentes"""
+    policy = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            policy = json.load(f)
+
+    policy['default'] = threshold
+    policy['early_exit'] = early_exit
+    for key, rec in users.items():
+        section = 'fingers' if ':' in key else 'users'
+        policy.setdefault(section, {})[key] = rec['threshold']
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(policy, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibración FAR/FRR de umbrales de coincidencia')
+    parser.add_argument('files', nargs='+', help='Archivos CSV o JSON por línea con scores etiquetados')
+    parser.add_argument('--target-far', type=float, default=1e-3, help='FAR objetivo del umbral de operación')
+    parser.add_argument('--early-exit-margin', type=int, default=5, help='Margen sobre el mayor score impostor observado')
+    parser.add_argument('--max-user-frr', type=float, default=0.05, help='FRR máximo tolerado por usuario/dedo')
+    parser.add_argument('--user-far-factor', type=float, default=10.0, help='Los umbrales por usuario no bajan del punto FAR objetivo x este factor')
+    parser.add_argument('--min-samples', type=int, default=20, help='Muestras genuinas mínimas para recomendar un umbral por usuario')
+    parser.add_argument('--curve', help='Exportar la curva FAR/FRR a este CSV')
+    parser.add_argument('--write-policy', help='Escribir la recomendación en este archivo de política JSON')
+    parser.add_argument('--traffic', action='store_true', help='Resumir muestras de SCORE_LOG_FILE en lugar de calibrar')
+    args = parser.parse_args()
+
+    if args.traffic:
+        traffic_summary(args.files)
+        return
+
+    samples = load_samples(args.files)
+    genuine = [s for s, is_genuine, _, _ in samples if is_genuine]
+    impostor = [s for s, is_genuine, _, _ in samples if not is_genuine]
+
+    if not genuine or not impostor:
+        print(f"❌ Se necesitan scores genuinos e impostores (genuinos: {len(genuine)}, impostores: {len(impostor)})")
+        sys.exit(1)
+
+    curve = rate_curve(genuine, impostor, max(s for s, _, _, _ in samples))
+
+    print_header("MUESTRAS")
+    print(f"   Genuinos: {len(genuine)}   Impostores: {len(impostor)}")
+    if len(impostor) < 1 / args.target_far:
+        print(f"⚠️  Con {len(impostor)} impostores no se puede medir un FAR de {args.target_far:g} con confianza")
+
+    print_header("PUNTOS DE OPERACIÓN")
+    eer_t, eer = equal_error_rate(curve)
+    print(f"   EER: {eer:.4%} (umbral {eer_t})")
+    for target in sorted(set(TARGET_FARS + (args.target_far,)), reverse=True):
+        t, far, frr = operating_point(curve, target)
+        print(f"   FAR <= {target:g}: umbral {t:>3}  FAR {far:.4%}  FRR {frr:.4%}")
+
+    threshold, far, frr = operating_point(curve, args.target_far)
+    early_exit, early_fraction = early_exit_score(curve, genuine, args.early_exit_margin)
+    floor, _, _ = operating_point(curve, min(args.target_far * args.user_far_factor, 1.0))
+
+    print_header("RECOMENDACIÓN")
+    print(f"✅ Umbral global (default): {threshold}  (FAR {far:.4%}, FRR {frr:.4%})")
+    print(f"✅ early_exit: {early_exit}  ({early_fraction:.1%} de las consultas genuinas terminan la búsqueda ahí)")
+
+    users, blocked = user_recommendations(samples, threshold, floor, args.max_user_frr, args.min_samples)
+    if users:
+        print(f"\n   Usuarios/dedos con FRR > {args.max_user_frr:.0%} (umbral mínimo permitido: {floor}):")
+        for key, rec in users.items():
+            print(f"   {key:<20} muestras {rec['samples']:>4}  FRR {rec['frr_at_global']:.2%}  -> umbral {rec['threshold']}")
+    if blocked:
+        print(f"\n   Usuarios/dedos con FRR > {args.max_user_frr:.0%} que no se pueden bajar sin superar el FAR:")
+        for key, rec in blocked.items():
+            print(f"   {key:<20} muestras {rec['samples']:>4}  FRR {rec['frr_at_global']:.2%}  (re-enrolar)")
+
+    if args.curve:
+        write_curve(args.curve, curve)
+        print(f"\n📄 Curva FAR/FRR exportada a {args.curve}")
+
+    if args.write_policy:
+        write_policy(args.write_policy, threshold, early_exit, users)
+        print(f"📄 Política escrita en {args.write_policy} (recargar con POST /api/policy/thresholds/reload)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,46 @@
 <?php
 // config.php - Configuración de Base de Datos
+
+// Bridges (URLs separadas por coma) a los que api.php notifica los cambios de la galería;
+// vacío desactiva las notificaciones (los bridges solo detectan cambios por la firma).
+// Solo se envían con PHP-FPM (fastcgi_finish_request): con mod_php se omiten para no
+// demorar la respuesta al cliente.
+define('BRIDGE_NOTIFY_URLS', getenv('BRIDGE_NOTIFY_URLS') !== false
+    ? getenv('BRIDGE_NOTIFY_URLS')
+    : 'http://localhost:5000/api/gallery/changes');
+define('BRIDGE_NOTIFY_TOKEN', (string)getenv('BRIDGE_NOTIFY_TOKEN')); // Igual a GALLERY_NOTIFY_TOKEN del bridge
+define('BRIDGE_NOTIFY_TIMEOUT', 0.5); // Segundos por bridge
+
 class Database {
     private $host = "localhost";
     private $db_name = "fingerprint_db";
     private $username = "root";
     private $password = "";
+    // Conexión persistente: cada proceso de PHP (FPM/mod_php) reutiliza su conexión MySQL
+    // entre solicitudes en lugar de abrir una nueva. DB_PERSISTENT=false la desactiva.
+    private $persistent;
     public $conn;
 
+    // Tiempo (ms) que tomó obtener la conexión en esta solicitud (encabezado Server-Timing)
+    public static $connect_ms = null;
+
+    public function __construct() {
+        $this->persistent = strtolower((string)getenv('DB_PERSISTENT')) !== 'false';
+    }
+
     public function getConnection() {
         $this->conn = null;
+        $start = microtime(true);
         try {
             $this->conn = new PDO(
                 "mysql:host=" . $this->host . ";dbname=" . $this->db_name . ";charset=utf8", 
                 $this->username, 
-                $this->password
+                $this->password,
+                [PDO::ATTR_PERSISTENT => $this->persistent]
             );
             $this->conn->setAttribute(PDO::ATTR_ERRMODE, PDO::ERRMODE_EXCEPTION);
             $this->conn->setAttribute(PDO::ATTR_DEFAULT_FETCH_MODE, PDO::FETCH_ASSOC);
+            self::$connect_ms = round((microtime(true) - $start) * 1000, 2);
         } catch(PDOException $exception) {
             error_log("Error de conexión: " . $exception->getMessage());
             die(json_encode([
@@ -27,4 +51,4 @@ class Database {
         return $this->conn;
     }
 }
-?>
\ No newline at end of file
+?>